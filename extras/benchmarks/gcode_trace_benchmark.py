@@ -0,0 +1,73 @@
+"""
+Measures the per-line cost the G-code trace adds to the `parse_sent_lines` hook.
+
+Run from the repository root:
+
+    python extras/benchmarks/gcode_trace_benchmark.py
+
+The trace module has no OctoPrint dependencies, so it is loaded straight from
+its file without importing the plugin package.
+
+Results vary between machines and runs. Timestamps are stored as deltas, so
+the file size depends on the timing too: a slower or noisier machine has
+larger, less regular deltas that compress less well. Six runs on a single-CPU
+x86 container gave a mean overhead of 0.09 to 0.24 us/line (p99 0.36 to
+0.74 us) and 0.76 to 0.93 bytes/line. A run on another machine gave about
+0.36 us/line and 1.31 bytes/line.
+"""
+import os
+import time
+import tempfile
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_PATH = os.path.join(HERE, "..", "..", "octoprint_mattaconnect", "gcode_trace.py")
+
+spec = importlib.util.spec_from_file_location("gcode_trace", MODULE_PATH)
+gcode_trace = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(gcode_trace)
+
+LINES = 200_000
+FLUSH_EVERY = 1000  # about one data thread tick worth of short segments
+
+
+def run(enabled):
+    trace = gcode_trace.GcodeTrace()
+    path = os.path.join(tempfile.mkdtemp(), "gcode_trace.bin")
+    if enabled:
+        trace.start(path)
+    tags = {"source:file", "filepos:371", "fileline:7"}
+    timings = []
+    for start in range(0, LINES, FLUSH_EVERY):
+        begin = time.perf_counter_ns()
+        for line_num in range(start, start + FLUSH_EVERY):
+            # mirrors the work done per line in parse_sent_lines
+            line = [item for item in tags if item.startswith("fileline")][0]
+            line = line.replace("fileline:", "")
+            if trace.enabled:
+                trace.record(line_num)
+        timings.append((time.perf_counter_ns() - begin) / FLUSH_EVERY)
+        trace.flush()
+    trace.stop()
+    size = os.path.getsize(path) if enabled else 0
+    return timings, size, trace
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+if __name__ == "__main__":
+    base, _, _ = run(enabled=False)
+    traced, size, trace = run(enabled=True)
+    overhead = [t - b for t, b in zip(traced, base)]
+    print(f"lines per run:           {LINES}")
+    print(f"hook without trace:      {sum(base) / len(base) / 1000:.3f} us/line")
+    print(f"hook with trace:         {sum(traced) / len(traced) / 1000:.3f} us/line")
+    print(f"trace overhead (mean):   {sum(overhead) / len(overhead) / 1000:.3f} us/line")
+    print(f"trace overhead (p99):    {percentile(overhead, 99) / 1000:.3f} us/line")
+    print(f"trace file size:         {size} bytes ({size / LINES:.2f} bytes/line)")
+    print(f"dropped records:         {trace.dropped}")
+    lines, times = gcode_trace.read_trace(trace.path)
+    assert list(lines) == list(range(LINES)), "trace did not round trip"
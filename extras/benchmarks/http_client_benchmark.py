@@ -0,0 +1,111 @@
+"""
+Compares module-level `requests.post` calls, which open a new connection per
+call, with the pooled client in `client.py`, against a local stand-in server.
+
+Run from the repository root:
+
+    python extras/benchmarks/http_client_benchmark.py
+
+The server speaks plain HTTP/1.1 on the loopback interface, so the numbers
+leave out the TLS handshake that dominates a fresh connection to the cloud;
+the real-world gap on a Pi is larger than shown here.
+
+The client and the modules it imports have no OctoPrint dependencies, so the
+plugin package is registered without running its __init__ and the client is
+imported from it.
+"""
+import os
+import sys
+import json
+import time
+import types
+import threading
+import importlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_PATH = os.path.join(HERE, "..", "..", "octoprint_mattaconnect")
+
+package = types.ModuleType("octoprint_mattaconnect")
+package.__path__ = [PACKAGE_PATH]
+sys.modules["octoprint_mattaconnect"] = package
+client = importlib.import_module("octoprint_mattaconnect.client")
+
+REQUESTS = 2000
+THREADS = 4
+PAYLOAD = b"x" * 20_000  # about the size of a small frame upload
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real backend
+    disable_nagle_algorithm = True  # as production servers do on keep-alive sockets
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({"ok": True}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(post, url, threads):
+    latencies = []
+    lock = threading.Lock()
+    per_thread = REQUESTS // threads
+
+    def worker():
+        mine = []
+        for _ in range(per_thread):
+            begin = time.perf_counter()
+            resp = post(url, data=PAYLOAD, token="token", timeout=(5, 30))
+            resp.raise_for_status()
+            mine.append(time.perf_counter() - begin)
+        with lock:
+            latencies.extend(mine)
+
+    begin = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - begin
+    latencies.sort()
+    return {
+        "req_per_s": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def unpooled_post(url, token=None, **kwargs):
+    return requests.post(url, headers={"Authorization": token}, **kwargs)
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/v1/images/print/predict/new-image"
+    pooled = client.HttpClient()
+
+    print(f"{REQUESTS} POSTs of {len(PAYLOAD)} bytes")
+    for threads in (1, THREADS):
+        for name, post in (("requests.post", unpooled_post), ("HttpClient", pooled.post)):
+            result = run(post, url, threads)
+            print(
+                f"{name:14} threads={threads}  {result['req_per_s']:8.0f} req/s  "
+                f"p50 {result['p50_ms']:6.2f} ms  p99 {result['p99_ms']:6.2f} ms"
+            )
+    pooled.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
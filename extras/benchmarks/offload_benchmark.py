@@ -0,0 +1,119 @@
+"""
+Measures how late a stand-in for OctoPrint's comm thread wakes up while frames
+are transformed and a G-code file is scanned for its first layer, in-process
+and through the offload pool.
+
+Run from the repository root:
+
+    python extras/benchmarks/offload_benchmark.py
+
+The comm thread is simulated by a thread sleeping 1 ms at a time, recording
+how far past its deadline it wakes. Needs Pillow.
+
+The offload module only uses the standard library and imports PIL inside its
+tasks, so it is imported straight from the package directory. Worker processes
+have to import it by name to run the tasks, which rules out loading it from a
+file path.
+"""
+import io
+import os
+import sys
+import time
+import random
+import tempfile
+import threading
+
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "octoprint_mattaconnect"))
+
+import offload  # noqa: E402
+
+FRAMES = 40
+GCODE_LAYERS = 200
+GCODE_LINES_PER_LAYER = 1000
+SCANS = 20
+FRAME_SIZE = (1280, 720)
+COMM_PERIOD = 0.001  # seconds between serial writes of the stand-in comm thread
+
+
+def make_frame():
+    random.seed(0)
+    image = Image.new("RGB", FRAME_SIZE)
+    image.putdata(
+        [
+            (random.randrange(256), random.randrange(256), random.randrange(256))
+            for _ in range(FRAME_SIZE[0] * FRAME_SIZE[1] // 16)
+        ]
+        * 16
+    )
+    byte_arr = io.BytesIO()
+    image.save(byte_arr, format="JPEG", quality=85)
+    return byte_arr.getvalue()
+
+
+def make_gcode():
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.gcode")
+    with open(path, "w") as gcode:
+        gcode.write("; generated\nG28\nG1 Z5 F3000\n")
+        for layer in range(GCODE_LAYERS):
+            gcode.write(f";LAYER:{layer}\nG1 Z{0.2 + layer * 0.2:.2f}\n")
+            for i in range(GCODE_LINES_PER_LAYER):
+                gcode.write(f"G1 X{i % 200}.{i % 10} Y{i % 180}.5 E{i * 0.03:.5f}\n")
+    return path
+
+
+def run(task, *args, repeat=1):
+    lateness = []
+    stop = threading.Event()
+
+    def comm_thread():
+        while not stop.is_set():
+            deadline = time.perf_counter() + COMM_PERIOD
+            time.sleep(COMM_PERIOD)
+            lateness.append(time.perf_counter() - deadline)
+
+    comm = threading.Thread(target=comm_thread)
+    comm.start()
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        task(*args)
+    elapsed = time.perf_counter() - begin
+    stop.set()
+    comm.join()
+    lateness.sort()
+    return {
+        "per_s": repeat / elapsed,
+        "p50_ms": lateness[len(lateness) // 2] * 1000,
+        "p99_ms": lateness[int(len(lateness) * 0.99)] * 1000,
+        "max_ms": lateness[-1] * 1000,
+    }
+
+
+def main():
+    frame = make_frame()
+    gcode_path = make_gcode()
+    pool = offload.OffloadPool(workers=1)
+    pool.transform_frame(frame, False, False, False)  # start the worker outside the timing
+
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{FRAMES} frames of {FRAME_SIZE[0]}x{FRAME_SIZE[1]}, {len(frame)} bytes JPEG")
+    for name, transform in (("in-process", offload.transform_frame), ("offloaded", pool.transform_frame)):
+        report(name, "frames/s", run(transform, frame, True, False, True, repeat=FRAMES))
+    print(f"{SCANS} first layer scans of {GCODE_LAYERS * GCODE_LINES_PER_LAYER} G-code lines")
+    for name, scan in (("in-process", offload.scan_first_layer), ("offloaded", pool.scan_first_layer)):
+        report(name, "scans/s", run(scan, gcode_path, repeat=SCANS))
+    pool.close()
+    os.remove(gcode_path)
+
+
+def report(name, unit, result):
+    print(
+        f"  {name:10}  {result['per_s']:6.1f} {unit:8}  comm thread late by "
+        f"p50 {result['p50_ms']:6.2f} ms  p99 {result['p99_ms']:6.2f} ms  max {result['max_ms']:6.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
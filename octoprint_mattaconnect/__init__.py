@@ -2,11 +2,23 @@
 import flask
 import base64
 import octoprint.plugin
+from octoprint.events import Events
 import signal
-from .utils import init_sentry
+import importlib
+from time import perf_counter
+from .config import config
+from .timing import StartupTimings
+from .metrics import metrics, HOOK_BUCKETS
 
-from .matta import MattaCore
-from .printer import MattaPrinter
+# imported in on_after_startup rather than when OctoPrint loads the plugin
+DEFERRED_IMPORTS = ("sentry_sdk", "requests", "psutil", "websocket")
+
+SENT_HOOK = metrics.histogram(
+    "matta_hook_seconds", "Time spent in the G-code hooks", {"hook": "sent"}, HOOK_BUCKETS
+)
+RECEIVED_HOOK = metrics.histogram(
+    "matta_hook_seconds", "Time spent in the G-code hooks", {"hook": "received"}, HOOK_BUCKETS
+)
 
 
 class MattaconnectPlugin(
@@ -29,11 +41,63 @@ class MattaconnectPlugin(
             "snapshot_url": "http://localhost/webcam/?action=snapshot",
             "webrtc_url": "http://localhost/webcam/webrtc",
             "live_upload": False,
+            "live_upload_interval": 60,
             "flip_h": False,
             "flip_v": False,
             "rotate": False,
+            "gcode_cache_size_mb": 1024,
+            "queue_prefetch_count": 2,
+            # every *_kbps setting is a rate in KiB per second, 0 for unlimited
+            "queue_prefetch_kbps": 1024,
+            "queue_prefetch_disk_mb": 512,
+            "layer_capture": True,
+            "layer_capture_interval": 1,
+            "layer_capture_min_interval": 0.6,
+            "gcode_trace": False,
+            "telemetry_commit_rows": 48,
+            "telemetry_commit_interval": 30.0,
+            "adaptive_sampling": True,
+            "http2": False,
+            "bandwidth_up_kbps": 0,
+            "bandwidth_down_kbps": 0,
+            "bandwidth_reserve_percent": 25,
+            "sampling_frame_kbps": 256,
+            "sampling_cpu_percent": 15,
+            "sampling_boost_duration": 30,
+            # worker processes for frame transforms and G-code scans, 0 runs them in-process
+            "offload_workers": 0,
+            "resource_governor": True,
         }
 
+    def on_settings_save(self, data):
+        """Saves the settings from the settings dialog and refreshes the settings snapshot"""
+        octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        config.refresh()
+
+    def on_event(self, event, payload):
+        """
+        Forwards print lifecycle events to the data engine, which starts and
+        stops data collection on them, and refreshes the settings snapshot
+        when OctoPrint's settings change.
+
+        Args:
+            event (str): The OctoPrint event name.
+            payload (dict): The event payload.
+        """
+        if event == Events.SETTINGS_UPDATED:
+            config.refresh()
+
+        if event in (
+            Events.PRINT_STARTED,
+            Events.PRINT_DONE,
+            Events.PRINT_FAILED,
+            Events.PRINT_CANCELLED,
+        ):
+            try:
+                self.matta_os.data_engine.on_print_event(event, payload)
+            except AttributeError:
+                self._logger.debug(f"Data engine not ready for {event}.")
+
     def get_template_configs(self):
         """Returns the template configurations for the plugin"""
         self._logger.debug("MattaConnect - is loading template configurations. Okay.")
@@ -68,14 +132,58 @@ class MattaconnectPlugin(
     def on_after_startup(self):
         """
         Function that runs after OctoPrint starts and the plugin is loaded.
-        Sets up the threads and variables needed.
+        Imports the heavy dependencies and starts the plugin's subsystems,
+        timing each step, so none of it holds up OctoPrint's own start-up.
         """
         self._logger.debug("MattaConnect plugin - is starting up.")
+        startup = self.startup
+        try:
+            for name in DEFERRED_IMPORTS:
+                with startup.measure(f"import {name}"):
+                    importlib.import_module(name)
+            with startup.measure("import plugin"):
+                from .utils import init_sentry
+                from .governor import resources
+                from .matta import MattaCore
+            with startup.measure("sentry"):
+                init_sentry(self._plugin_version)
+            matta_os = MattaCore(self, startup=startup)
+        except Exception as e:
+            self._logger.error(f"MattaConnect failed to start: {e}")
+            return
+        self.comm_monitor = resources.comm
+        self.matta_os = matta_os
+        self._logger.info(
+            f"MattaConnect started in {startup.total() * 1000:.0f}ms: {startup.summary()}"
+        )
+
+    def on_shutdown(self):
+        """
+        Writes pending settings changes, unhooks the plugin from OctoPrint's
+        printer callbacks and closes pooled connections and workers.
+        """
+        try:
+            config.flush()
+            if self.matta_os is None:
+                return
+            from .client import http
+
+            self.matta_os._printer.close()
+            self.matta_os.data_engine.offload.close()
+            http.close()
+        except Exception as e:
+            self._logger.error(e)
 
     def initialize(self):
-        """Initialize the plugin"""
-        init_sentry(self._plugin_version)
-        self.matta_os = MattaCore(self)
+        """
+        Initialize the plugin. Only the settings are set up here, the rest
+        starts in on_after_startup and the hooks do nothing until then.
+        """
+        self.startup = StartupTimings()
+        self.matta_os = None
+        self.comm_monitor = None
+        with self.startup.measure("settings"):
+            config.configure(self._settings, self.get_settings_defaults(), self._logger)
 
     def get_api_commands(self):
         """
@@ -88,6 +196,8 @@ class MattaconnectPlugin(
             test_auth_token=["auth_token"],
             snapshot=["url"],
             set_enabled=[],
+            camera_health=[],
+            metrics=[],
         )
 
     def is_api_adminonly(self):
@@ -110,6 +220,20 @@ class MattaconnectPlugin(
         Returns:
             flask.Response: A JSON response containing the result of the command execution.
         """
+        if command == "metrics":
+            # available while starting up too, the start-up itself is what may need looking at
+            if data.get("format") == "prometheus":
+                return flask.Response(
+                    metrics.prometheus(), mimetype="text/plain; version=0.0.4"
+                )
+            return flask.jsonify(metrics.to_dict())
+
+        if self.matta_os is None:
+            return flask.make_response(
+                flask.jsonify({"success": False, "text": "MattaConnect is still starting up."}),
+                503,
+            )
+
         if command == "test_auth_token":
             auth_token = data["auth_token"]
             success, status_text = self.matta_os.test_auth_token(token=auth_token)
@@ -126,6 +250,9 @@ class MattaconnectPlugin(
                 {"success": success, "text": status_text, "image": image_base64}
             )
 
+        if command == "camera_health":
+            return flask.jsonify(self.matta_os._printer.camera.to_dict())
+
     def parse_received_lines(self, comm_instance, line, *args, **kwargs):
         """
         Parse received lines from the printer's communication and update the printer's state accordingly.
@@ -139,12 +266,11 @@ class MattaconnectPlugin(
         Returns:
             str: The parsed line.
         """
-        try:
+        if self.matta_os is not None:
+            started = perf_counter()
+            self.comm_monitor.on_received(line)
             self.matta_os._printer.parse_line_for_updates(line)
-        except AttributeError:
-            self.matta_os._printer = MattaPrinter(
-                self._printer, self._logger, self._file_manager
-            )
+            RECEIVED_HOOK.observe(perf_counter() - started)
 
         if "UPDATED" in line:
             self.executed_update = True
@@ -183,6 +309,9 @@ class MattaconnectPlugin(
         Returns:
             str: The parsed command.
         """
+        if self.matta_os is None:
+            return cmd
+        started = perf_counter()
         try:
             if tags:
                 # tags is set in format: {'source:file', 'filepos:371', 'fileline:7'}
@@ -194,12 +323,16 @@ class MattaconnectPlugin(
                     ][0]
                     # strip file line to get number
                     line = line.replace("fileline:", "")
-                    self.matta_os._printer.gcode_line_num_no_comments = line
-                    self.matta_os._printer.gcode_cmd = cmd
+                    self.matta_os._printer.gcode_position = (line, cmd)
+                    self.matta_os._printer.layer_trigger.on_sent_line(cmd)
+                    self.comm_monitor.on_sent_file_line()
+                    if self.matta_os._printer.gcode_trace.enabled:
+                        self.matta_os._printer.gcode_trace.record(int(line))
                 elif "plugin:mattaconnect" in tags or "api:printer.command" in tags:
                     self.matta_os.terminal_cmds.append(cmd)
         except Exception as e:
             self._logger.error(e)
+        SENT_HOOK.observe(perf_counter() - started)
         return cmd
 
 
@@ -0,0 +1,213 @@
+'''
+This module holds the bandwidth governor that shares the configured upstream
+and downstream budgets between the plugin's traffic classes, and the
+streaming multipart body used to pace uploads through it.
+
+Control (websocket) and telemetry traffic are never delayed. They draw on the
+link's shared bucket and may run it into debt, which frames and bulk file
+transfers then have to wait out. Frames and bulk transfers are also capped
+below the budget, so part of it is always left as headroom for control and
+telemetry.
+'''
+import os
+import time
+import uuid
+import threading
+
+TRAFFIC_CLASSES = ("control", "telemetry", "frames", "bulk")
+UNSHAPED_CLASSES = ("control", "telemetry")
+# shares of the budget left after the reserve
+CLASS_SHARES = {"frames": 1.0, "bulk": 0.5}
+BANDWIDTH_RESERVE_PERCENT = 25
+BURST_SECONDS = 0.25
+MIN_BURST = 16 * 1024  # bytes
+MAX_DEBT_SECONDS = 2.0  # how far unshaped traffic can push the shared bucket into debt
+CHUNK_SIZE = 16 * 1024  # bytes paced at a time
+
+
+class TokenBucket:
+    """
+    Token bucket paced by reservation: taking bytes deducts them straight
+    away, possibly into debt, and returns how long the caller must wait for
+    the bucket to pay them back. Concurrent callers so queue up fairly.
+    """
+
+    def __init__(self, rate, clock=time.monotonic):
+        self.clock = clock
+        self.rate = float(rate)
+        self.burst = max(MIN_BURST, self.rate * BURST_SECONDS)
+        self.tokens = self.burst
+        self.last = clock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def reserve(self, nbytes, now):
+        """Takes nbytes and returns the seconds until the bucket is out of debt"""
+        self._refill(now)
+        self.tokens -= nbytes
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def charge(self, nbytes, now):
+        """Takes nbytes without waiting, limiting the debt it can cause"""
+        self._refill(now)
+        self.tokens = max(-self.rate * MAX_DEBT_SECONDS, self.tokens - nbytes)
+
+
+class Link:
+    """The buckets of one direction of the internet connection"""
+
+    def __init__(self, kbps, reserve_percent, clock=time.monotonic):
+        self.clock = clock
+        self.limited = kbps > 0
+        self.bytes = {traffic: 0 for traffic in TRAFFIC_CLASSES}
+        self.waited = {traffic: 0.0 for traffic in TRAFFIC_CLASSES}
+        self.kbps = kbps
+        if not self.limited:
+            return
+        rate = kbps * 1024
+        shaped_rate = rate * (1 - reserve_percent / 100.0)
+        self.shared = TokenBucket(rate, clock)
+        self.classes = {
+            traffic: TokenBucket(shaped_rate * share, clock)
+            for traffic, share in CLASS_SHARES.items()
+        }
+
+
+class BandwidthGovernor:
+    """Applies the upstream ("up") and downstream ("down") budgets"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.configure(0, 0)
+
+    def configure(self, upstream_kbps, downstream_kbps, reserve_percent=BANDWIDTH_RESERVE_PERCENT):
+        """
+        Sets the budgets, in KiB/s. A budget of 0 leaves that direction unshaped.
+
+        Args:
+            upstream_kbps (int): The upload budget.
+            downstream_kbps (int): The download budget.
+            reserve_percent (int): The part of each budget kept back for control and telemetry.
+        """
+        with self._lock:
+            self.reserve_percent = float(reserve_percent)
+            self._links = {
+                "up": Link(int(upstream_kbps or 0), self.reserve_percent, self.clock),
+                "down": Link(int(downstream_kbps or 0), self.reserve_percent, self.clock),
+            }
+
+    def limited(self, direction):
+        return self._links[direction].limited
+
+    def throttle(self, direction, traffic, nbytes):
+        """
+        Accounts nbytes of a traffic class, sleeping first if the class has to
+        wait for budget. Control and telemetry never wait.
+
+        Args:
+            direction (str): "up" or "down".
+            traffic (str): One of TRAFFIC_CLASSES.
+            nbytes (int): The number of bytes about to be sent or just received.
+        """
+        with self._lock:
+            link = self._links[direction]
+            link.bytes[traffic] += nbytes
+            if not link.limited:
+                return
+            now = self.clock()
+            if traffic in UNSHAPED_CLASSES:
+                link.shared.charge(nbytes, now)
+                return
+            wait = max(
+                link.shared.reserve(nbytes, now),
+                link.classes[traffic].reserve(nbytes, now),
+            )
+            link.waited[traffic] += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                direction: {
+                    "kbps": link.kbps,
+                    "bytes": dict(link.bytes),
+                    "waited": {k: round(v, 1) for k, v in link.waited.items()},
+                }
+                for direction, link in self._links.items()
+            }
+
+
+class MultipartStream:
+    """
+    A multipart/form-data body generated in chunks, with its length known up
+    front so it is sent with a Content-Length rather than chunked encoding.
+    Each chunk is passed through the governor before it is handed to the socket.
+
+    Args:
+        fields (dict): Form fields, name to str or bytes.
+        files (dict): Files, name to (filename, content, content type), where
+            content is bytes, str or an open binary file.
+        traffic (str): The traffic class the upload belongs to.
+        governor (BandwidthGovernor): The governor pacing the upload.
+    """
+
+    def __init__(self, fields, files, traffic, governor):
+        self.traffic = traffic
+        self.governor = governor
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self._parts = []  # bytes, or (file, size) to be read in chunks
+        for name, value in (fields or {}).items():
+            self._add_header(f'Content-Disposition: form-data; name="{name}"\r\n\r\n')
+            self._parts.append(value.encode("utf-8") if isinstance(value, str) else value)
+            self._parts.append(b"\r\n")
+        for name, (filename, content, content_type) in (files or {}).items():
+            self._add_header(
+                f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f"Content-Type: {content_type}\r\n\r\n"
+            )
+            if isinstance(content, str):
+                content = content.encode("utf-8")
+            if isinstance(content, bytes):
+                self._parts.append(content)
+            else:
+                size = os.fstat(content.fileno()).st_size - content.tell()
+                self._parts.append((content, size))
+            self._parts.append(b"\r\n")
+        self._parts.append(f"--{self.boundary}--\r\n".encode())
+        self.length = sum(
+            len(part) if isinstance(part, bytes) else part[1] for part in self._parts
+        )
+
+    def _add_header(self, header):
+        self._parts.append(f"--{self.boundary}\r\n{header}".encode("utf-8"))
+
+    def __len__(self):
+        return self.length
+
+    def _chunks(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                for i in range(0, len(part), CHUNK_SIZE):
+                    yield part[i : i + CHUNK_SIZE]
+            else:
+                file, remaining = part
+                while remaining > 0:
+                    chunk = file.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError("file shrank while it was being uploaded")
+                    remaining -= len(chunk)
+                    yield chunk
+
+    def __iter__(self):
+        for chunk in self._chunks():
+            self.governor.throttle("up", self.traffic, len(chunk))
+            yield chunk
+
+
+# shared by the whole plugin, so all transfers draw on the same budgets
+bandwidth = BandwidthGovernor()
@@ -0,0 +1,209 @@
+'''
+This module holds the circuit breakers guarding calls to the backend and the
+camera. A breaker watches the outcome and latency of recent calls to one
+endpoint, stops calling it for a while once too many fail or run slow, and
+then lets single probe calls through to find out if it has recovered.
+'''
+import time
+import threading
+from collections import deque
+
+import requests
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+BREAKER_WINDOW = 20  # recent calls considered
+BREAKER_MIN_CALLS = 5  # calls needed in the window before the breaker can open
+BREAKER_ERROR_RATE = 0.5
+BREAKER_SLOW_RATE = 0.8
+BREAKER_SLOW_CALL = 10.0  # seconds
+BREAKER_OPEN_SECONDS = 30.0
+BREAKER_MAX_OPEN_SECONDS = 300.0
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of making a call while the endpoint's breaker is open"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Circuit for {name} is open, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Breaker for a single endpoint.
+
+    Closed, it records the outcome and latency of each call in a sliding
+    window and opens when the error rate or the share of slow calls passes its
+    threshold. Open, it rejects calls until its open time has passed, then
+    goes half-open and lets one probe through: a successful probe closes it,
+    a failed one opens it again for twice as long.
+    """
+
+    def __init__(
+        self,
+        name,
+        window=BREAKER_WINDOW,
+        min_calls=BREAKER_MIN_CALLS,
+        error_rate=BREAKER_ERROR_RATE,
+        slow_rate=BREAKER_SLOW_RATE,
+        slow_call=BREAKER_SLOW_CALL,
+        open_seconds=BREAKER_OPEN_SECONDS,
+        max_open_seconds=BREAKER_MAX_OPEN_SECONDS,
+        clock=time.monotonic,
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_call = slow_call
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=window)  # (succeeded, slow) per call
+        self.state = CLOSED
+        self.open_seconds = open_seconds
+        self.open_until = 0.0
+        self.probe_in_flight = False
+        self.opened = 0
+        self.rejected = 0
+        self.last_error = None
+
+    def allow(self):
+        """
+        Checks if a call may be made now. In the half-open state only one
+        caller at a time is let through, as the probe.
+
+        Returns:
+            bool: True if the call may go ahead.
+        """
+        with self._lock:
+            if self.state == OPEN and self.clock() >= self.open_until:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self):
+        """Returns the seconds until the breaker lets a probe through"""
+        with self._lock:
+            if self.state == CLOSED:
+                return 0.0
+            return max(0.0, self.open_until - self.clock())
+
+    def check(self):
+        """
+        Raises if the breaker does not allow a call now.
+
+        Raises:
+            CircuitOpenError: If the breaker is open.
+        """
+        if not self.allow():
+            raise CircuitOpenError(self.name, max(1.0, self.retry_after()))
+
+    def _open(self):
+        self.state = OPEN
+        self.open_until = self.clock() + self.open_seconds
+        self.opened += 1
+        self._calls.clear()
+
+    def record(self, succeeded, latency=None, error=None):
+        """
+        Records the outcome of a call.
+
+        Args:
+            succeeded (bool): Whether the endpoint answered properly.
+            latency (float): How long the call took, in seconds.
+            error (str): What went wrong, if it failed.
+        """
+        slow = latency is not None and latency >= self.slow_call
+        with self._lock:
+            if not succeeded:
+                self.last_error = error
+            if self.state == HALF_OPEN:
+                self.probe_in_flight = False
+                if succeeded and not slow:
+                    self.state = CLOSED
+                    self.open_seconds = self.base_open_seconds
+                    self._calls.clear()
+                else:
+                    self.open_seconds = min(self.max_open_seconds, self.open_seconds * 2)
+                    self._open()
+                return
+            if self.state != CLOSED:
+                return
+            self._calls.append((succeeded, slow))
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for ok, _ in self._calls if not ok)
+            slow_calls = sum(1 for _, is_slow in self._calls if is_slow)
+            if (
+                failures >= self.error_rate * len(self._calls)
+                or slow_calls >= self.slow_rate * len(self._calls)
+            ):
+                self._open()
+
+    def reset(self):
+        """Closes the breaker, e.g. after the endpoint was reconfigured"""
+        with self._lock:
+            self.state = CLOSED
+            self.open_seconds = self.base_open_seconds
+            self.probe_in_flight = False
+            self._calls.clear()
+
+    def to_dict(self):
+        with self._lock:
+            failures = sum(1 for ok, _ in self._calls if not ok)
+            return {
+                "state": self.state,
+                "recent_calls": len(self._calls),
+                "recent_failures": failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "retry_after": (
+                    None
+                    if self.state == CLOSED
+                    else round(max(0.0, self.open_until - self.clock()), 1)
+                ),
+                "last_error": self.last_error,
+            }
+
+
+class BreakerRegistry:
+    """Creates and holds one breaker per endpoint name"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, name, **params):
+        """
+        Returns the breaker for an endpoint, creating it on first use.
+
+        Args:
+            name (str): The endpoint name.
+            **params: CircuitBreaker arguments, used only when the breaker is created.
+        """
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, **params)
+                self._breakers[name] = breaker
+            return breaker
+
+    def to_dict(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.to_dict() for breaker in breakers}
+
+
+# shared by the whole plugin, so every caller of an endpoint sees the same health
+breakers = BreakerRegistry()
@@ -0,0 +1,262 @@
+'''
+This module holds the content-addressed cache of G-code files, so that a file
+the cloud has sent before can be put in place without downloading it again.
+'''
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+HASH_REGEX = re.compile(r"^[0-9a-f]{64}$")
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    """
+    Computes the SHA-256 hash of a file.
+
+    Args:
+        path (str): The path of the file to hash.
+
+    Returns:
+        str: The hex digest of the file contents.
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def copy_and_hash(source, destination):
+    """
+    Copies a file and computes the SHA-256 hash of its contents in the same pass.
+
+    Returns:
+        str: The hex digest of the file contents.
+    """
+    sha = hashlib.sha256()
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+            dst.write(chunk)
+    return sha.hexdigest()
+
+
+def link_or_copy(source, destination):
+    """Hard links source to destination, falling back to a copy across filesystems"""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class GcodeCache:
+    """
+    Content-addressed store of G-code files keyed by their SHA-256 hash, with a
+    least-recently-used size budget.
+
+    Files are copied into the cache, never linked, so it does not follow
+    changes to the file a job printed from. Cached files are hard linked out
+    into the uploads directory though, where OctoPrint may later rewrite them
+    in place, so an entry is hashed again before it is used and dropped if
+    its contents no longer match. Recency is kept in a small JSON index rather
+    than file mtimes, since linked out files share their inode.
+    """
+
+    def __init__(self, cache_dir, max_bytes, logger):
+        self._dir = cache_dir
+        self._max_bytes = max_bytes
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._index = {}  # hash -> {"size": int, "last_used": float}
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_index()
+        except OSError as e:
+            self._logger.error(f"Failed to set up G-code cache at {cache_dir}: {e}")
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, "r") as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            index = {}
+        # only keep entries whose file is still on disk, and pick up strays
+        self._index = {}
+        for name in os.listdir(self._dir):
+            if not HASH_REGEX.match(name):
+                continue
+            entry = index.get(name, {})
+            self._index[name] = {
+                "size": os.path.getsize(os.path.join(self._dir, name)),
+                "last_used": entry.get("last_used", 0.0),
+            }
+
+    def _save_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self._index, file)
+        os.replace(tmp_path, self._index_path)
+
+    def _path(self, file_hash):
+        return os.path.join(self._dir, file_hash)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry["size"] for entry in self._index.values())
+
+    def size_of(self, hashes):
+        """Returns the combined size of the cached files among the given hashes"""
+        with self._lock:
+            return sum(
+                self._index[file_hash]["size"]
+                for file_hash in hashes
+                if file_hash in self._index
+            )
+
+    def has(self, file_hash, verify=False):
+        """
+        Checks if a file with the given hash is in the cache.
+
+        Args:
+            file_hash (str): The hash of the file.
+            verify (bool): Hash the cached file again and drop it if its contents changed,
+                before it is linked into place.
+        """
+        if not file_hash:
+            return False
+        file_hash = file_hash.lower()
+        with self._lock:
+            if file_hash not in self._index or not os.path.exists(self._path(file_hash)):
+                return False
+        if not verify:
+            return True
+        try:
+            actual_hash = hash_file(self._path(file_hash))
+        except OSError:
+            actual_hash = None
+        if actual_hash == file_hash:
+            return True
+        self._logger.warning(f"Cached G-code {file_hash} changed on disk, dropping it")
+        with self._lock:
+            self._remove(file_hash)
+            self._save_index()
+        return False
+
+    def link_to(self, file_hash, destination_path):
+        """
+        Links a cached file into place and marks it as recently used.
+
+        Args:
+            file_hash (str): The hash of the cached file.
+            destination_path (str): Where the file should appear.
+
+        Returns:
+            bool: True if the file was put in place, False if it is not cached.
+        """
+        file_hash = file_hash.lower()
+        with self._lock:
+            if file_hash not in self._index:
+                return False
+            try:
+                link_or_copy(self._path(file_hash), destination_path)
+            except FileNotFoundError:
+                del self._index[file_hash]
+                return False
+            self._index[file_hash]["last_used"] = time.time()
+            self._save_index()
+        return True
+
+    def put_bytes(self, content, expected_hash=None):
+        """
+        Adds file content to the cache.
+
+        Args:
+            content (bytes): The file content.
+            expected_hash (str): The hash the sender claims the content has.
+
+        Returns:
+            str: The hash the content is stored under.
+        """
+        file_hash = hashlib.sha256(content).hexdigest()
+        self._check_hash(file_hash, expected_hash)
+        with self._lock:
+            if file_hash not in self._index:
+                tmp_path = self._path(file_hash) + ".tmp"
+                with open(tmp_path, "wb") as file:
+                    file.write(content)
+                os.replace(tmp_path, self._path(file_hash))
+            self._add_entry(file_hash, len(content))
+        return file_hash
+
+    def put_file(self, path, expected_hash=None):
+        """
+        Adds a copy of an existing file to the cache.
+
+        Args:
+            path (str): The path of the file to add.
+            expected_hash (str): The hash the sender claims the file has.
+
+        Returns:
+            str: The hash the file is stored under.
+        """
+        tmp_path = os.path.join(self._dir, f"put-{threading.get_ident()}.tmp")
+        try:
+            file_hash = copy_and_hash(path, tmp_path)
+            self._check_hash(file_hash, expected_hash)
+            with self._lock:
+                if file_hash not in self._index:
+                    os.replace(tmp_path, self._path(file_hash))
+                self._add_entry(file_hash, os.path.getsize(self._path(file_hash)))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return file_hash
+
+    def _check_hash(self, file_hash, expected_hash):
+        if expected_hash and expected_hash.lower() != file_hash:
+            self._logger.warning(
+                f"G-code hash mismatch, expected {expected_hash} got {file_hash}"
+            )
+
+    def resize(self, max_bytes):
+        """Changes the size budget, evicting entries if the cache is now over it"""
+        with self._lock:
+            if max_bytes == self._max_bytes:
+                return
+            self._max_bytes = max_bytes
+            self._evict()
+            self._save_index()
+
+    def _add_entry(self, file_hash, size):
+        """Records a new entry and evicts old ones. Must be called with the lock held."""
+        self._index[file_hash] = {"size": size, "last_used": time.time()}
+        self._evict(keep=file_hash)
+        self._save_index()
+
+    def _evict(self, keep=None):
+        total = sum(entry["size"] for entry in self._index.values())
+        by_age = sorted(self._index.items(), key=lambda item: item[1]["last_used"])
+        for file_hash, entry in by_age:
+            if total <= self._max_bytes:
+                break
+            if file_hash == keep:
+                continue
+            total -= entry["size"]
+            self._remove(file_hash)
+            self._logger.debug(f"Evicted {file_hash} from G-code cache")
+
+    def _remove(self, file_hash):
+        """Deletes an entry and its file. Must be called with the lock held."""
+        try:
+            os.remove(self._path(file_hash))
+        except FileNotFoundError:
+            pass
+        self._index.pop(file_hash, None)
@@ -0,0 +1,210 @@
+'''
+This module holds the camera health monitor that every snapshot fetch goes
+through. It bounds how long a frame may take, checks that what came back is
+a whole image, backs off exponentially while the camera keeps failing, and
+keeps latency and availability figures for the plugin's API.
+'''
+import time
+import threading
+from collections import deque
+
+import requests
+
+from .client import http, CAMERA_TIMEOUT
+
+CAMERA_SLOW_FRAME = 2.0  # seconds, frames slower than this mark the camera degraded
+CAMERA_MAX_FRAME_SECONDS = 10.0  # a frame taking longer than this in total is abandoned
+CAMERA_MAX_FRAME_BYTES = 20 * 1024**2
+CAMERA_FAILURE_THRESHOLD = 3  # consecutive failures before backing off
+CAMERA_BASE_BACKOFF = 2.0  # seconds
+CAMERA_MAX_BACKOFF = 120.0  # seconds
+CAMERA_WINDOW = 100  # recent fetches kept for availability and latency
+
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class CameraError(Exception):
+    """A snapshot fetch that did not produce a usable frame"""
+
+    def __init__(self, kind, message):
+        super().__init__(message)
+        self.kind = kind
+
+
+def check_frame(data):
+    """
+    Checks that a frame is a complete JPEG or PNG, without decoding it.
+
+    Raises:
+        CameraError: If the frame is empty, truncated or not an image.
+    """
+    if not data:
+        raise CameraError("corrupt", "empty frame")
+    if data.startswith(PNG_SIGNATURE):
+        return
+    if not data.startswith(JPEG_START):
+        raise CameraError("corrupt", "frame is not a JPEG or PNG image")
+    # some streamers pad frames, so look for the end marker past trailing zeros
+    if not data.rstrip(b"\x00").endswith(JPEG_END):
+        raise CameraError("corrupt", "truncated JPEG frame")
+
+
+class CameraMonitor:
+    """
+    Fetches snapshots and tracks the camera's health.
+
+    After CAMERA_FAILURE_THRESHOLD consecutive failures, fetches are skipped
+    for a backoff that starts at CAMERA_BASE_BACKOFF and doubles up to
+    CAMERA_MAX_BACKOFF. The first fetch after a backoff is a probe, and a
+    single good probe restores the full rate straight away.
+    """
+
+    def __init__(self, logger, clock=time.monotonic):
+        self._logger = logger
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=CAMERA_WINDOW)  # True for a usable frame
+        self._latencies = deque(maxlen=CAMERA_WINDOW)
+        self.failures = {}
+        self.frames = 0
+        self.slow_frames = 0
+        self.skipped = 0
+        self.reset()
+
+    def reset(self):
+        """Clears the backoff, e.g. after the snapshot URL was changed or tested"""
+        with self._lock:
+            self.consecutive_failures = 0
+            self.backoff = 0.0
+            self.backoff_until = 0.0
+            self.last_slow = False
+            self.last_error = None
+
+    def available(self, now=None):
+        """Returns False while fetches are being held back"""
+        now = self.clock() if now is None else now
+        return now >= self.backoff_until
+
+    def fetch(self, url, force=False):
+        """
+        Fetches one frame from the camera.
+
+        Args:
+            url (str): The snapshot URL.
+            force (bool): Fetch even while backing off, e.g. for a user-triggered test.
+
+        Returns:
+            bytes: The frame, or None if the camera is backing off or the fetch failed.
+        """
+        started = self.clock()
+        if not force and not self.available(started):
+            with self._lock:
+                self.skipped += 1
+            return None
+        try:
+            data = self._read(url, started)
+            check_frame(data)
+        except CameraError as e:
+            self._failure(e.kind, str(e), self.clock() - started)
+            return None
+        self._success(self.clock() - started)
+        return data
+
+    def _read(self, url, started):
+        """Reads a frame, abandoning it once CAMERA_MAX_FRAME_SECONDS have passed"""
+        try:
+            with http.get(url, stream=True, timeout=CAMERA_TIMEOUT) as resp:
+                if resp.status_code != 200:
+                    raise CameraError("status", f"status code {resp.status_code}")
+                chunks = []
+                size = 0
+                for chunk in resp.iter_content(chunk_size=65536):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size > CAMERA_MAX_FRAME_BYTES:
+                        raise CameraError("corrupt", f"frame larger than {CAMERA_MAX_FRAME_BYTES} bytes")
+                    if self.clock() - started > CAMERA_MAX_FRAME_SECONDS:
+                        raise CameraError("timeout", "frame took too long to arrive")
+                return b"".join(chunks)
+        except requests.exceptions.Timeout as e:
+            raise CameraError("timeout", str(e))
+        except requests.exceptions.ConnectionError as e:
+            raise CameraError("connection", str(e))
+        except requests.exceptions.RequestException as e:
+            raise CameraError("request", str(e))
+
+    def _success(self, latency):
+        slow = latency >= CAMERA_SLOW_FRAME
+        with self._lock:
+            if self.backoff:
+                self._logger.info(f"Camera is back after {self.consecutive_failures} failed fetches.")
+            self.consecutive_failures = 0
+            self.backoff = 0.0
+            self.backoff_until = 0.0
+            self.last_slow = slow
+            self.frames += 1
+            if slow:
+                self.slow_frames += 1
+            self._outcomes.append(True)
+            self._latencies.append(latency)
+
+    def _failure(self, kind, error, latency):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.failures[kind] = self.failures.get(kind, 0) + 1
+            self.last_error = f"{kind}: {error}"
+            self._outcomes.append(False)
+            if kind == "timeout":
+                self._latencies.append(latency)
+            if self.consecutive_failures >= CAMERA_FAILURE_THRESHOLD:
+                self.backoff = min(
+                    CAMERA_MAX_BACKOFF,
+                    max(CAMERA_BASE_BACKOFF, self.backoff * 2),
+                )
+                self.backoff_until = self.clock() + self.backoff
+                self._logger.info(
+                    f"Camera failed {self.consecutive_failures} times ({self.last_error}), "
+                    f"next try in {self.backoff:.0f}s."
+                )
+
+    def mark_corrupt(self, error):
+        """Records a frame that passed the checks here but could not be decoded"""
+        self._failure("corrupt", error, 0.0)
+
+    def state(self):
+        if self.backoff:
+            return "down"
+        if self.consecutive_failures or self.last_slow:
+            return "degraded"
+        return "healthy"
+
+    def to_dict(self):
+        with self._lock:
+            outcomes = list(self._outcomes)
+            latencies = sorted(self._latencies)
+            now = self.clock()
+            return {
+                "state": self.state(),
+                "availability": (
+                    round(sum(outcomes) / len(outcomes), 3) if outcomes else None
+                ),
+                "latency_ms": {
+                    "p50": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+                    "p95": (
+                        round(latencies[int(len(latencies) * 0.95)] * 1000, 1)
+                        if latencies
+                        else None
+                    ),
+                    "max": round(latencies[-1] * 1000, 1) if latencies else None,
+                },
+                "frames": self.frames,
+                "slow_frames": self.slow_frames,
+                "failures": dict(self.failures),
+                "consecutive_failures": self.consecutive_failures,
+                "skipped": self.skipped,
+                "backoff": self.backoff,
+                "retry_in": round(max(0.0, self.backoff_until - now), 1) if self.backoff else None,
+                "last_error": self.last_error,
+            }
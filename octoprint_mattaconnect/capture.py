@@ -0,0 +1,134 @@
+'''
+This module holds the event-driven frame capture trigger, which watches the
+sent G-code stream for layer changes so a frame can be taken the moment a
+layer completes rather than on the next periodic sample.
+'''
+import re
+import time
+import threading
+from collections import deque
+
+Z_REGEX = re.compile(r"Z(-?\d*\.?\d+)")
+Z_EPSILON = 0.001  # mm, ignore float noise between moves
+LAYER_CHANGE_BACKLOG = 1024  # layer changes kept for the data thread, oldest dropped first
+
+
+class LayerCaptureTrigger:
+    """
+    Detects layer changes in sent G-code lines and signals the data thread.
+
+    A layer change is counted when the first extruding move happens at a new,
+    higher Z, so Z-hops on travel moves are not mistaken for new layers. Every
+    change is also queued with its start time, so the data thread can close
+    each layer when it ends even if it was shorter than a sampling period.
+    """
+
+    def __init__(self, enabled=True, layer_interval=1, min_frame_interval=0.6):
+        self.enabled = enabled
+        self.layer_interval = max(1, int(layer_interval))
+        self.min_frame_interval = min_frame_interval
+        self.budget_period = 0.0
+        self.period_factor = 1.0
+        self.event = threading.Event()
+        self.changes = deque(maxlen=LAYER_CHANGE_BACKLOG)
+        self.reset()
+
+    def configure(self, enabled, layer_interval, min_frame_interval):
+        """Applies the layer capture settings"""
+        self.enabled = enabled
+        self.layer_interval = max(1, int(layer_interval))
+        self.min_frame_interval = float(min_frame_interval)
+
+    def set_budget(self, budget_period, period_factor=1.0):
+        """
+        Holds layer captures to the frame budget as well as to min_frame_interval.
+
+        Args:
+            budget_period (float): The shortest frame period the sampling policy's
+                bandwidth and CPU budget allows, in seconds.
+            period_factor (float): The factor the resource governor stretches frame periods by.
+        """
+        self.budget_period = budget_period
+        self.period_factor = period_factor
+
+    def frame_interval(self):
+        """Returns the seconds a layer capture has to keep from the last frame"""
+        return max(self.min_frame_interval, self.budget_period) * self.period_factor
+
+    def reset(self):
+        """Clears the layer state at the start of a job"""
+        self.current_z = None
+        self.layer_z = None
+        self.layer = 0
+        self.layer_started_at = None
+        self.last_capture = 0.0
+        self.pending_since = None
+        self.changes.clear()
+        self.event.clear()
+
+    def on_sent_line(self, cmd):
+        """
+        Inspects a sent G-code line. Called from the comm thread, so kept cheap.
+
+        Args:
+            cmd (str): The G-code line sent to the printer.
+        """
+        if not (cmd.startswith("G1") or cmd.startswith("G0")):
+            return
+        if "Z" in cmd:
+            match = Z_REGEX.search(cmd)
+            if match:
+                self.current_z = float(match.group(1))
+        if "E" not in cmd or self.current_z is None:
+            return
+        if self.layer_z is None or self.current_z > self.layer_z + Z_EPSILON:
+            self.layer_z = self.current_z
+            self.layer += 1
+            self.layer_started_at = time.time()
+            self.changes.append((self.layer, self.layer_z, self.layer_started_at))
+            if self.enabled and self.layer % self.layer_interval == 0:
+                if self.pending_since is None:
+                    self.pending_since = time.perf_counter()
+            self.event.set()
+
+    def pop_changes(self):
+        """
+        Takes the layer changes seen since the last call.
+
+        Returns:
+            list: (layer, z, started_at) tuples in the order the layers started.
+        """
+        changes = []
+        while True:
+            try:
+                changes.append(self.changes.popleft())
+            except IndexError:
+                return changes
+
+    def wait(self, timeout):
+        """Sleeps until a layer change is signalled or the timeout expires"""
+        if self.event.wait(timeout):
+            self.event.clear()
+
+    def capture_due(self, now):
+        """
+        Checks if a layer capture should be taken now. Captures are held back
+        until frame_interval has passed since the last frame, which bounds both
+        the capture latency and the total frame rate, so short layers cannot
+        push frames past the bandwidth budget or the governor's slowdown.
+        """
+        return (
+            self.pending_since is not None
+            and now - self.last_capture >= self.frame_interval()
+        )
+
+    def time_until_due(self, now):
+        """Returns the seconds until a pending layer capture may be taken, or None"""
+        if self.pending_since is None:
+            return None
+        return max(0.0, self.last_capture + self.frame_interval() - now)
+
+    def mark_captured(self, now):
+        """Records that a frame was taken, by either the layer trigger or the timer"""
+        self.last_capture = now
+        self.pending_since = None
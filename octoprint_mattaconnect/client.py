@@ -0,0 +1,276 @@
+'''
+This module holds the shared HTTP client used for every cloud and camera
+call. It keeps one keep-alive requests.Session per host, so repeated calls
+reuse the TCP and TLS connection, applies default timeouts to every call, and
+can send the cloud calls over HTTP/2 when httpx is installed.
+'''
+import time
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .breaker import breakers
+from .bandwidth import bandwidth, MultipartStream
+
+try:
+    import httpx  # optional, HTTP/2 also needs the h2 package
+except ImportError:
+    httpx = None
+
+DEFAULT_TIMEOUT = (5, 30)  # connect, read, in seconds
+CAMERA_TIMEOUT = (2, 5)  # the camera is on the local network
+POOL_MAXSIZE = 8  # concurrent connections kept per host
+# statuses besides 5xx that count against an endpoint's circuit breaker
+BREAKER_FAILURE_STATUS = (429,)
+
+
+class Http2Response:
+    """Gives an httpx response the parts of the requests.Response interface the plugin uses"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        return self._response.content
+
+    @property
+    def text(self):
+        return self._response.text
+
+    def json(self):
+        return self._response.json()
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.exceptions.HTTPError(
+                f"{self.status_code} Error for url: {self.url}", response=self
+            )
+
+    def iter_content(self, chunk_size=8192):
+        return self._response.iter_bytes(chunk_size)
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HttpClient:
+    """
+    Shared HTTP client with a keep-alive connection pool per host.
+
+    Calls take the same arguments as requests.request, plus an optional
+    auth token that is turned into the Authorization header. The headers for
+    a token are built once and reused until the token changes.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, pool_maxsize=POOL_MAXSIZE):
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.http2_hosts = set()
+        self._sessions = {}
+        self._http2_clients = {}
+        self._lock = threading.Lock()
+        self._auth_token = None
+        self._auth_headers = {}
+        self.requests = {}
+
+    def configure(self, http2=False, http2_hosts=()):
+        """
+        Enables HTTP/2 for the given hosts if httpx with HTTP/2 support is installed.
+
+        Args:
+            http2 (bool): Whether to use HTTP/2.
+            http2_hosts (iterable): The hosts ("scheme://host[:port]") to use it for.
+
+        Returns:
+            bool: True if HTTP/2 is in use.
+        """
+        hosts = set(http2_hosts) if http2 and httpx is not None else set()
+        if hosts:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                hosts = set()
+        with self._lock:
+            self.http2_hosts = hosts
+        return bool(hosts)
+
+    @staticmethod
+    def host_key(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session(self, url):
+        """Returns the keep-alive session for the host of a URL"""
+        key = self.host_key(url)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_maxsize
+                )
+                session.mount(key, adapter)
+                self._sessions[key] = session
+            self.requests[key] = self.requests.get(key, 0) + 1
+        return session
+
+    def _http2_client(self, key):
+        with self._lock:
+            client = self._http2_clients.get(key)
+            if client is None:
+                client = httpx.Client(http2=True)
+                self._http2_clients[key] = client
+            self.requests[key] = self.requests.get(key, 0) + 1
+        return client
+
+    def auth_headers(self, token):
+        """
+        Returns the authentication headers for a token.
+
+        Returns:
+            dict: A copy of the headers, safe for the caller to add to.
+        """
+        if token != self._auth_token:
+            self._auth_headers = {"Authorization": token}
+            self._auth_token = token
+        return dict(self._auth_headers)
+
+    def request(
+        self,
+        method,
+        url,
+        token=None,
+        headers=None,
+        timeout=None,
+        breaker=None,
+        traffic=None,
+        **kwargs,
+    ):
+        """
+        Sends a request.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL.
+            token (str): Optional auth token for the Authorization header.
+            headers (dict): Extra headers.
+            timeout: Connect and read timeout, DEFAULT_TIMEOUT if not given.
+            breaker (str): Optional name of the circuit breaker guarding the endpoint.
+            traffic (str): Optional bandwidth traffic class of an upload with files.
+            **kwargs: Passed on to requests.
+
+        Returns:
+            requests.Response: The response.
+
+        Raises:
+            requests.exceptions.RequestException: If the request failed.
+            CircuitOpenError: If the endpoint's breaker is open.
+        """
+        if traffic is not None and kwargs.get("files") and bandwidth.limited("up"):
+            # send the multipart body ourselves so the governor can pace it
+            body = MultipartStream(
+                kwargs.pop("data", None), kwargs.pop("files"), traffic, bandwidth
+            )
+            headers = dict(headers or {})
+            headers["Content-Type"] = body.content_type
+            headers["Content-Length"] = str(len(body))
+            kwargs["data"] = body
+        if breaker is None:
+            return self._request(method, url, token, headers, timeout, **kwargs)
+        circuit = breakers.get(breaker)
+        circuit.check()
+        started = time.monotonic()
+        try:
+            resp = self._request(method, url, token, headers, timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            circuit.record(False, time.monotonic() - started, str(e))
+            raise
+        except BaseException:
+            circuit.record(True)  # not the endpoint's fault, just free the probe
+            raise
+        failed = resp.status_code >= 500 or resp.status_code in BREAKER_FAILURE_STATUS
+        circuit.record(
+            not failed,
+            time.monotonic() - started,
+            f"status code {resp.status_code}" if failed else None,
+        )
+        return resp
+
+    def _request(self, method, url, token, headers, timeout, **kwargs):
+        if token is not None:
+            merged = self.auth_headers(token)
+            merged.update(headers or {})
+            headers = merged
+        timeout = self.timeout if timeout is None else timeout
+        key = self.host_key(url)
+        if key in self.http2_hosts and not kwargs.get("stream"):
+            return self._request_http2(key, method, url, headers, timeout, **kwargs)
+        return self.session(url).request(
+            method, url, headers=headers, timeout=timeout, **kwargs
+        )
+
+    def _request_http2(self, key, method, url, headers, timeout, **kwargs):
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        data, content = kwargs.get("data"), None
+        if isinstance(data, MultipartStream):
+            data, content = None, data
+        try:
+            response = self._http2_client(key).request(
+                method,
+                url,
+                headers=headers,
+                timeout=timeout,
+                content=content,
+                data=data,
+                files=kwargs.get("files"),
+                json=kwargs.get("json"),
+                params=kwargs.get("params"),
+            )
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+        return Http2Response(response)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        """Closes every pooled connection"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            for client in self._http2_clients.values():
+                client.close()
+            self._sessions = {}
+            self._http2_clients = {}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hosts": len(self._sessions) + len(self._http2_clients),
+                "http2_hosts": sorted(self.http2_hosts),
+                "requests": dict(self.requests),
+            }
+
+
+# shared by the whole plugin so every caller benefits from the same pools
+http = HttpClient()
@@ -0,0 +1,204 @@
+'''
+This module holds the plugin's settings store. Readers take `config.current`,
+an immutable snapshot of every plugin setting converted to its type, instead
+of going through OctoPrint's settings on each read. The snapshot is rebuilt
+only when the settings change: when the user saves them, on OctoPrint's
+SettingsUpdated event, or when the plugin itself sets one.
+
+Settings the plugin sets take effect in memory straight away, while writing
+them to config.yaml is debounced, so a burst of changes from the request
+path costs one write to the SD card, made off that path.
+'''
+import threading
+from types import MappingProxyType
+
+SETTINGS_SAVE_DELAY = 2.0  # seconds a save is held back to coalesce further changes
+# settings whose default does not give their type
+SETTINGS_TYPES = {
+    "default_z_offset": float,
+    "nozzle_tip_coords_x": int,
+    "nozzle_tip_coords_y": int,
+}
+# settings without a default
+EXTRA_SETTINGS = ("webrtc_auth_key",)
+
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "yes", "on")
+    return bool(value)
+
+
+def to_number(value):
+    """Converts to int, or to float if the value has a fractional part"""
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+class SettingsSnapshot:
+    """Immutable, typed view of the plugin settings at one version"""
+
+    __slots__ = ("version", "_values")
+
+    def __init__(self, version=0, values=None):
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "_values", MappingProxyType(dict(values or {})))
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(f"no setting named {name}")
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def to_dict(self):
+        return dict(self._values)
+
+
+class DebouncedSaver:
+    """
+    Coalesces save requests: the first request arms a timer and every request
+    made before it fires is covered by the same save.
+    """
+
+    def __init__(self, save, logger=None, delay=SETTINGS_SAVE_DELAY):
+        self._save = save
+        self._logger = logger
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._timer = None
+        self.requests = 0
+        self.saves = 0
+
+    def request(self):
+        with self._lock:
+            self.requests += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self._fire)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _fire(self):
+        with self._lock:
+            if self._timer is None:
+                return  # flushed in the meantime
+            self._timer = None
+        self._run()
+
+    def _run(self):
+        try:
+            self._save()
+            self.saves += 1
+        except Exception as e:
+            if self._logger:
+                self._logger.error(f"Failed to save settings: {e}")
+
+    def flush(self):
+        """Saves straight away if a save is pending, e.g. on shutdown"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+            self._run()
+
+
+class SettingsStore:
+    """Holds the current settings snapshot and applies the plugin's own changes"""
+
+    def __init__(self):
+        self._settings = None
+        self._logger = None
+        self._types = {}
+        self._defaults = {}
+        self._lock = threading.Lock()
+        self._saver = None
+        self.current = SettingsSnapshot()
+        self.listeners = []
+
+    def configure(self, settings, defaults, logger=None):
+        """
+        Args:
+            settings: The plugin's OctoPrint settings.
+            defaults (dict): The plugin's settings defaults, which give each setting its type.
+            logger: The plugin logger.
+        """
+        self._settings = settings
+        self._logger = logger
+        self._types = {
+            key: SETTINGS_TYPES.get(key, type(default) if default is not None else None)
+            for key, default in defaults.items()
+        }
+        for key in EXTRA_SETTINGS:
+            self._types.setdefault(key, None)
+        self._defaults = dict(defaults)
+        self._saver = DebouncedSaver(settings.save, logger)
+        self.refresh()
+
+    def add_listener(self, listener):
+        """Registers listener(snapshot) to be called with the new snapshot after every refresh"""
+        self.listeners.append(listener)
+
+    def _convert(self, key, value):
+        kind = self._types.get(key)
+        if value is None or kind is None or kind is str:
+            return value
+        try:
+            if kind is bool:
+                return to_bool(value)
+            return to_number(value) if kind is int else kind(value)
+        except (TypeError, ValueError):
+            if self._logger:
+                self._logger.warning(f"Invalid value {value!r} for setting {key}, using the default.")
+            return self._convert(key, self._defaults.get(key))
+
+    def refresh(self):
+        """Rebuilds the snapshot from OctoPrint's settings"""
+        with self._lock:
+            values = {
+                key: self._convert(key, self._settings.get([key])) for key in self._types
+            }
+            self.current = SettingsSnapshot(self.current.version + 1, values)
+            snapshot = self.current
+        for listener in self.listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                if self._logger:
+                    self._logger.error(f"Failed to apply the new settings: {e}")
+        return snapshot
+
+    def set(self, key, value):
+        """
+        Changes a setting. It applies at once and is written to disk shortly after.
+
+        Args:
+            key (str): The setting.
+            value: The new value.
+        """
+        self._settings.set([key], value, force=True)
+        self.refresh()
+        self._saver.request()
+
+    def flush(self):
+        """Writes pending changes to disk"""
+        if self._saver is not None:
+            self._saver.flush()
+
+    def stats(self):
+        return {
+            "version": self.current.version,
+            "save_requests": self._saver.requests if self._saver else 0,
+            "saves": self._saver.saves if self._saver else 0,
+        }
+
+
+# shared by the whole plugin, so every reader sees the same snapshot
+config = SettingsStore()
@@ -1,23 +1,73 @@
-import re
 import time
+import queue
 import threading
 import requests
-import csv
 import json
-import io
-from cachetools import TTLCache
+import gzip
+from collections import deque
 from .utils import (
     get_api_url,
     get_gcode_upload_dir,
     make_timestamp,
-    generate_auth_headers,
     SAMPLING_TIMEOUT,
     MATTA_TMP_DATA_DIR,
 )
 import os
 import shutil
-from PIL import Image
+from octoprint.events import Events
 from .printer import MattaPrinter
+from .worker import PRIORITY_PRINT_NOW
+from .telemetry import TelemetryWriter
+from .timing import DeadlineScheduler
+from .policy import SamplingPolicy
+from .layers import LayerAggregator
+from .offload import OffloadPool, FrameDecodeError
+from .governor import resources
+from .config import config
+from .client import http
+from .breaker import breakers, CircuitOpenError
+from .metrics import metrics, record_upload, SIZE_BUCKETS, SEND_BUCKETS
+
+CAMERA_FRAME_BYTES = metrics.histogram(
+    "matta_frame_bytes", "Size of the frames", {"stage": "camera"}, SIZE_BUCKETS
+)
+UPLOAD_FRAME_BYTES = metrics.histogram(
+    "matta_frame_bytes", "Size of the frames", {"stage": "upload"}, SIZE_BUCKETS
+)
+FRAME_TRANSFORM_TIME = metrics.histogram(
+    "matta_frame_transform_seconds", "Time taken to transform and encode a frame", buckets=SEND_BUCKETS
+)
+
+# the running job's identity and progress, so a restart can pick it up again
+ACTIVE_JOB_PATH = os.path.join(MATTA_TMP_DATA_DIR, "active_job.json")
+LIVE_UPLOAD_ENDPOINT = "print-jobs/remote/live-upload"
+
+# How a print ended, by the OctoPrint event that ends it
+JOB_END_REASONS = {
+    Events.PRINT_DONE: "done",
+    Events.PRINT_FAILED: "failed",
+    Events.PRINT_CANCELLED: "cancelled",
+}
+
+# Typed columns of the print log, in CSV column order
+TELEMETRY_COLUMNS = [
+    ("count", "i"),
+    ("timestamp", "s"),
+    ("flow_rate", "i"),
+    ("feed_rate", "i"),
+    ("z_offset", "f"),
+    ("target_hotend", "f"),
+    ("hotend", "f"),
+    ("target_bed", "f"),
+    ("bed", "f"),
+    ("gcode_line_num_no_comments", "i"),
+    ("gcode_cmd", "s"),
+    ("nozzle_tip_coords_x", "i"),
+    ("nozzle_tip_coords_y", "i"),
+    ("flip_h", "b"),
+    ("flip_v", "b"),
+    ("rotate", "b"),
+]
 
 class DataEngine:
     def __init__(
@@ -25,20 +75,45 @@ class DataEngine:
         matta_printer: MattaPrinter,
         settings,
         logger,
+        outbox,
     ):
         self._printer = matta_printer
         self._settings = settings
         self._logger = logger
+        self.outbox = outbox
         self.image_count = 0
         self.gcode_path = None
-        self.csv_print_log = None
-        self.csv_writer = None
+        self.telemetry = None
         self.csv_path = None
         self.first_layer_end_line = None
+        self.first_layer_end_row = None
         self.first_layer_csv_uploaded = False
-        self.upload_attempts = 0
-        self.bad_url_cache = TTLCache(maxsize=100, ttl=120)
-        self.unsuccessful_image_count = 0
+        self.telemetry_stats = None
+        self.live_upload_offset = 0
+        self.last_live_upload = 0.0
+        self.live_upload_stopped = False
+        # (job, offset) of live chunks the backend rejected, from the outbox workers
+        self.rejected_live_uploads = deque()
+        self.outbox.add_listener(self.on_outbox_dead)
+        self.start_job_queued = threading.Event()
+        self.start_job_queued.set()
+        self.active_job = {}
+        self.job_events = queue.Queue()
+        metrics.gauge(
+            "matta_job_events_depth", "Print events waiting for the data thread", fn=self.job_events.qsize
+        )
+        self.sampling = False
+        self.job_event_time = None
+        self.first_sample_latency = None
+        self.sampling_policy = SamplingPolicy()
+        self.layers = LayerAggregator()
+        self.offload = OffloadPool(config.current.offload_workers, self._logger)
+        self.frame_schedule = DeadlineScheduler(
+            SAMPLING_TIMEOUT, wakeup=self._printer.layer_trigger.event
+        )
+        self.telemetry_schedule = DeadlineScheduler(
+            SAMPLING_TIMEOUT, wakeup=self._printer.layer_trigger.event
+        )
         self.start_data_thread()
 
     def start_data_thread(self):
@@ -68,7 +143,7 @@ class DataEngine:
         """
         data_path = self.get_job_dir()
         try:
-            os.makedirs(data_path)
+            os.makedirs(data_path, exist_ok=True)
             self._logger.debug(f"Successfully created job directory at {data_path}")
         except OSError as e:
             self._logger.error(
@@ -81,315 +156,629 @@ class DataEngine:
         """
         Reset the job-related data after a print job.
         """
-        self.csv_print_log = None
-        self.csv_writer = None
+        self.telemetry = None
+        self.live_upload_offset = 0
+        self.live_upload_stopped = False
         self.first_layer_csv_uploaded = False
         self.first_layer_end_line = None
+        self.first_layer_end_row = None
         try:
             shutil.rmtree(self.get_job_dir())
         except OSError as e:
             pass
         except TypeError as e:
             pass
+        self.active_job = {}
+        try:
+            os.remove(ACTIVE_JOB_PATH)
+        except OSError:
+            pass
         self.csv_path = None
-        self._printer.new_print_job = True
         self._printer.current_job = None
         self.gcode_path = None
         self.image_count = 0
-        self._printer.gcode_line_num_no_comments = None
-        self._printer.gcode_cmd = None
+        self._printer.gcode_position = (None, None)
+        self._printer.layer_trigger.reset()
+        self._printer.gcode_trace.path = None
 
-    def create_metadata(self):
-        temps = self._printer.get_data()["temperature_data"]
+    def create_metadata(self, snapshot, trigger="timer"):
+        """Builds the frame metadata from the snapshot of the current tick."""
         metadata = {
-            "count": self.image_count,
-            "timestamp": make_timestamp(),
-            "flow_rate": self._printer.flow_rate,
-            "feed_rate": self._printer.feed_rate,
-            "z_offset": self._printer.z_offset,
-            "hotend_target": temps["tool0"]["target"],
-            "hotend_actual": temps["tool0"]["actual"],
-            "bed_target": temps["bed"]["target"],
-            "bed_actual": temps["bed"]["actual"],
-            "gcode_line_num": self._printer.gcode_line_num_no_comments,
-            "gcode_cmd": self._printer.gcode_cmd,
-            "nozzle_tip_coords_x": int(self._settings.get(["nozzle_tip_coords_x"])),
-            "nozzle_tip_coords_y": int(self._settings.get(["nozzle_tip_coords_y"])),
-            "flip_h": self._settings.get(["flip_h"]),
-            "flip_v": self._settings.get(["flip_v"]),
-            "rotate": self._settings.get(["rotate"]),
-            "printer_state": self._printer.get_data()["state"],
+            "count": snapshot.count,
+            "capture_trigger": trigger,
+            "layer": snapshot.layer,
+            "timestamp": snapshot.timestamp,
+            "flow_rate": snapshot.flow_rate,
+            "feed_rate": snapshot.feed_rate,
+            "z_offset": snapshot.z_offset,
+            "hotend_target": snapshot.hotend_target,
+            "hotend_actual": snapshot.hotend_actual,
+            "bed_target": snapshot.bed_target,
+            "bed_actual": snapshot.bed_actual,
+            "gcode_line_num": snapshot.gcode_line_num,
+            "gcode_cmd": snapshot.gcode_cmd,
+            "nozzle_tip_coords_x": snapshot.nozzle_tip_coords_x,
+            "nozzle_tip_coords_y": snapshot.nozzle_tip_coords_y,
+            "flip_h": snapshot.flip_h,
+            "flip_v": snapshot.flip_v,
+            "rotate": snapshot.rotate,
+            "printer_state": snapshot.state,
         }
         return metadata
 
     def gcode_upload(self, job_name, gcode_path):
         """
-        Uploads G-code files to the specified base URL.
+        Queues the G-code file of a new job for upload to the server.
+
+        Hashing the file into the G-code cache reads all of it, so that and
+        queuing the upload run as a file job rather than on the data thread.
+        The start-job upload's place in the outbox is reserved first, so the
+        job's later uploads, end-job included, are sent after it.
+
+        Args:
+            job_name (str): The name of the print job.
+            gcode_path (str): The path to the G-code file.
+        """
+        queued = self.start_job_queued = threading.Event()
+        seq = self.outbox.reserve(job_name)
+
+        def on_finish(job):
+            # also when the job was cancelled before it ran
+            self.outbox.release(job_name, seq)
+            queued.set()
+
+        self._printer.file_jobs.submit(
+            "cache",
+            self.queue_start_job,
+            job_name,
+            gcode_path,
+            make_timestamp(),
+            queued,
+            seq,
+            priority=PRIORITY_PRINT_NOW,
+            description=os.path.basename(gcode_path),
+            on_finish=on_finish,
+        )
+        # get first layer end line
+        self.find_first_layer_end_line(gcode_path)
+
+    def queue_start_job(self, job, job_name, gcode_path, start_time, queued, seq):
+        """
+        Adds the G-code file to the cache and queues the start-job upload. Runs as a file job.
 
         Args:
-            files (dict): A dictionary containing the files to upload.
-            headers (dict): Additional headers to include in the request.
+            job (FileJob): The file job.
+            job_name (str): The name of the print job.
+            gcode_path (str): The path to the G-code file.
+            start_time (str): When the print started.
+            queued (threading.Event): Set once this is done, whether or not it succeeded.
+            seq (int): The place reserved for the upload in the outbox.
 
         Raises:
-            requests.exceptions.RequestException: If an error occurs during the upload.
+            OSError: If the upload could not be written to the outbox.
         """
-        self._logger.debug("Posting gcode")
-        with open(gcode_path, "rb") as gcode:
+        try:
+            self._logger.debug("Posting gcode")
+            gcode_hash = self.cache_gcode(gcode_path)
             gcode_name = os.path.basename(gcode_path)
             metadata = {
                 "name": os.path.splitext(gcode_name)[0],
                 "long_name": job_name,
                 "gcode_file": gcode_name,
-                "start_time": make_timestamp(),
+                "gcode_hash": gcode_hash,
+                "start_time": start_time,
             }
             data = {"data": json.dumps(metadata)}
             files = {
-                "gcode_obj": (job_name, gcode, "text/plain"),
+                "gcode_obj": (job_name, gcode_path, "text/plain"),
             }
-            full_url = get_api_url() + "print-jobs/remote/start-job"
-            headers = generate_auth_headers(self._settings.get(["auth_token"]))
-            try:
-                resp = requests.post(
-                    url=full_url,
-                    data=data,
-                    files=files,
-                    headers=headers,
-                )
-                resp.raise_for_status()
-            except requests.exceptions.RequestException as e:
-                self._logger.error(e)
-        # get first layer end line
-        self.find_first_layer_end_line(gcode_path)
+            self.outbox.enqueue("print-jobs/remote/start-job", data, job_name, files, seq=seq)
+            if self.active_job.get("name") == job_name:
+                self.save_active_job(start_job_queued=True)
+        finally:
+            queued.set()
 
-    def image_upload(self, image):
+    def cache_gcode(self, gcode_path):
         """
-        Uploads image files to the specified base URL.
+        Adds the G-code of the current job to the local G-code cache, so that
+        a reprint sent from the cloud can skip the download.
 
         Args:
-            files (dict): A dictionary containing the files to upload.
-            headers (dict): Additional headers to include in the request.
+            gcode_path (str): The path to the G-code file.
 
-        Raises:
-            requests.exceptions.RequestException: If an error occurs during the upload.
+        Returns:
+            str: The hash of the G-code file, or None if it could not be cached.
         """
-        self._logger.debug("Posting image")
-        image_name = f"image_{self.image_count}.png"
+        try:
+            return self._printer.gcode_cache.put_file(gcode_path)
+        except Exception as e:
+            self._logger.error(f"Failed to cache G-code file: {e}")
+            return None
 
-        # Load the image using PIL
-        pil_image = Image.open(io.BytesIO(image))
+    def image_upload(self, image, snapshot, trigger="timer"):
+        """
+        Uploads image files to the specified base URL.
 
-        # Flip the image if necessary
-        if self._settings.get(["flip_h"]):
-            pil_image = pil_image.transpose(Image.FLIP_LEFT_RIGHT)
-        if self._settings.get(["flip_v"]):
-            pil_image = pil_image.transpose(Image.FLIP_TOP_BOTTOM)
-        if self._settings.get(["rotate"]):
-            pil_image = pil_image.transpose(Image.ROTATE_90)
+        Args:
+            image (bytes): The captured image.
+            snapshot (TelemetrySnapshot): The snapshot of the tick the image belongs to.
+            trigger (str): What caused the capture, "timer" or "layer".
 
-        # Convert the PIL image back to bytes
-        byte_arr = io.BytesIO()
-        pil_image.save(byte_arr, format="PNG")
-        image = byte_arr.getvalue()
+        Returns:
+            int: The bytes sent, 0 if the upload was not attempted.
+        """
+        self._logger.debug("Posting image")
+        image_name = f"image_{snapshot.count}.png"
+
+        CAMERA_FRAME_BYTES.observe(len(image))
+        started = time.perf_counter()
+        image = self.offload.transform_frame(
+            image,
+            snapshot.flip_h,
+            snapshot.flip_v,
+            snapshot.rotate,
+            resources.frame_scale(),
+        )
+        FRAME_TRANSFORM_TIME.observe(time.perf_counter() - started)
+        UPLOAD_FRAME_BYTES.observe(len(image))
 
         metadata = {
             "name": image_name,
             "img_file": image_name,
         }
-        metadata.update(self.create_metadata())
+        metadata.update(self.create_metadata(snapshot, trigger))
         data = {"data": json.dumps(metadata)}
         files = {
             "image_obj": (image_name, image, "image/png"),
         }
+        # what goes over the wire is the PNG, often several times the camera's JPEG
+        sent_bytes = len(image) + len(data["data"])
         full_url = get_api_url() + "images/print/predict/new-image"
-        headers = generate_auth_headers(self._settings.get(["auth_token"]))
+        started = time.perf_counter()
         try:
-            resp = requests.post(
-                url=full_url,
+            resp = http.post(
+                full_url,
                 data=data,
                 files=files,
-                headers=headers,
+                token=config.current.auth_token,
                 timeout=5,
+                breaker="new-image",
+                traffic="frames",
             )
             resp.raise_for_status()
+            record_upload("new-image", time.perf_counter() - started, True)
+        except CircuitOpenError as e:
+            self._logger.debug(e)
+            return 0
         except requests.exceptions.RequestException as e:
+            record_upload("new-image", time.perf_counter() - started, False)
             self._logger.info(e)
+        return sent_bytes
 
-    def first_layer_upload(self, job_name, gcode_path, csv_path, first_layer_csv_path):
+    def first_layer_upload(self, job_name, gcode_path, first_layer_csv_path):
         """
-        Sends the first layer csv to the server for analysis.
+        Queues the first layer csv for upload to the server for analysis.
 
         Args:
             job_name (str): The name of the print job.
             gcode_path (str): The path to the G-code file.
-            csv_path (str): The path to the CSV file.
-        
+            first_layer_csv_path (str): The path to the first layer CSV file.
+
         Raises:
-            requests.exceptions.RequestException: If an error occurs during the upload.
+            OSError: If the upload could not be written to the outbox.
 
         """
-        self._logger.debug(csv_path)
-        with open(csv_path, "rb") as csv:
-            gcode_name = os.path.basename(gcode_path)
-            csv_name = os.path.basename(first_layer_csv_path)
-            metadata = {
-                "name": os.path.splitext(gcode_name)[0],
-                "long_name": job_name,
-                "first_layer_csv_file": csv_name,
-            }
-            data = {"data": json.dumps(metadata)}
-            files = {
-                "csv_obj": (first_layer_csv_path, csv, "text/csv"),
-            }
-            full_url = get_api_url() + "print-jobs/remote/first-layer-upload"
-            headers = generate_auth_headers(self._settings.get(["auth_token"]))
-            retries = 3
-            decay = 2  # decay factor for wait time between retries
-
-            for i in range(retries):
-                try:
-                    resp = requests.post(
-                        url=full_url,
-                        data=data,
-                        files=files,
-                        headers=headers,
-                    )
-                    resp.raise_for_status()
-                    break  # if the request is successful, we break the loop
-                except requests.exceptions.RequestException as e:
-                    if i < retries - 1:  # no need to wait after the last try
-                        time.sleep(decay ** i)  # wait time increases with each retry
-                    else:
-                        self._logger.error(e)
-                        raise e
+        self._logger.debug(first_layer_csv_path)
+        gcode_name = os.path.basename(gcode_path)
+        csv_name = os.path.basename(first_layer_csv_path)
+        metadata = {
+            "name": os.path.splitext(gcode_name)[0],
+            "long_name": job_name,
+            "first_layer_csv_file": csv_name,
+        }
+        data = {"data": json.dumps(metadata)}
+        files = {
+            "csv_obj": (first_layer_csv_path, first_layer_csv_path, "text/csv"),
+        }
+        self.outbox.enqueue("print-jobs/remote/first-layer-upload", data, job_name, files)
 
-    def finished_upload(self, job_name, gcode_path, csv_path):
+    def live_upload_chunk(self, job_name):
         """
-        Notifies the server that the print job has finished.
+        Queues the telemetry rows added since the last queued offset for upload,
+        gzip-compressed. The offset only moves on once the chunk is safely in the
+        outbox, which then delivers it in order with the other job uploads.
 
         Args:
             job_name (str): The name of the print job.
 
         Raises:
-            requests.exceptions.RequestException: If an error occurs during the upload.
+            OSError: If the chunk could not be written to the outbox.
+        """
+        offset = self.live_upload_offset
+        chunk, row_count = self.telemetry.csv_chunk(start=offset)
+        if row_count == 0:
+            return
+        metadata = {
+            "long_name": job_name,
+            "offset": offset,
+            "rows": row_count,
+            "encoding": "gzip",
+        }
+        data = {"data": json.dumps(metadata)}
+        files = {
+            "csv_obj": (f"print_log_{offset}.csv.gz", gzip.compress(chunk), "application/gzip"),
+        }
+        self.outbox.enqueue(LIVE_UPLOAD_ENDPOINT, data, job_name, files)
+        self.live_upload_offset = offset + row_count
+        self.save_live_upload_offset()
+
+    def on_outbox_dead(self, entry):
+        """Notes a live chunk the outbox gave up on, for the data thread to act on"""
+        if entry["endpoint"] == LIVE_UPLOAD_ENDPOINT:
+            self.rejected_live_uploads.append(
+                (entry["group"], json.loads(entry["data"]["data"])["offset"])
+            )
+
+    def take_rejected_live_uploads(self, job_name):
+        """Returns the offsets of the job's live chunks the outbox gave up on since the last call"""
+        offsets = []
+        while self.rejected_live_uploads:
+            group, offset = self.rejected_live_uploads.popleft()
+            if group == job_name:
+                offsets.append(offset)
+        return offsets
+
+    def withdraw_live_uploads(self, job_name, offsets=()):
+        """
+        Takes the job's live chunks that are not delivered yet back out of the
+        outbox and rolls the offset back to the first of them, so their rows go
+        with the end-job upload instead and cannot hold it up.
+
+        Args:
+            job_name (str): The name of the print job.
+            offsets (list): Offsets of chunks already given up on.
+        """
+        offsets = list(offsets) + [
+            json.loads(entry["data"]["data"])["offset"]
+            for entry in self.outbox.withdraw(job_name, LIVE_UPLOAD_ENDPOINT)
+        ]
+        if offsets and min(offsets) < self.live_upload_offset:
+            self.live_upload_offset = min(offsets)
+            self.save_live_upload_offset()
+
+    def live_upload_offset_path(self):
+        return os.path.join(self.get_job_dir(), "live_upload_offset")
+
+    def save_live_upload_offset(self):
+        with open(self.live_upload_offset_path(), "w") as file:
+            file.write(str(self.live_upload_offset))
+
+    def load_live_upload_offset(self):
+        """
+        Resumes live uploads of a job picked up again after a restart from the
+        first row not yet queued. Rows already queued are left to the outbox,
+        which delivers them on its own unless the job ends first.
+        """
+        try:
+            with open(self.live_upload_offset_path(), "r") as file:
+                self.live_upload_offset = int(file.read().strip() or 0)
+        except (OSError, ValueError):
+            self.live_upload_offset = 0
+
+    def update_live_upload(self, now):
+        """Sends a live telemetry chunk if live uploads are on and the interval has passed"""
+        job_name = self._printer.current_job
+        rejected = self.take_rejected_live_uploads(job_name)
+        if rejected and not self.live_upload_stopped:
+            self._logger.warning("Backend rejected a live upload, stopping live uploads for this job.")
+            self.live_upload_stopped = True
+            self.withdraw_live_uploads(job_name, rejected)
+        if not config.current.live_upload or self.telemetry is None or self.live_upload_stopped:
+            return
+        if not self.start_job_queued.is_set():
+            return
+        if now - self.last_live_upload < config.current.live_upload_interval:
+            return
+        self.last_live_upload = now
+        try:
+            self.live_upload_chunk(job_name)
+        except Exception as e:
+            self._logger.info(f"Live upload failed, will retry: {e}")
+
+    def finished_upload(self, job_name, gcode_path, csv_path, reason="done"):
+        """
+        Queues the notification that the print job has finished, with the
+        remaining print log, for upload to the server.
+
+        Args:
+            job_name (str): The name of the print job.
+            gcode_path (str): The path to the G-code file.
+            csv_path (str): The path to the CSV file.
+            reason (str): How the print ended, "done", "failed" or "cancelled".
+
+        Raises:
+            OSError: If the upload could not be written to the outbox.
         """
         self._logger.debug(csv_path)
-        with open(csv_path, "rb") as csv:
-            gcode_name = os.path.basename(gcode_path)
-            csv_name = os.path.basename(csv_path)
-            metadata = {
-                "name": os.path.splitext(gcode_name)[0],
-                "long_name": job_name,
-                "csv_file": csv_name,
-                "end_time": make_timestamp(),
-            }
-            data = {"data": json.dumps(metadata)}
-            files = {
-                "csv_obj": (csv_name, csv, "text/csv"),
-            }
-            full_url = get_api_url() + "print-jobs/remote/end-job"
-            headers = generate_auth_headers(self._settings.get(["auth_token"]))
-            import time
-
-            retries = 3
-            decay = 2  # decay factor for wait time between retries
-
-            for i in range(retries):
-                try:
-                    resp = requests.post(
-                        url=full_url,
-                        data=data,
-                        files=files,
-                        headers=headers,
-                    )
-                    resp.raise_for_status()
-                    break  # if the request is successful, we break the loop
-                except requests.exceptions.RequestException as e:
-                    if i < retries - 1:  # no need to wait after the last try
-                        time.sleep(decay ** i)  # wait time increases with each retry
-                    else:
-                        self._logger.error(e)
-                        raise e
+        gcode_name = os.path.basename(gcode_path)
+        csv_name = os.path.basename(csv_path)
+        metadata = {
+            "name": os.path.splitext(gcode_name)[0],
+            "long_name": job_name,
+            "csv_file": csv_name,
+            "csv_offset": self.live_upload_offset,
+            "end_time": make_timestamp(),
+            "end_reason": reason,
+            "telemetry_stats": self.telemetry_stats,
+        }
+        data = {"data": json.dumps(metadata)}
+        files = {
+            "csv_obj": (csv_name, csv_path, "text/csv"),
+        }
+        layers_path = os.path.join(os.path.dirname(csv_path), "layers.jsonl")
+        if os.path.exists(layers_path):
+            files["layers_obj"] = ("layers.jsonl", layers_path, "application/x-ndjson")
+        trace_path = self._printer.gcode_trace.path
+        if trace_path is not None and os.path.exists(trace_path):
+            files["trace_obj"] = (
+                os.path.basename(trace_path),
+                trace_path,
+                "application/octet-stream",
+            )
+        self.outbox.enqueue("print-jobs/remote/end-job", data, job_name, files)
 
-    def is_new_job(self):
+    def on_print_event(self, event, payload):
         """
-        Checks if a new print job has started and performs necessary setup tasks.
+        Queues a print lifecycle event from OctoPrint's event bus for the data
+        thread, so job setup and teardown never block event dispatch.
 
-        Returns:
-            bool: True if a new job has started, False otherwise.
-        """
-        if self._printer.has_job():
-            # self._logger.debug(f"Has job: {self._printer.current_job}")
-            if self._printer.new_print_job:
-                self._logger.debug("New job.")
-                self._printer.new_print_job = False
-                self._printer.current_job = self._printer.make_job_name()
-                self._logger.debug(f"New job: {self._printer.current_job}")
-                try:
-                    self.setup_print_log()
-                    self.gcode_upload(self._printer.current_job, self.gcode_path)
-                except Exception as e:
-                    self._logger.error(
-                        f"Failed to set up data collection for print job: {e}"
-                    )
-            return True
-
-        elif self._printer.is_operational():
-            if self._printer.just_finished():
-                self._logger.debug("Just finished a print job.")
-                try:
-                    self.cleanup_print_log()
-                    self._logger.debug("Print log cleaned up.")
-                    self.finished_upload(
-                        self._printer.current_job, self.gcode_path, self.csv_path
-                    )
-                    self._logger.debug("Posted!")
-                    self.finished = True
-                    self._printer.finished = True
-                except Exception as e:
-                    self._logger.error(f"Failed to finish print job: {e}")
-                    self.upload_attempts += 1
-                    if self.upload_attempts > 3:
-                        self.reset_job_data()
-                        self.upload_attempts = 0
-                        self.finished = True
-                        self._printer.finished = True
-
-            self.reset_job_data()
-        return False
-
-    def setup_print_log(self):
+        Args:
+            event (str): The OctoPrint event name.
+            payload (dict): The event payload.
+        """
+        self.job_events.put((event, payload or {}, time.perf_counter()))
+        self._printer.layer_trigger.event.set()  # wake the data thread
+
+    def resume_running_job(self):
+        """
+        Starts sampling a print that was already running when the plugin loaded.
+        If it is the job sampled before the restart, that job is carried on.
+        """
+        if not self._printer.has_job():
+            return
+        job = self._printer.get_current_job()["file"]
+        self._logger.info(f"Resuming data collection for running print {job['name']}.")
+        self.on_print_event(
+            Events.PRINT_STARTED,
+            {
+                "name": job["name"],
+                "path": job["path"],
+                "origin": job.get("origin"),
+                "resumed": True,
+            },
+        )
+
+    @staticmethod
+    def job_key(payload):
+        """Identifies a print by its file, which unlike the job name survives a restart"""
+        return f"{payload.get('origin')}:{payload.get('path')}"
+
+    def load_active_job(self, payload):
+        """
+        Returns the record of the job sampled before a restart if the running
+        print is that job and its directory is still there, None otherwise.
+        """
+        try:
+            with open(ACTIVE_JOB_PATH, "r") as file:
+                record = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if record.get("key") != self.job_key(payload):
+            return None
+        job_dir = os.path.join(MATTA_TMP_DATA_DIR, record["name"].replace(":", "-"))
+        return record if os.path.isdir(job_dir) else None
+
+    def save_active_job(self, **changes):
+        """Records the running job's identity and progress, see ACTIVE_JOB_PATH"""
+        self.active_job.update(changes)
+        try:
+            tmp_path = ACTIVE_JOB_PATH + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(self.active_job, file)
+            os.replace(tmp_path, ACTIVE_JOB_PATH)
+        except OSError as e:
+            self._logger.error(f"Failed to save the running job: {e}")
+
+    def process_job_events(self):
+        """Applies queued print lifecycle events on the data thread"""
+        while True:
+            try:
+                event, payload, event_time = self.job_events.get_nowait()
+            except queue.Empty:
+                return
+            if event == Events.PRINT_STARTED:
+                if self.sampling:
+                    self._logger.info("Print started before the last one ended, ending it.")
+                    self.end_job("failed")
+                self.start_job(payload, event_time)
+            elif event in JOB_END_REASONS and self.sampling:
+                # close the layers the print got through before it ended
+                self.process_layer_changes()
+                self.end_job(JOB_END_REASONS[event])
+
+    def process_layer_changes(self):
+        """Opens and closes layer records for the layer changes the layer trigger saw"""
+        for layer, z, started_at in self._printer.layer_trigger.pop_changes():
+            try:
+                record = self.layers.on_layer_change(layer, z, started_at)
+            except OSError as e:
+                self._logger.error(f"Failed to write layer summary: {e}")
+                continue
+            if record is not None:
+                self._logger.debug(f"Layer {record['layer']} done in {record['duration']}s")
+
+    def start_job(self, payload, event_time):
+        """
+        Sets up data collection for a print that has just started, or carries
+        on with the job sampled before a restart.
+
+        Args:
+            payload (dict): The PrintStarted event payload, with "resumed" set
+                when the print was already running when the plugin loaded.
+            event_time (float): When the event was received, from time.perf_counter.
+        """
+        resumed = self.load_active_job(payload) if payload.get("resumed") else None
+        if resumed is not None:
+            self._printer.current_job = resumed["name"]
+            self.active_job = resumed
+            self._logger.info(f"Carrying on with job {resumed['name']}.")
+        else:
+            self._printer.current_job = self._printer.make_job_name(payload.get("name"))
+            self.active_job = {"key": self.job_key(payload), "name": self._printer.current_job}
+            self.save_active_job()
+        self._logger.debug(f"New job: {self._printer.current_job}")
+        self.job_event_time = event_time
+        self.first_sample_latency = None
+        self.sampling = True
+        self.sampling_policy.reset()
+        self.frame_schedule.reset()
+        self.telemetry_schedule.reset()
+        try:
+            self.setup_print_log(payload["path"], resume=resumed is not None)
+            if resumed is not None and resumed.get("start_job_queued"):
+                # start-job is already in the outbox, which survived the restart
+                self.start_job_queued = threading.Event()
+                self.start_job_queued.set()
+                self.first_layer_csv_uploaded = resumed.get("first_layer_uploaded", False)
+                self.find_first_layer_end_line(self.gcode_path)
+            else:
+                self.gcode_upload(self._printer.current_job, self.gcode_path)
+        except Exception as e:
+            self._logger.error(f"Failed to set up data collection for print job: {e}")
+
+    def end_job(self, reason):
+        """
+        Finishes data collection for the current print and queues the end-job upload.
+
+        Args:
+            reason (str): How the print ended, "done", "failed" or "cancelled".
+        """
+        self._logger.debug(f"Print job ended: {reason}.")
+        self.sampling = False
+        try:
+            self.cleanup_print_log()
+            self._logger.debug("Print log cleaned up.")
+            # the outbox holds end-job back until start-job is queued ahead of it
+            self.finished_upload(
+                self._printer.current_job, self.gcode_path, self.csv_path, reason
+            )
+            self._logger.debug("End-job upload queued.")
+        except Exception as e:
+            self._logger.error(f"Failed to finish print job: {e}")
+        self.reset_job_data()
+
+    def record_first_sample(self, sample_time):
+        """Measures the latency from the PrintStarted event to the first sample"""
+        if self.first_sample_latency is None and self.job_event_time is not None:
+            self.first_sample_latency = sample_time - self.job_event_time
+            self._logger.info(
+                f"First sample {self.first_sample_latency * 1000:.1f}ms after print start."
+            )
+
+    def lifecycle_stats(self):
+        return {
+            "cadence": {
+                "frames": self.frame_schedule.stats(),
+                "telemetry": self.telemetry_schedule.stats(),
+            },
+            "sampling_policy": self.sampling_policy.stats(),
+            "layers": self.layers.stats(),
+            "offload": self.offload.stats(),
+            "sampling": self.sampling,
+            "job": self._printer.current_job,
+            "first_sample_latency_ms": (
+                None
+                if self.first_sample_latency is None
+                else round(self.first_sample_latency * 1000, 1)
+            ),
+        }
+
+    def setup_print_log(self, gcode_file_path, resume=False):
         """
         Set up the print log file and start the image thread.
+
+        Args:
+            gcode_file_path (str): The path of the printed file within the uploads directory.
+            resume (bool): Carry on with the print log of a job picked up after a restart.
         """
         job_dir = self.create_job_dir()
         self.csv_path = os.path.join(job_dir, "print_log.csv")
+        self.telemetry_path = os.path.join(job_dir, "print_log.mtf")
         self.first_layer_csv_path = os.path.join(job_dir, "first_layer.csv")
+        self.layers.start(os.path.join(job_dir, "layers.jsonl"))
         self.gcode_path = os.path.join(
             get_gcode_upload_dir(),
-            self._printer.get_current_job()["file"]["path"],
+            gcode_file_path,
         )
         self._logger.debug("G-code file copied.")
+        self.telemetry_stats = None
+        self.load_live_upload_offset()
+        self.last_live_upload = time.perf_counter()
         try:
-            self.csv_print_log = open(self.csv_path, "w")
-            self.csv_writer = csv.writer(self.csv_print_log, delimiter=",")
-            self.csv_writer.writerow(self.csv_headers())
-            self.csv_print_log.flush()
+            self.telemetry = TelemetryWriter(
+                self.telemetry_path,
+                TELEMETRY_COLUMNS,
+                commit_rows=config.current.telemetry_commit_rows,
+                commit_interval=config.current.telemetry_commit_interval,
+                resume=resume,
+            )
+            if self.telemetry.resumed_rows:
+                self._logger.info(f"Print log resumed after {self.telemetry.resumed_rows} rows.")
         except IOError as e:
             self._logger.error(f"Failed to open print log file: {e}")
-            self.csv_print_log = None
-            self.csv_writer = None
+            self.telemetry = None
+        if config.current.gcode_trace:
+            self._printer.gcode_trace.start(os.path.join(job_dir, "gcode_trace.bin"))
+        self._printer.layer_trigger.configure(
+            config.current.layer_capture,
+            config.current.layer_capture_interval,
+            config.current.layer_capture_min_interval,
+        )
+        self.sampling_policy.configure(
+            config.current.adaptive_sampling,
+            config.current.sampling_frame_kbps,
+            config.current.sampling_cpu_percent,
+            config.current.sampling_boost_duration,
+        )
 
     def cleanup_print_log(self):
         """
         Clean up the print log file and image thread after the print has finished.
         """
         try:
-            self.csv_print_log.flush()
-            self.csv_print_log.close()
+            self.telemetry.close()
+            # live chunks still waiting in the outbox are sent with end-job instead,
+            # and rows already delivered as live uploads are not sent again
+            job_name = self._printer.current_job
+            self.withdraw_live_uploads(job_name, self.take_rejected_live_uploads(job_name))
+            self.telemetry.export_csv(self.csv_path, start=self.live_upload_offset)
+            self.telemetry_stats = self.telemetry.stats()
+            self.telemetry_stats["upload_bytes"] = os.path.getsize(self.csv_path)
+            self._logger.info(f"Print log stats: {self.telemetry_stats}")
         except AttributeError:
             self._logger.error("CSV print log was never made...")
         except Exception as e:
             self._logger.error(f"Failed to close print log file: {e}")
+        try:
+            self.layers.finish(time.time())
+        except OSError as e:
+            self._logger.error(f"Failed to write layer summary: {e}")
+        if self._printer.gcode_trace.enabled:
+            try:
+                self._printer.gcode_trace.stop()
+                self._logger.debug(f"G-code trace stats: {self._printer.gcode_trace.stats()}")
+            except OSError as e:
+                self._logger.error(f"Failed to flush G-code trace: {e}")
 
     def find_first_layer_end_line(self, gcode_path):
         """
@@ -401,103 +790,40 @@ class DataEngine:
         Returns:
             int: The line number of the first layer end.
         """
-        with open(gcode_path, "r") as gcode:
-            gcode_lines = gcode.readlines()
-            # find lines that are not comments and have E in them
-            e_lines = []
-            z_change_lines = []
-
-            i=0
-            for line in gcode_lines:
-                if line.startswith(";") or line == "\n":
-                    continue
-                i+=1
-                if "E" in line:
-                    e_lines.append(i)
-                if "Z" in line:
-                    # regex string after Z and before space or the end of the line
-                    regex = r"Z(-?\d*\.?\d+)"
-                    z_change = re.search(regex, line)
-                    if z_change:
-                        z_change_lines.append((i, float(z_change.group(1))))
-                      
-            self._logger.info(f"Z change lines length: {len(z_change_lines)}")
-            self._logger.info(f"E lines length: {len(e_lines)}")
-            self._logger.info(f"Z change lines: {z_change_lines[:20]}")
-
-            # find the first layer start extrusion line if Es are in 8 out of 10 consecutive lines
-            consecutive_e_lines = 0
-            first_layer_start_line = None
-            threshold = 10
-            for threshold in range(10, 20, 1):
-                for i, line in enumerate(e_lines):
-                    if i + 8 >= len(e_lines):
-                        break
-                    if e_lines[i + 8] - e_lines[i] < threshold:
-                        first_layer_start_line = e_lines[i]
-                        break
-                if first_layer_start_line is not None:
-
-                    break
-            
-            # find what Z value is at the first layer start line
-            first_layer_start_z = None
-            for line in z_change_lines:
-                if line[0] > first_layer_start_line:
-                    first_layer_end_line = line[0]
-                    break
-                first_layer_start_z = line[1]
-                
-            self._logger.info(f"First layer start line: {first_layer_start_line}")
-            self._logger.info(f"First layer start Z: {first_layer_start_z}")
-            self._logger.info(f"First layer end line: {first_layer_end_line}")
-
-            self.first_layer_end_line = first_layer_end_line
-            return
-                    
-            
+        first_layer = self.offload.scan_first_layer(gcode_path)
+        self._logger.info(f"Z change lines length: {first_layer['z_changes']}")
+        self._logger.info(f"E lines length: {first_layer['e_lines']}")
+        self._logger.info(f"Z change lines: {first_layer['first_z_changes']}")
+        self._logger.info(f"First layer start line: {first_layer['start_line']}")
+        self._logger.info(f"First layer start Z: {first_layer['start_z']}")
+        self._logger.info(f"First layer end line: {first_layer['end_line']}")
+
+        self.first_layer_end_line = first_layer["end_line"]
+        return self.first_layer_end_line
 
     def csv_headers(self):
         """Returns a list of CSV headers used for data collection."""
-        return [
-            "count",
-            "timestamp",
-            "flow_rate",
-            "feed_rate",
-            "z_offset",
-            "target_hotend",
-            "hotend",
-            "target_bed",
-            "bed",
-            "gcode_line_num_no_comments",
-            "gcode_cmd",
-            "nozzle_tip_coords_x",
-            "nozzle_tip_coords_y",
-            "flip_h",
-            "flip_v",
-            "rotate",
-        ]
+        return [name for name, _ in TELEMETRY_COLUMNS]
 
-    def csv_data_row(self):
-        """Fetches data and returns a list for populating a row of a CSV."""
-        temps = self._printer.get_data()["temperature_data"]
+    def csv_data_row(self, snapshot):
+        """Returns a list for populating a row of a CSV from the snapshot of the current tick."""
         row = [
-            self.image_count,
-            make_timestamp(),
-            self._printer.flow_rate,
-            self._printer.feed_rate,
-            self._printer.z_offset,
-            temps["tool0"]["target"],
-            temps["tool0"]["actual"],
-            temps["bed"]["target"],
-            temps["bed"]["actual"],
-            self._printer.gcode_line_num_no_comments,
-            self._printer.gcode_cmd,
-            int(self._settings.get(["nozzle_tip_coords_x"])),
-            int(self._settings.get(["nozzle_tip_coords_y"])),
-            self._settings.get(["flip_h"]),
-            self._settings.get(["flip_v"]),
-            self._settings.get(["rotate"]),
+            snapshot.count,
+            snapshot.timestamp,
+            snapshot.flow_rate,
+            snapshot.feed_rate,
+            snapshot.z_offset,
+            snapshot.hotend_target,
+            snapshot.hotend_actual,
+            snapshot.bed_target,
+            snapshot.bed_actual,
+            snapshot.gcode_line_num,
+            snapshot.gcode_cmd,
+            snapshot.nozzle_tip_coords_x,
+            snapshot.nozzle_tip_coords_y,
+            snapshot.flip_h,
+            snapshot.flip_v,
+            snapshot.rotate,
         ]
         return row
 
@@ -508,40 +834,89 @@ class DataEngine:
         Returns:
             dict: The authentication headers.
         """
-        return {"Authorization": self._settings.get(["auth_token"])}
+        return {"Authorization": config.current.auth_token}
 
-    def update_csv(self):
+    def update_csv(self, snapshot):
         try:
-            self.csv_writer.writerow(self.csv_data_row())
-            self.csv_print_log.flush()
+            row = self.telemetry.row_count
+            self.telemetry.append(self.csv_data_row(snapshot))
         except Exception as e:
             self._logger.error(e)
+            row = None
+        # the first row past the first layer bounds the first layer upload
+        if (
+            self.first_layer_end_row is None
+            and row is not None
+            and snapshot.gcode_line_num is not None
+            and self.first_layer_end_line is not None
+            and int(snapshot.gcode_line_num) > self.first_layer_end_line
+        ):
+            self.first_layer_end_row = row
+        self.layers.on_sample(snapshot)
         
         # check if first layer is done
         buffer_length = 8
         
-        if self.first_layer_csv_uploaded == False and int(self._printer.gcode_line_num_no_comments) > self.first_layer_end_line + buffer_length:
+        if (
+            self.first_layer_csv_uploaded == False
+            and self.start_job_queued.is_set()
+            and self.first_layer_end_row is not None
+            and snapshot.gcode_line_num is not None
+            and int(snapshot.gcode_line_num) > self.first_layer_end_line + buffer_length
+        ):
             self.first_layer_csv_uploaded = True
-            self.first_layer_upload(self._printer.current_job, self.gcode_path, self.csv_path, self.first_layer_csv_path)
+            try:
+                self.telemetry.export_csv(self.first_layer_csv_path, end=self.first_layer_end_row)
+                self.first_layer_upload(self._printer.current_job, self.gcode_path, self.first_layer_csv_path)
+                self.save_active_job(first_layer_uploaded=True)
+            except Exception as e:
+                self._logger.error(f"Failed to queue first layer upload: {e}")
+
+    def update_image(self, snapshot, trigger="timer"):
+        """
+        Fetches a frame from the snapshot URL and uploads it.
 
-    def update_image(self):
+        Returns:
+            int: The bytes uploaded for the frame, 0 if none was sent.
+        """
+        # no point grabbing a frame the backend is not taking right now
+        if breakers.get("new-image").retry_after() > 0:
+            return 0
+        image = self._printer.camera.fetch(config.current.snapshot_url)
+        if image is None:
+            return 0
         try:
-            if self._settings.get(["snapshot_url"]) not in self.bad_url_cache:
-                resp = requests.get(self._settings.get(["snapshot_url"]), stream=True)
-                if resp.status_code != 200:
-                    raise Exception("Unsuccessful request, status code: " + str(resp.status_code))
-            else:
-                raise Exception("Bad URL")
-            self.unsuccessful_image_count = 0
-            self.image_upload(resp.content)
+            sent_bytes = self.image_upload(image, snapshot, trigger)
+            self.layers.on_frame(snapshot.count)
             self.image_count += 1
+            return sent_bytes
+        except FrameDecodeError as e:
+            self._printer.camera.mark_corrupt(str(e))
         except Exception as e:
-            if "unsuccessful request" in str(e).lower():
-                self._logger.info("Unsuccessful request image request.")
-                self.unsuccessful_image_count += 1
-                if self.unsuccessful_image_count > 3:
-                    self._logger.info("Maximum failed image requests reached, blacklisting snapshot URL for 2 minutes.")
-                    self.bad_url_cache[self._settings.get(["snapshot_url"])] = True
+            self._logger.error(f"Failed to process image: {e}")
+        return 0
+
+    def flush_gcode_trace(self):
+        """Writes the sent lines traced since the last sample to the job directory"""
+        if not self._printer.gcode_trace.enabled:
+            return
+        try:
+            self._printer.gcode_trace.flush()
+        except OSError as e:
+            self._logger.error(f"Failed to flush G-code trace: {e}")
+
+    def apply_sampling_policy(self, snapshot, now):
+        """
+        Feeds the sampling policy a snapshot and reschedules to the periods it
+        picks, with frames slowed down further while the resource governor asks for it.
+        Layer captures are held to the same budget and slowdown.
+        """
+        self.sampling_policy.observe(snapshot, self.first_layer_end_line, now)
+        frame_period, telemetry_period = self.sampling_policy.periods(now)
+        factor = resources.frame_period_factor()
+        self.frame_schedule.set_period(frame_period * factor)
+        self.telemetry_schedule.set_period(telemetry_period)
+        self._printer.layer_trigger.set_budget(self.sampling_policy.min_frame_period(), factor)
 
     def data_thread_loop(self):
         """
@@ -549,23 +924,64 @@ class DataEngine:
         - to populate the CSV log
         - to capture image frames
 
-        This loop runs at a rate determined by SAMPLING_TIMEOUT.
+        Sampling runs between the PrintStarted and PrintDone/PrintFailed/PrintCancelled
+        events. Telemetry rows and frames run on separate deadline schedules whose
+        periods the sampling policy sets from the print phase, its detectors and
+        the bandwidth and CPU budget. A layer change seen by the layer trigger pulls
+        the next frame forward, and the frame schedule restarts from there so
+        frames are not doubled up.
 
         Returns:
             None
         """
         self._logger.debug("Starting main data loop method.")
-        old_time = time.perf_counter()
-        time_buffer = 0.0
+        layer_trigger = self._printer.layer_trigger
+        self.resume_running_job()
 
         while True:
+            self.process_job_events()
+            self.process_layer_changes()
             current_time = time.perf_counter()
-            if (
-                self.is_new_job()
-                and (current_time - old_time) > SAMPLING_TIMEOUT - time_buffer
-            ):
-                time_buffer = max(0, current_time - old_time - SAMPLING_TIMEOUT)
-                old_time = current_time
-                self.update_csv()
-                self.update_image()
-            time.sleep(0.1)  # slow things down to 100ms to run other threads
+            if self.sampling:
+                layer_capture = layer_trigger.capture_due(current_time)
+                frame_due = layer_capture or self.frame_schedule.due(current_time)
+                telemetry_due = self.telemetry_schedule.due(current_time)
+                if frame_due or telemetry_due:
+                    self.record_first_sample(current_time)
+                    snapshot = self._printer.capture_snapshot(self.image_count)
+                # sampling costs are CPU time, the camera and network waits are
+                # left to the bandwidth budget
+                if telemetry_due:
+                    self.telemetry_schedule.tick(current_time)
+                    telemetry_start = time.thread_time()
+                    self.update_csv(snapshot)
+                    self.flush_gcode_trace()
+                    self.update_live_upload(current_time)
+                    self.sampling_policy.record_telemetry(
+                        time.thread_time() - telemetry_start
+                    )
+                if frame_due:
+                    if layer_capture:
+                        self.frame_schedule.restart(current_time)
+                    else:
+                        self.frame_schedule.tick(current_time)
+                    layer_trigger.mark_captured(current_time)
+                    frame_start = time.thread_time()
+                    size = self.update_image(snapshot, "layer" if layer_capture else "timer")
+                    self.sampling_policy.record_frame(size, time.thread_time() - frame_start)
+                if frame_due or telemetry_due:
+                    self.apply_sampling_policy(snapshot, current_time)
+            # sleep until the next deadline, waking early on a layer change or
+            # print event, and idle for longer between prints
+            if self.sampling:
+                now = time.perf_counter()
+                timeout = min(
+                    self.frame_schedule.time_until(now),
+                    self.telemetry_schedule.time_until(now),
+                )
+                layer_due = layer_trigger.time_until_due(now)
+                if layer_due is not None:
+                    timeout = min(timeout, layer_due)
+            else:
+                timeout = 1.0
+            layer_trigger.wait(timeout)
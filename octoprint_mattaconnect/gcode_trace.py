@@ -0,0 +1,168 @@
+'''
+This module holds the high-resolution G-code execution trace. Every line sent
+from a printing file is recorded as its line number and a monotonic timestamp
+into a preallocated ring buffer, which the data thread flushes to the job
+directory in compact binary chunks.
+
+Chunk layout (little endian):
+    magic "MGT1" | uint32 count | int64 first line | int64 first time (ns) |
+    uint32 crc32 of payload | uint32 payload length | payload
+
+The payload is the zlib-compressed, delta-encoded line numbers followed by the
+delta-encoded timestamps, both as int64 arrays of `count - 1` items.
+'''
+import sys
+import zlib
+import struct
+from array import array
+from time import monotonic_ns
+
+CHUNK_MAGIC = b"MGT1"
+CHUNK_HEADER = struct.Struct("<4sIqqII")
+DEFAULT_TRACE_CAPACITY = 16384  # records, roughly 15s of very short segments
+
+
+class GcodeTrace:
+    """
+    Single-producer, single-consumer ring buffer of sent G-code lines.
+
+    `record` runs on OctoPrint's comm thread and only writes into the
+    preallocated arrays, `flush` runs on the data thread.
+    """
+
+    def __init__(self, capacity=DEFAULT_TRACE_CAPACITY):
+        self.capacity = capacity
+        self.lines = array("q", bytes(8 * capacity))
+        self.times = array("q", bytes(8 * capacity))
+        self.enabled = False
+        self.path = None
+        self.reset()
+
+    def reset(self):
+        self.head = 0  # total records written
+        self.tail = 0  # total records flushed
+        self.dropped = 0
+        self.bytes_written = 0
+
+    def start(self, path):
+        """Starts tracing into the given file"""
+        self.reset()
+        self.path = path
+        self.enabled = True
+
+    def stop(self):
+        """Stops tracing and flushes what is left in the buffer"""
+        self.enabled = False
+        self.flush()
+
+    def record(self, line_num):
+        """
+        Records a sent line. Hot path, no allocation beyond the int arguments.
+
+        Args:
+            line_num (int): The file line number that was sent.
+        """
+        head = self.head
+        if head - self.tail >= self.capacity:
+            self.dropped += 1
+            return
+        index = head % self.capacity
+        self.lines[index] = line_num
+        self.times[index] = monotonic_ns()
+        self.head = head + 1
+
+    def _pending(self):
+        """Copies out the records written since the last flush, in order"""
+        tail, head = self.tail, self.head
+        start, end = tail % self.capacity, head % self.capacity
+        if head - tail == 0:
+            return tail, head, array("q"), array("q")
+        if start < end:
+            return tail, head, self.lines[start:end], self.times[start:end]
+        return (
+            tail,
+            head,
+            self.lines[start:] + self.lines[:end],
+            self.times[start:] + self.times[:end],
+        )
+
+    def flush(self):
+        """
+        Writes the pending records to the trace file as one chunk.
+
+        Returns:
+            int: The number of records flushed.
+        """
+        tail, head, lines, times = self._pending()
+        count = head - tail
+        if count == 0 or self.path is None:
+            return 0
+        chunk = encode_chunk(lines, times)
+        with open(self.path, "ab") as file:
+            file.write(chunk)
+        self.bytes_written += len(chunk)
+        self.tail = head
+        return count
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "records": self.head,
+            "dropped": self.dropped,
+            "bytes_written": self.bytes_written,
+        }
+
+
+def _deltas(values):
+    deltas = array("q", values)
+    for i in range(len(deltas) - 1, 0, -1):
+        deltas[i] -= deltas[i - 1]
+    return deltas[1:]
+
+
+def encode_chunk(lines, times):
+    """Encodes trace records into a binary chunk"""
+    line_deltas, time_deltas = _deltas(lines), _deltas(times)
+    if sys.byteorder != "little":
+        line_deltas.byteswap()
+        time_deltas.byteswap()
+    payload = zlib.compress(line_deltas.tobytes() + time_deltas.tobytes())
+    header = CHUNK_HEADER.pack(
+        CHUNK_MAGIC, len(lines), lines[0], times[0], zlib.crc32(payload), len(payload)
+    )
+    return header + payload
+
+
+def read_trace(path):
+    """
+    Reads a trace file back into line numbers and timestamps. Stops at the first
+    truncated or corrupt chunk, so a trace cut short by a crash is still readable.
+
+    Returns:
+        tuple: Two arrays, line numbers and monotonic timestamps in ns.
+    """
+    lines, times = array("q"), array("q")
+    with open(path, "rb") as file:
+        data = file.read()
+    offset = 0
+    while offset + CHUNK_HEADER.size <= len(data):
+        magic, count, first_line, first_time, crc, length = CHUNK_HEADER.unpack_from(
+            data, offset
+        )
+        offset += CHUNK_HEADER.size
+        payload = data[offset : offset + length]
+        if magic != CHUNK_MAGIC or len(payload) != length or zlib.crc32(payload) != crc:
+            break
+        offset += length
+        deltas = array("q", zlib.decompress(payload))
+        if sys.byteorder != "little":
+            deltas.byteswap()
+        line, stamp = first_line, first_time
+        lines.append(line)
+        times.append(stamp)
+        for i in range(count - 1):
+            line += deltas[i]
+            stamp += deltas[count - 1 + i]
+            lines.append(line)
+            times.append(stamp)
+    return lines, times
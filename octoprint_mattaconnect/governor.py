@@ -0,0 +1,254 @@
+'''
+This module holds the resource governor that protects OctoPrint's serial
+streaming on small boards. It takes CPU load, SoC temperature and the
+Raspberry Pi throttling flags from the system metrics sampler, measures how
+quickly the comm thread answers the printer, and degrades the plugin's own work in steps while the board is
+under pressure:
+
+    1. reduce_frames: frames are taken less often and at half resolution
+    2. pause_bulk: bulk transfers (background file jobs, job start/end uploads)
+       are held, while downloads for a print starting now still run
+    3. pause_telemetry: live telemetry uploads are held as well
+
+It steps up one level at a time while any input stays over its limit, and
+steps back down only after every input has stayed below its limit minus a
+margin for a while, so it does not flap around a threshold.
+'''
+import time
+import threading
+from collections import deque
+
+from .sysmetrics import SYSTEM_SAMPLE_INTERVAL
+
+GOVERNOR_LEVELS = ("normal", "reduce_frames", "pause_bulk", "pause_telemetry")
+GOVERNOR_INTERVAL = SYSTEM_SAMPLE_INTERVAL  # the governor decides once per system sample
+GOVERNOR_ESCALATE_SECONDS = 10.0  # pressure needed before stepping up a level
+GOVERNOR_RECOVER_SECONDS = 60.0  # calm needed before stepping down a level
+# per input, the readings at which levels 1, 2 and 3 are wanted, and the margin
+# below a limit a reading has to fall before that level may be left
+GOVERNOR_LIMITS = {
+    "cpu_percent": ((85.0, 95.0, 99.0), 15.0),
+    "temperature": ((75.0, 80.0, 85.0), 5.0),  # the Pi firmware throttles at 80 and 85
+    "comm_turnaround_ms": ((20.0, 50.0, 100.0), 10.0),
+}
+GOVERNOR_DECISIONS = 20  # recent level changes kept for reporting
+FRAME_PERIOD_FACTORS = (1.0, 2.0, 3.0, 4.0)  # by level
+REDUCED_FRAME_SCALE = 0.5
+# file job kinds held back from pause_bulk on, jobs already running carry on
+# and print-now jobs are never held, see FileJobScheduler.pause_kind
+GOVERNOR_BULK_FILE_JOBS = ("download", "upload", "prefetch")
+
+COMM_WINDOW = 200  # recent ok-to-send turnarounds kept
+COMM_MAX_TURNAROUND = 1.0  # seconds, longer gaps are pauses rather than a slow comm thread
+
+# get_throttled bits that are set while the condition is active
+UNDER_VOLTAGE = 0x1
+FREQUENCY_CAPPED = 0x2
+THROTTLED = 0x4
+SOFT_TEMP_LIMIT = 0x8
+
+
+class CommMonitor:
+    """
+    Measures the comm thread's turnaround: the time from the printer's "ok"
+    to OctoPrint sending the next line of the file being printed. It is
+    fed from the received and sent G-code hooks and grows when the plugin
+    starves the comm thread of CPU.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._turnarounds = deque(maxlen=COMM_WINDOW)
+        self._ok_at = None
+
+    def on_received(self, line):
+        if line.startswith("ok"):
+            self._ok_at = self.clock()
+
+    def on_sent_file_line(self):
+        ok_at, self._ok_at = self._ok_at, None
+        if ok_at is None:
+            return
+        turnaround = self.clock() - ok_at
+        if turnaround <= COMM_MAX_TURNAROUND:
+            with self._lock:
+                self._turnarounds.append(turnaround)
+
+    def turnaround_ms(self):
+        """Returns the 95th percentile turnaround in ms, None if nothing was streamed lately"""
+        with self._lock:
+            turnarounds = sorted(self._turnarounds)
+            self._turnarounds.clear()
+        if not turnarounds:
+            return None
+        return round(turnarounds[int(len(turnarounds) * 0.95)] * 1000, 2)
+
+
+class ResourceGovernor:
+    """
+    Picks the plugin's degradation level from the board's readings. Readers
+    ask it what they may do through frame_period_factor, frame_scale,
+    allows_bulk and allows_telemetry, which are cheap enough to call per frame.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._logger = None
+        self.comm = CommMonitor()
+        self.enabled = True
+        self.level = 0
+        self.readings = {}
+        self.reasons = []
+        self.pressure_since = None
+        self.calm_since = None
+        self.level_since = clock()
+        self.decisions = deque(maxlen=GOVERNOR_DECISIONS)
+        self.listeners = []
+
+    def configure(self, logger, enabled=True):
+        """
+        Args:
+            logger: The plugin logger.
+            enabled (bool): Whether to degrade plugin work. Readings are taken either way.
+        """
+        self._logger = logger
+        self.enabled = enabled
+
+    def add_listener(self, listener):
+        """Registers listener(level) to be called with the effective level after it changes"""
+        self.listeners.append(listener)
+
+    def on_system_sample(self, snapshot):
+        """Decides on the readings of a new system metrics snapshot, see SystemSampler"""
+        self.update(
+            {
+                "cpu_percent": snapshot.get("cpu_percent"),
+                "temperature": snapshot.get("temperature"),
+                "throttled": snapshot.get("throttled"),
+                "comm_turnaround_ms": self.comm.turnaround_ms(),
+            }
+        )
+
+    @staticmethod
+    def wanted_level(readings, margin=False):
+        """
+        Returns the level the readings call for, and the inputs calling for it.
+
+        Args:
+            readings (dict): cpu_percent, temperature, throttled and comm_turnaround_ms,
+                None where unknown.
+            margin (bool): Lower every limit by its margin, to decide if a level may be left.
+        """
+        wanted, reasons = 0, []
+        for name, (limits, limit_margin) in GOVERNOR_LIMITS.items():
+            value = readings.get(name)
+            if value is None:
+                continue
+            offset = limit_margin if margin else 0
+            crossed = [limit for limit in limits if value >= limit - offset]
+            if crossed:
+                wanted = max(wanted, len(crossed))
+                reasons.append(f"{name} {value} >= {crossed[-1] - offset}")
+        throttled = readings.get("throttled") or 0
+        if throttled & (FREQUENCY_CAPPED | THROTTLED | SOFT_TEMP_LIMIT):
+            wanted = max(wanted, 2)
+            reasons.append(f"throttled {throttled:#x}")
+        elif throttled & UNDER_VOLTAGE:
+            wanted = max(wanted, 1)
+            reasons.append("under-voltage")
+        return wanted, reasons
+
+    def update(self, readings):
+        """
+        Moves at most one level towards what the readings call for, once the
+        pressure or calm has lasted long enough.
+
+        Args:
+            readings (dict): As for wanted_level.
+        """
+        now = self.clock()
+        wanted, reasons = self.wanted_level(readings)
+        still_wanted, _ = self.wanted_level(readings, margin=True)
+        with self._lock:
+            previous = self.level
+            self.readings = readings
+            self.reasons = reasons
+            if wanted > self.level:
+                self.calm_since = None
+                if self.pressure_since is None:
+                    self.pressure_since = now
+                if now - self.pressure_since >= GOVERNOR_ESCALATE_SECONDS:
+                    self._change(self.level + 1, now, "; ".join(reasons))
+            elif still_wanted < self.level:
+                self.pressure_since = None
+                if self.calm_since is None:
+                    self.calm_since = now
+                if now - self.calm_since >= GOVERNOR_RECOVER_SECONDS:
+                    self._change(self.level - 1, now, "recovered")
+            else:
+                self.pressure_since = None
+                self.calm_since = None
+            changed = self.level != previous
+        if changed:
+            for listener in self.listeners:
+                listener(self.effective_level())
+
+    def _change(self, level, now, reason):
+        """Must be called with the lock held"""
+        self.decisions.append(
+            {
+                "time": time.time(),
+                "from": GOVERNOR_LEVELS[self.level],
+                "to": GOVERNOR_LEVELS[level],
+                "reason": reason,
+            }
+        )
+        if self._logger:
+            self._logger.info(
+                f"Resource governor: {GOVERNOR_LEVELS[self.level]} -> {GOVERNOR_LEVELS[level]} ({reason})"
+            )
+        self.level = level
+        self.level_since = now
+        # the next step needs its own full period of pressure or calm
+        self.pressure_since = now if level < len(GOVERNOR_LEVELS) - 1 else None
+        self.calm_since = now if level > 0 else None
+
+    def effective_level(self):
+        return self.level if self.enabled else 0
+
+    def frame_period_factor(self):
+        """Returns the factor the frame period is stretched by"""
+        return FRAME_PERIOD_FACTORS[self.effective_level()]
+
+    def frame_scale(self):
+        """Returns the scale frames are sent at"""
+        return REDUCED_FRAME_SCALE if self.effective_level() >= 1 else 1.0
+
+    def allows_bulk(self):
+        return self.effective_level() < 2
+
+    def allows_telemetry(self):
+        """Whether non-critical telemetry (live uploads) may be sent"""
+        return self.effective_level() < 3
+
+    def to_dict(self):
+        with self._lock:
+            readings = dict(self.readings)
+            throttled = readings.get("throttled")
+            if throttled is not None:
+                readings["throttled"] = f"{throttled:#x}"
+            return {
+                "enabled": self.enabled,
+                "level": self.effective_level(),
+                "state": GOVERNOR_LEVELS[self.effective_level()],
+                "for": round(self.clock() - self.level_since, 1),
+                "readings": readings,
+                "reasons": list(self.reasons),
+                "decisions": list(self.decisions),
+            }
+
+
+# shared by the whole plugin, so every subsystem follows the same decisions
+resources = ResourceGovernor()
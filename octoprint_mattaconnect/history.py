@@ -0,0 +1,219 @@
+'''
+This module holds the in-memory telemetry history sent to the dashboard when
+a user connects, so graphs show the recent past and not just the latest point.
+Samples are kept in fixed-size typed arrays, and the history is reduced to a
+requested number of points with Largest-Triangle-Three-Buckets downsampling,
+using NumPy for the per-bucket work when it is installed. The points each
+column keeps are merged into one time axis shared by every column, which keeps
+the message to a few KB.
+'''
+import math
+import time
+import threading
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, the pure Python path gives the same result
+    np = None
+
+HISTORY_COLUMNS = (
+    "hotend_actual",
+    "hotend_target",
+    "bed_actual",
+    "bed_target",
+    "flow_rate",
+    "feed_rate",
+    "z",
+)
+HISTORY_CAPACITY = 7200  # about four hours at OctoPrint's 2 s temperature rate
+HISTORY_POINTS = 120  # 3 to 7 KB of JSON, depending on how much the columns agree
+MAX_HISTORY_POINTS = 1000
+
+
+def _lttb_indices_python(xs, ys, threshold):
+    """Pure Python LTTB, returns the indices of the points to keep"""
+    n = len(xs)
+    bucket_size = (n - 2) / (threshold - 2)
+    indices = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        # the average of the next bucket stands in for the point not yet chosen
+        count = next_end - end
+        avg_x = sum(xs[end:next_end]) / count
+        avg_y = sum(ys[end:next_end]) / count
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        indices.append(best)
+        a = best
+    indices.append(n - 1)
+    return indices
+
+
+def _lttb_indices_numpy(xs, ys, threshold):
+    """LTTB with the triangle areas of each bucket computed by NumPy"""
+    n = len(xs)
+    bucket_size = (n - 2) / (threshold - 2)
+    edges = (np.arange(threshold) * bucket_size).astype(np.int64) + 1
+    edges[-1] = n - 1
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < threshold - 1 else n
+        avg_x = xs[end:next_end].mean()
+        avg_y = ys[end:next_end].mean()
+        ax, ay = xs[a], ys[a]
+        areas = np.abs(
+            (ax - avg_x) * (ys[start:end] - ay) - (ax - xs[start:end]) * (avg_y - ay)
+        )
+        a = start + int(areas.argmax())
+        indices[i + 1] = a
+    return indices
+
+
+def lttb(xs, ys, threshold):
+    """
+    Downsamples a series with Largest-Triangle-Three-Buckets.
+
+    Args:
+        xs (sequence): The x values, in increasing order.
+        ys (sequence): The y values.
+        threshold (int): The number of points to keep.
+
+    Returns:
+        list: The indices of the kept points.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    if np is not None:
+        return _lttb_indices_numpy(np.asarray(xs), np.asarray(ys), threshold).tolist()
+    return _lttb_indices_python(xs, ys, threshold)
+
+
+class TelemetryHistory:
+    """
+    Fixed-memory ring buffer of recent temperature, flow, feed and Z samples.
+
+    Each column is a preallocated array('d'), so the memory used does not grow
+    with uptime. Missing values are stored as NaN and left out of the output.
+    """
+
+    def __init__(self, capacity=HISTORY_CAPACITY, columns=HISTORY_COLUMNS):
+        self.capacity = int(capacity)
+        self.columns = columns
+        self._lock = threading.Lock()
+        self._times = array("d", bytes(8 * self.capacity))
+        self._values = {name: array("d", bytes(8 * self.capacity)) for name in columns}
+        self._next = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, timestamp=None, **values):
+        """
+        Adds one sample.
+
+        Args:
+            timestamp (float): Unix time of the sample, defaults to now.
+            **values: The value of each column, None if unknown.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            i = self._next
+            self._times[i] = timestamp
+            for name in self.columns:
+                value = values.get(name)
+                self._values[name][i] = math.nan if value is None else value
+            self._next = (i + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def _ordered(self, column):
+        """Returns a column oldest first. Called with the lock held."""
+        if self._size < self.capacity:
+            return column[: self._size]
+        return column[self._next :] + column[: self._next]
+
+    def series(self):
+        """
+        Returns a copy of the history, oldest first.
+
+        Returns:
+            tuple: The timestamps and a dict of each column's values.
+        """
+        with self._lock:
+            times = self._ordered(self._times)
+            values = {name: self._ordered(self._values[name]) for name in self.columns}
+        return times, values
+
+    def downsample(self, points=HISTORY_POINTS):
+        """
+        Reduces the history to about `points` samples. Each column picks its
+        share of them with LTTB, and every column is given at all the picked
+        samples, so they share one time axis.
+
+        Args:
+            points (int): The number of samples requested, clamped to
+                2..MAX_HISTORY_POINTS.
+
+        Returns:
+            tuple: The kept timestamps and a dict of each column's values at
+                them, None where a value is missing.
+        """
+        points = max(2, min(int(points), MAX_HISTORY_POINTS))
+        times, values = self.series()
+        n = len(times)
+        per_column = (points - 2) // len(self.columns)
+        if per_column < 3 or n <= points:
+            # too few points to share out, or nothing to drop: evenly spaced samples
+            keep = sorted({int(i * (n - 1) / max(1, points - 1)) for i in range(min(points, n))})
+        else:
+            keep = {0, n - 1}
+            for column in values.values():
+                if np is not None:
+                    vs = np.frombuffer(column)
+                    known = np.flatnonzero(~np.isnan(vs))
+                    ts, vs = np.frombuffer(times)[known], vs[known]
+                else:
+                    known = [i for i, v in enumerate(column) if v == v]
+                    ts = [times[i] for i in known]
+                    vs = [column[i] for i in known]
+                keep.update(int(known[i]) for i in lttb(ts, vs, per_column))
+            keep = sorted(keep)
+        return (
+            [times[i] for i in keep],
+            {
+                name: [None if column[i] != column[i] else round(column[i], 1) for i in keep]
+                for name, column in values.items()
+            },
+        )
+
+    def to_dict(self, points=HISTORY_POINTS):
+        """
+        Returns the downsampled history for the dashboard.
+
+        Returns:
+            dict: The buffer's capacity and size, the Unix time of the first kept
+                sample ("start"), each kept sample's whole seconds after it ("t"),
+                and each column's values at those samples ("series").
+        """
+        times, series = self.downsample(points)
+        start = times[0] if times else None
+        return {
+            "capacity": self.capacity,
+            "size": self._size,
+            "start": None if start is None else round(start, 1),
+            "t": [round(t - start) for t in times],
+            "series": series,
+        }
@@ -0,0 +1,212 @@
+'''
+This module holds the per-layer telemetry aggregator. It folds every sampling
+tick into running statistics for the layer being printed and writes one
+compact summary record per completed layer, so layer analytics do not depend
+on uploading every raw row.
+'''
+import json
+import math
+
+
+class RunningStats:
+    """Constant-memory min/mean/max of a series"""
+
+    __slots__ = ("count", "total", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        if value is None:
+            return
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        if not self.count:
+            return None
+        return {
+            "min": round(self.min, 2),
+            "mean": round(self.total / self.count, 2),
+            "max": round(self.max, 2),
+        }
+
+
+class RateTracker:
+    """Tracks the first and last value of a percentage rate and how often it changed"""
+
+    __slots__ = ("first", "last", "changes")
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.changes = 0
+
+    def add(self, value):
+        if value is None:
+            return
+        if self.first is None:
+            self.first = value
+        elif value != self.last:
+            self.changes += 1
+        self.last = value
+
+    def to_dict(self):
+        return {"first": self.first, "last": self.last, "changes": self.changes}
+
+
+class LayerSummary:
+    """The running aggregate of one layer"""
+
+    def __init__(self, layer, z, start_time):
+        self.layer = layer
+        self.z = z
+        self.start_time = start_time
+        self.samples = 0
+        self.hotend = RunningStats()
+        self.bed = RunningStats()
+        self.flow = RateTracker()
+        self.feed = RateTracker()
+        self.first_line = None
+        self.last_line = None
+        self.first_frame = None
+        self.last_frame = None
+        self.frames = 0
+
+    def add_sample(self, snapshot):
+        self.samples += 1
+        self.hotend.add(snapshot.hotend_actual)
+        self.bed.add(snapshot.bed_actual)
+        self.flow.add(snapshot.flow_rate)
+        self.feed.add(snapshot.feed_rate)
+        if snapshot.gcode_line_num is not None:
+            line = int(snapshot.gcode_line_num)
+            if self.first_line is None:
+                self.first_line = line
+            self.last_line = line
+
+    def add_frame(self, count):
+        if self.first_frame is None:
+            self.first_frame = count
+        self.last_frame = count
+        self.frames += 1
+
+    def to_dict(self, end_time):
+        return {
+            "layer": self.layer,
+            "z": self.z,
+            "start": round(self.start_time, 3),
+            "duration": round(end_time - self.start_time, 3),
+            "samples": self.samples,
+            "hotend": self.hotend.to_dict(),
+            "bed": self.bed.to_dict(),
+            "flow_rate": self.flow.to_dict(),
+            "feed_rate": self.feed.to_dict(),
+            "gcode_lines": [self.first_line, self.last_line],
+            "frames": {
+                "first": self.first_frame,
+                "last": self.last_frame,
+                "count": self.frames,
+            },
+        }
+
+
+class LayerAggregator:
+    """
+    Aggregates telemetry per layer and appends a record to a JSON lines file
+    as each layer completes.
+
+    Layer boundaries come from the layer trigger, which the sent-line hook
+    drives, so a layer's duration runs from the first extruding move at its Z
+    to the first extruding move of the next layer. Layers are opened and closed
+    on those changes rather than on sampling ticks, so a layer shorter than a
+    sampling period still gets its own record, with no samples.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.current = None
+        self.completed = 0
+        self.last_record = None
+
+    def start(self, path):
+        """
+        Starts aggregating a new job.
+
+        Args:
+            path (str): The JSON lines file the layer records are appended to.
+        """
+        self.path = path
+        self.current = None
+        self.completed = 0
+        self.last_record = None
+
+    def _emit(self, end_time):
+        record = self.current.to_dict(end_time)
+        self.current = None
+        self.completed += 1
+        self.last_record = record
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        return record
+
+    def on_layer_change(self, layer, z, started_at):
+        """
+        Closes the current layer and opens the next one.
+
+        Args:
+            layer (int): The number of the layer that started.
+            z (float): The Z height of the layer that started.
+            started_at (float): Unix time the layer started, which is when the
+                previous layer ended.
+
+        Returns:
+            dict: The record of the layer that completed, or None.
+        """
+        if self.path is None:
+            return None
+        record = None
+        try:
+            if self.current is not None:
+                record = self._emit(started_at)
+        finally:
+            self.current = LayerSummary(layer, z, started_at)
+        return record
+
+    def on_sample(self, snapshot):
+        """
+        Folds a sampling tick into the current layer.
+
+        Args:
+            snapshot (TelemetrySnapshot): The snapshot of the current tick.
+        """
+        if self.current is not None:
+            self.current.add_sample(snapshot)
+
+    def on_frame(self, count):
+        """Adds a frame reference to the current layer"""
+        if self.current is not None:
+            self.current.add_frame(count)
+
+    def finish(self, now):
+        """Closes the last layer at the end of a job"""
+        record = None
+        if self.current is not None:
+            record = self._emit(now)
+        self.path = None
+        return record
+
+    def stats(self):
+        return {
+            "completed": self.completed,
+            "current_layer": None if self.current is None else self.current.layer,
+            "last": self.last_record,
+        }
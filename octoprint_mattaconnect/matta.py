@@ -12,26 +12,38 @@ from .utils import (
     make_timestamp,
     get_cloud_http_url,
     get_cloud_websocket_url,
-    get_current_memory_usage,
     generate_auth_headers,
+    SAMPLING_TIMEOUT,
 )
 from .printer import MattaPrinter
 from .ws import Socket
 from .data import DataEngine
+from .outbox import Outbox
+from .timing import DeadlineScheduler, StartupTimings
+from .metrics import metrics
+from .history import HISTORY_POINTS, MAX_HISTORY_POINTS
+from .client import http
+from .breaker import breakers
+from .bandwidth import bandwidth
+from .governor import resources, GOVERNOR_BULK_FILE_JOBS
+from .sysmetrics import system_metrics
+from .config import config
 import requests
 
 
 class MattaCore:
-    def __init__(self, plugin, csv_capture=True, image_capture=True):
+    def __init__(self, plugin, csv_capture=True, image_capture=True, startup=None):
         self._settings = plugin._settings
         self._plugin = plugin
         self.updated_plugin_version = None
-        self._printer = MattaPrinter(
-            plugin._printer,
-            plugin._logger,
-            plugin._file_manager,
-            settings=plugin._settings,
-        )
+        self.startup = startup if startup is not None else StartupTimings()
+        with self.startup.measure("printer"):
+            self._printer = MattaPrinter(
+                plugin._printer,
+                plugin._logger,
+                plugin._file_manager,
+                settings=plugin._settings,
+            )
         self._logger = plugin._logger
         self._file_manager = plugin._file_manager
         self._attempt_reconnect = False
@@ -39,6 +51,7 @@ class MattaCore:
         self.nozzle_camera_count = 0
         self.ws = None
         self.ws_loop_time = 5
+        self.ws_schedule = DeadlineScheduler(self.ws_loop_time)
         self.terminal_cmds = []
         # get OS type (linux, windows, mac)
         self.os = get_os()
@@ -46,13 +59,51 @@ class MattaCore:
         self.octoprint_version = get_octoprint_version_string()
 
         self.user_online = False
-        self.start_websocket_thread()
+        with self.startup.measure("http"):
+            if http.configure(
+                config.current.http2, [http.host_key(get_cloud_http_url())]
+            ):
+                self._logger.info("Using HTTP/2 for cloud requests.")
+            self.bandwidth_settings = None
+            self.on_settings_refresh(config.current)
+            config.add_listener(self.on_settings_refresh)
+        with self.startup.measure("outbox"):
+            self.outbox = Outbox(self._settings, self._logger)
+        with self.startup.measure("data engine"):
+            self.data_engine = DataEngine(
+                self._printer, self._settings, self._logger, self.outbox
+            )
+        with self.startup.measure("system metrics"):
+            resources.configure(self._logger, config.current.resource_governor)
+            resources.add_listener(self.on_governor_level)
+            system_metrics.add_listener(resources.on_system_sample)
+            system_metrics.start(self._logger)
+        with self.startup.measure("websocket"):
+            self.start_websocket_thread()
 
         # Set up signal handlers
-        signal.signal(signal.SIGTERM, self.handle_shutdown)
-        signal.signal(signal.SIGINT, self.handle_shutdown)
+        try:
+            signal.signal(signal.SIGTERM, self.handle_shutdown)
+            signal.signal(signal.SIGINT, self.handle_shutdown)
+        except ValueError as e:  # only possible on the main thread
+            self._logger.debug(f"Signal handlers not installed: {e}")
+
+    def on_settings_refresh(self, snapshot):
+        """Applies the bandwidth budgets when they change in the settings"""
+        settings = (
+            snapshot.bandwidth_up_kbps,
+            snapshot.bandwidth_down_kbps,
+            snapshot.bandwidth_reserve_percent,
+        )
+        # configuring starts the links afresh, so only do it on a change
+        if settings != self.bandwidth_settings:
+            bandwidth.configure(*settings)
+            self.bandwidth_settings = settings
 
-        self.data_engine = DataEngine(self._printer, self._settings, self._logger)
+    def on_governor_level(self, level):
+        """Holds back or resumes background file jobs when the resource governor changes level"""
+        for kind in GOVERNOR_BULK_FILE_JOBS:
+            self._printer.file_jobs.pause_kind(kind, not resources.allows_bulk())
 
     def start_websocket_thread(self):
         """Starts the main WS thread."""
@@ -75,6 +126,7 @@ class MattaCore:
         else:
             # When the user is offline
             self.ws_loop_time = 30  # 30s websocket send interval
+        self.ws_schedule.set_period(self.ws_loop_time)
 
     def handle_shutdown(self, signum, frame):
         if self.ws_connected():
@@ -178,7 +230,7 @@ class MattaCore:
             self.ws = Socket(
                 on_message=lambda ws, msg: self.ws_on_message(msg),
                 url=full_url,
-                token=self._settings.get(["auth_token"]),
+                token=config.current.auth_token,
             )
             self.ws_thread = threading.Thread(target=self.ws.run)
             self.ws_thread.daemon = True
@@ -188,6 +240,15 @@ class MattaCore:
         except Exception as e:
             self._logger.info("ws_on_close: %s", e)
 
+    def webcam_transforms(self):
+        """Returns the webcam transforms the client should apply to the stream"""
+        settings = config.current
+        return {
+            "flip_h": settings.flip_h,
+            "flip_v": settings.flip_v,
+            "rotate": settings.rotate,
+        }
+
     def ws_on_message(self, incoming_msg):
         """
         Callback function called when a message is received over the WebSocket connection.
@@ -202,28 +263,31 @@ class MattaCore:
             self._logger.info("ws_on_message: %s", json_msg)
             msg = self.ws_data()  # default message
             if (
-                json_msg.get("token", None) == self._settings.get(["auth_token"])
+                json_msg.get("token", None) == config.current.auth_token
                 and json_msg.get("interface", None) == "client"
             ):
                 if json_msg.get("state", None) == "online":
                     self.user_online = True
-                    msg = self.ws_data()
+                    # a reconnecting client gets the recent past for its graphs
+                    try:
+                        points = int(json_msg.get("history_points", HISTORY_POINTS))
+                    except (TypeError, ValueError):
+                        points = HISTORY_POINTS
+                    points = max(2, min(points, MAX_HISTORY_POINTS))
+                    msg = self.ws_data({"history": self._printer.history.to_dict(points)})
                 elif json_msg.get("state", None) == "offline":
                     self.user_online = False
                     msg = self.ws_data()
                 elif json_msg.get("webrtc", None) == "request":
                     # check if auth_key has already been received
                     webrtc_auth_key = json_msg.get("auth_key", None)
-                    last_webrtc_auth_key = self._settings.get(["webrtc_auth_key"])
+                    last_webrtc_auth_key = config.current.webrtc_auth_key
                     if (
                         webrtc_auth_key is not None
                         and webrtc_auth_key != last_webrtc_auth_key
                     ):
                         # save auth_key
-                        self._settings.set(
-                            ["webrtc_auth_key"], webrtc_auth_key, force=True
-                        )
-                        self._settings.save()
+                        config.set("webrtc_auth_key", webrtc_auth_key)
                         webrtc_data = (
                             self.request_webrtc_stream()
                         )  # this can be None or {"webrtc_data": resp.json()}
@@ -231,12 +295,7 @@ class MattaCore:
                             webrtc_data = inject_auth_key(
                                 webrtc_data, json_msg, self._logger
                             )
-                            webcam_transforms = {
-                                "flip_h": self._settings.get(["flip_h"]),
-                                "flip_v": self._settings.get(["flip_v"]),
-                                "rotate": self._settings.get(["rotate"]),
-                            }
-                            webrtc_data["transforms"] = webcam_transforms
+                            webrtc_data["transforms"] = self.webcam_transforms()
                             msg = self.ws_data(extra_data=webrtc_data)
                         else:
                             msg = self.ws_data()
@@ -248,12 +307,7 @@ class MattaCore:
                         webrtc_data = inject_auth_key(
                             webrtc_data, json_msg, self._logger
                         )
-                        webcam_transforms = {
-                            "flip_h": self._settings.get(["flip_h"]),
-                            "flip_v": self._settings.get(["flip_v"]),
-                            "rotate": self._settings.get(["rotate"]),
-                        }
-                        webrtc_data["transforms"] = webcam_transforms
+                        webrtc_data["transforms"] = self.webcam_transforms()
                         msg = self.ws_data(extra_data=webrtc_data)
                     else:
                         msg = self.ws_data()
@@ -265,12 +319,7 @@ class MattaCore:
                         webrtc_data = inject_auth_key(
                             webrtc_data, json_msg, self._logger
                         )
-                        webcam_transforms = {
-                            "flip_h": self._settings.get(["flip_h"]),
-                            "flip_v": self._settings.get(["flip_v"]),
-                            "rotate": self._settings.get(["rotate"]),
-                        }
-                        webrtc_data["transforms"] = webcam_transforms
+                        webrtc_data["transforms"] = self.webcam_transforms()
                         msg = self.ws_data(extra_data=webrtc_data)
                     else:
                         msg = self.ws_data()
@@ -321,36 +370,44 @@ class MattaCore:
 
         """
         try:
+            snapshot = self._printer.current_snapshot(max_age=SAMPLING_TIMEOUT)
             data = {
                 "type": "printer_packet",
-                "token": self._settings.get(["auth_token"]),
+                "token": config.current.auth_token,
                 "timestamp": make_timestamp(),
                 "files": self._file_manager.list_files(recursive=True),
                 "terminal_cmds": self.terminal_cmds,
+                "file_jobs": self._printer.file_jobs.snapshot(),
+                "print_queue": self._printer.print_queue.to_dict(),
+                "outbox": self.outbox.stats(),
+                "job_lifecycle": self.data_engine.lifecycle_stats(),
+                "ws_cadence": self.ws_schedule.stats(),
+                "metrics": metrics.summary(),
                 "system": {
                     "software": "octoprint",
                     "version": self.octoprint_version,
                     "os": self.os,
-                    "memory": get_current_memory_usage(self.os),
+                    "memory": system_metrics.memory_usage(),
+                    "metrics": system_metrics.snapshot,
+                    "http": http.stats(),
+                    "breakers": breakers.to_dict(),
+                    "bandwidth": bandwidth.stats(),
+                    "governor": resources.to_dict(),
+                    "startup": self.startup.to_dict(),
                     "plugin_version": self._plugin._plugin_version if self.updated_plugin_version is None else self.updated_plugin_version,
                 },
                 "nozzle_tip_coords": {
-                    "nozzle_tip_coords_x": int(
-                        self._settings.get(["nozzle_tip_coords_x"])
-                    ),
-                    "nozzle_tip_coords_y": int(
-                        self._settings.get(["nozzle_tip_coords_y"])
-                    ),
+                    "nozzle_tip_coords_x": snapshot.nozzle_tip_coords_x,
+                    "nozzle_tip_coords_y": snapshot.nozzle_tip_coords_y,
                 },
                 "webcam_transforms": {
-                    "flip_h": self._settings.get(["flip_h"]),
-                    "flip_v": self._settings.get(["flip_v"]),
-                    "rotate": self._settings.get(["rotate"]),
+                    "flip_h": snapshot.flip_h,
+                    "flip_v": snapshot.flip_v,
+                    "rotate": snapshot.rotate,
                 },
             }
             if self._printer.connected():
-                printer_data = self._printer.get_data()
-                data.update(printer_data)
+                data.update(snapshot.get_data())
             if extra_data:
                 data.update(extra_data)
             return data
@@ -374,18 +431,10 @@ class MattaCore:
         if token == "":
             status_text = "Please enter a token."
             return success, status_text
-        self._settings.set(["auth_token"], token, force=True)
-        self._settings.save()
+        config.set("auth_token", token)
         try:
-            headers = generate_auth_headers(token)
-            resp = requests.get(
-                url=full_url,
-                headers=headers,
-                timeout=5,
-            )
+            resp = http.get(full_url, token=token, timeout=5)
             if resp.status_code == 200:
-                self._settings.set(["auth_token"], token, force=True)
-                self._settings.save()
                 if self.ws_connected():
                     self.ws.disconnect()
                 status_text = "All is tickety boo! Your token is valid."
@@ -420,22 +469,18 @@ class MattaCore:
         if url == "":
             status_text = "Please enter a URL."
             return success, status_text, image
-        self._settings.set(["snapshot_url"], url.strip(), force=True)
-        self._settings.save()
-        try:
-            resp = requests.get(
-                self._settings.get(["snapshot_url"]), stream=True
-            )  # Add a timeout
-        except requests.exceptions.RequestException as e:
-            self._logger.info("Error when sending request: %s", e)
-            status_text = "Error when sending request: " + str(e)
-            return success, status_text, image
-        if resp.status_code == 200:
+        config.set("snapshot_url", url.strip())
+        camera = self._printer.camera
+        # a user-triggered test goes ahead even while frame captures are backing off
+        image = camera.fetch(config.current.snapshot_url, force=True)
+        if image is not None:
             success = True
-            image = resp.content
             status_text = "Image captured successfully."
+            # the URL works now, so stop holding back frame captures
+            camera.reset()
         else:
-            status_text = "Error: received status code " + str(resp.status_code)
+            self._logger.info("Error when taking snapshot: %s", camera.last_error)
+            status_text = "Error: " + str(camera.last_error)
         return success, status_text, image
 
     def websocket_thread_loop(self):
@@ -445,22 +490,17 @@ class MattaCore:
         This method continuously sends data while the WebSocket connection is active.
 
         """
-        old_time = time.perf_counter()
-        time_buffer = 0.0
         while True:
             try:
                 self.ws_connect()
                 while self.ws_connected():
-                    current_time = time.perf_counter()
-                    if (current_time - old_time) > self.ws_loop_time - time_buffer:
-                        time_buffer = max(
-                            0, current_time - old_time - self.ws_loop_time
-                        )
-                        old_time = current_time
+                    if self.ws_schedule.due():
+                        self.ws_schedule.tick()
                         msg = self.ws_data()
                         self.ws.send_msg(msg)
-                    time.sleep(0.1)  # slow things down to 100ms
                     self.update_ws_send_interval()
+                    # wake at least every second to notice a dropped connection
+                    self.ws_schedule.wait(max_wait=1.0)
             except Exception as e:
                 self._logger.info("ERROR websocket_thread_loop: %s", e)
                 if self.ws_connected():
@@ -493,8 +533,8 @@ class MattaCore:
         }
         headers = {"Content-Type": "application/json"}
         try:
-            resp = requests.post(
-                self._settings.get(["webrtc_url"]),
+            resp = http.post(
+                config.current.webrtc_url,
                 json=params,
                 headers=headers,
                 timeout=5,
@@ -528,8 +568,8 @@ class MattaCore:
         }
         headers = {"Content-Type": "application/json"}
         try:
-            resp = requests.post(
-                self._settings.get(["webrtc_url"]),
+            resp = http.post(
+                config.current.webrtc_url,
                 json=params,
                 headers=headers,
                 timeout=5,
@@ -563,8 +603,8 @@ class MattaCore:
         }
         headers = {"Content-Type": "application/json"}
         try:
-            resp = requests.post(
-                self._settings.get(["webrtc_url"]),
+            resp = http.post(
+                config.current.webrtc_url,
                 json=params,
                 headers=headers,
                 timeout=5,
@@ -0,0 +1,280 @@
+'''
+This module holds the plugin's metrics registry: counters, gauges and
+fixed-bucket histograms for the cost of the G-code hooks, upload latency,
+WebSocket send time, queue depths and frame sizes.
+
+Metrics are created once, when their module loads, and updated from hot
+paths such as the comm thread's G-code hooks, so an update takes no lock.
+Under the GIL a racing update can at worst be lost, which is fine for
+monitoring. Only creating a metric and reading the registry take the lock.
+
+The registry is read through the "metrics" API command, in summary form in
+ws_data, and in the Prometheus text format.
+'''
+import time
+import threading
+from bisect import bisect_left
+
+# histogram bucket upper bounds, in seconds or bytes
+HOOK_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+SEND_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 120.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def format_labels(labels, extra=None):
+    """Formats labels as Prometheus does, {name="value",...}, or "" without any"""
+    items = list(labels) + list(extra or ())
+    if not items:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in items
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A value that only goes up, like the number of lines seen"""
+
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def summary(self):
+        return self.value
+
+    def samples(self, name, labels):
+        return [(name, format_labels(labels), self.value)]
+
+
+class Gauge:
+    """
+    A value that goes up and down, like a queue depth. A gauge given a
+    function reads it when the registry is read instead of being set.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        self._value += amount
+
+    def dec(self, amount=1):
+        self._value -= amount
+
+    @property
+    def value(self):
+        if self.fn is None:
+            return self._value
+        try:
+            return self.fn()
+        except Exception:
+            return None
+
+    def summary(self):
+        return self.value
+
+    def samples(self, name, labels):
+        value = self.value
+        if value is None:
+            return []
+        return [(name, format_labels(labels), value)]
+
+
+class Histogram:
+    """Counts observations into fixed buckets, and keeps their sum and maximum"""
+
+    kind = "histogram"
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in.
+
+        Returns:
+            float: The estimate, the maximum if it falls past the last bucket,
+                None without observations.
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self):
+        count = self.count
+        return {
+            "count": count,
+            "mean": self.sum / count if count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max if count else None,
+        }
+
+    def samples(self, name, labels):
+        counts = list(self.counts)
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            samples.append(
+                (f"{name}_bucket", format_labels(labels, [("le", format_value(bound))]), cumulative)
+            )
+        samples.append((f"{name}_sum", format_labels(labels), self.sum))
+        samples.append((f"{name}_count", format_labels(labels), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Holds every metric by name and labels. Asking for a metric that already
+    exists returns it, so modules can declare the metrics they update at
+    import time without coordinating.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}  # name -> (kind, help)
+        self._metrics = {}  # (name, labels) -> metric
+        self.started = time.time()
+
+    def _get(self, kind, name, help, labels, make):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                self._families[name] = (kind, help)
+            elif family[0] != kind:
+                raise ValueError(f"metric {name} is a {family[0]}, not a {kind}")
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = make()
+            return metric
+
+    def counter(self, name, help="", labels=None):
+        """
+        Returns the counter with the given name and labels, creating it if needed.
+
+        Args:
+            name (str): The metric name, in Prometheus style (matta_..._total).
+            help (str): What the metric counts.
+            labels (dict): Label names to values, for one series of the metric.
+        """
+        return self._get("counter", name, help, labels, Counter)
+
+    def gauge(self, name, help="", labels=None, fn=None):
+        """Returns the gauge with the given name and labels, see counter. fn reads its value."""
+        gauge = self._get("gauge", name, help, labels, lambda: Gauge(fn))
+        if fn is not None:
+            gauge.fn = fn  # the latest owner, e.g. after the subsystem was rebuilt
+        return gauge
+
+    def histogram(self, name, help="", labels=None, buckets=REQUEST_BUCKETS):
+        """Returns the histogram with the given name and labels, see counter"""
+        return self._get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._metrics.items()), dict(self._families)
+
+    def summary(self):
+        """
+        Returns every metric in a compact form for ws_data.
+
+        Returns:
+            dict: The value of each counter and gauge, and the count, mean, p50,
+                p95 and max of each histogram, keyed by name and labels.
+        """
+        items, _ = self._items()
+        return {
+            name + format_labels(labels): metric.summary()
+            for (name, labels), metric in items
+        }
+
+    def to_dict(self):
+        """Returns every metric with its type and help, and the histogram buckets"""
+        items, families = self._items()
+        result = {}
+        for (name, labels), metric in items:
+            entry = {"type": metric.kind, "help": families[name][1], "value": metric.summary()}
+            if metric.kind == "histogram":
+                entry["buckets"] = dict(
+                    zip([format_value(bound) for bound in metric.buckets + (float("inf"),)], metric.counts)
+                )
+            result[name + format_labels(labels)] = entry
+        return {"started": self.started, "metrics": result}
+
+    def prometheus(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        items, families = self._items()
+        lines = []
+        current = None
+        for (name, labels), metric in items:
+            if name != current:
+                current = name
+                kind, help = families[name]
+                if help:
+                    lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+            for sample, label_text, value in metric.samples(name, labels):
+                lines.append(f"{sample}{label_text} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def record_upload(endpoint, seconds, ok):
+    """
+    Records one upload to the backend.
+
+    Args:
+        endpoint (str): The last part of the endpoint path, e.g. "new-image".
+        seconds (float): How long the request took.
+        ok (bool): Whether the backend took it.
+    """
+    metrics.histogram(
+        "matta_upload_seconds", "Time taken by uploads to the backend", {"endpoint": endpoint}
+    ).observe(seconds)
+    metrics.counter(
+        "matta_uploads_total",
+        "Uploads to the backend by result",
+        {"endpoint": endpoint, "result": "ok" if ok else "failed"},
+    ).inc()
+
+
+# shared by the whole plugin, so every subsystem reports into one registry
+metrics = MetricsRegistry()
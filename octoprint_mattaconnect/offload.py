@@ -0,0 +1,283 @@
+'''
+This module moves CPU-heavy work (PIL frame transforms and the first-layer
+G-code scan) into a small pool of worker processes, so it does not hold
+OctoPrint's GIL while the comm thread is streaming to the printer.
+
+Frames are handed to the workers through shared memory rather than pickled
+through the pool's pipe. With no workers configured, on Python before 3.8
+(which has no shared memory), or if the pool breaks or a task times out, the
+same functions run in-process.
+
+No workers are configured by default: measured on a single-CPU host, moving
+frame transforms to a worker made the comm thread's wake-up lateness worse
+(p99 0.10 to 0.16 ms, max 3.8 to 4.1 ms), and each worker imports the whole
+plugin package, OctoPrint and Flask included, to run its tasks.
+'''
+import io
+import re
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8, tasks then run in-process
+    shared_memory = None
+
+OFFLOAD_WORKERS = 0
+OFFLOAD_TIMEOUT = 60.0  # seconds to wait for a worker before giving up on a task
+Z_REGEX = re.compile(r"Z(-?\d*\.?\d+)")
+
+
+class FrameDecodeError(Exception):
+    """Raised when a frame is not an image PIL can decode"""
+
+
+def transform_frame(data, flip_h, flip_v, rotate, scale=1.0):
+    """
+    Applies the webcam transforms to a frame and encodes it as PNG.
+
+    Args:
+        data (bytes): The frame as received from the camera.
+        flip_h (bool): Flip horizontally.
+        flip_v (bool): Flip vertically.
+        rotate (bool): Rotate by 90 degrees.
+        scale (float): Scale to resize the frame to, 1.0 to keep its size.
+
+    Returns:
+        bytes: The PNG encoded frame.
+
+    Raises:
+        FrameDecodeError: If the frame cannot be decoded.
+    """
+    # imported here so loading the plugin does not pay for PIL
+    from PIL import Image, UnidentifiedImageError
+
+    # Load the image using PIL
+    try:
+        pil_image = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError as e:
+        raise FrameDecodeError(str(e))
+    if scale < 1.0:
+        # draft lets the JPEG decoder skip detail instead of decoding it all first
+        size = (int(pil_image.width * scale), int(pil_image.height * scale))
+        pil_image.draft("RGB", size)
+        if pil_image.size != size:
+            pil_image = pil_image.resize(size)
+
+    # Flip the image if necessary
+    if flip_h:
+        pil_image = pil_image.transpose(Image.FLIP_LEFT_RIGHT)
+    if flip_v:
+        pil_image = pil_image.transpose(Image.FLIP_TOP_BOTTOM)
+    if rotate:
+        pil_image = pil_image.transpose(Image.ROTATE_90)
+
+    # Convert the PIL image back to bytes
+    byte_arr = io.BytesIO()
+    pil_image.save(byte_arr, format="PNG")
+    return byte_arr.getvalue()
+
+
+def transform_shared_frame(name, size, flip_h, flip_v, rotate, scale=1.0):
+    """Runs transform_frame on a frame the parent placed in shared memory"""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    return transform_frame(data, flip_h, flip_v, rotate, scale)
+
+
+def scan_first_layer(gcode_path):
+    """
+    Finds where the first layer ends in a G-code file.
+
+    The first layer starts at the first run of extruding lines (8 of them
+    within a window of 10 to 19 non-comment lines) and ends at the next Z
+    change after that.
+
+    Args:
+        gcode_path (str): The path to the G-code file.
+
+    Returns:
+        dict: The start line, start Z and end line of the first layer, each None
+        if not found, and the counts of extruding lines and Z changes.
+    """
+    e_lines = []
+    z_change_lines = []
+    with open(gcode_path, "r") as gcode:
+        i = 0
+        for line in gcode:
+            if line.startswith(";") or line == "\n":
+                continue
+            i += 1
+            if "E" in line:
+                e_lines.append(i)
+            if "Z" in line:
+                z_change = Z_REGEX.search(line)
+                if z_change:
+                    z_change_lines.append((i, float(z_change.group(1))))
+
+    first_layer_start_line = None
+    for threshold in range(10, 20, 1):
+        for i in range(len(e_lines) - 8):
+            if e_lines[i + 8] - e_lines[i] < threshold:
+                first_layer_start_line = e_lines[i]
+                break
+        if first_layer_start_line is not None:
+            break
+
+    first_layer_start_z = None
+    first_layer_end_line = None
+    if first_layer_start_line is not None:
+        for line_num, z in z_change_lines:
+            if line_num > first_layer_start_line:
+                first_layer_end_line = line_num
+                break
+            first_layer_start_z = z
+
+    return {
+        "start_line": first_layer_start_line,
+        "start_z": first_layer_start_z,
+        "end_line": first_layer_end_line,
+        "e_lines": len(e_lines),
+        "z_changes": len(z_change_lines),
+        "first_z_changes": z_change_lines[:20],
+    }
+
+
+class OffloadPool:
+    """
+    Runs CPU-heavy tasks in worker processes, falling back to running them
+    in-process when no workers are configured or the pool has broken.
+
+    The pool is started on first use, with the forkserver start method where
+    available, since forking OctoPrint's multi-threaded process is unsafe.
+    """
+
+    def __init__(self, workers=OFFLOAD_WORKERS, logger=None):
+        self.workers = int(workers or 0)
+        self._logger = logger
+        if self.workers > 0 and shared_memory is None:
+            if logger:
+                logger.warning("Offloading needs Python 3.8 or later, running tasks in-process.")
+            self.workers = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self.offloaded = 0
+        self.inline = 0
+        self.errors = 0
+        self.busy_time = 0.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None and self.workers > 0:
+                methods = multiprocessing.get_all_start_methods()
+                method = "forkserver" if "forkserver" in methods else "spawn"
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(method),
+                )
+            return self._executor
+
+    def _discard(self, executor):
+        """Drops a pool and kills its workers, so a stuck task cannot hold up later ones"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        # shutdown forgets the worker processes, so take them first
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        try:
+            executor.shutdown(wait=False, cancel_futures=True)
+        except TypeError:  # Python < 3.9
+            executor.shutdown(wait=False)
+        for process in processes:
+            try:
+                process.terminate()
+            except Exception:
+                pass
+
+    def _run(self, fn, *args, inline=None):
+        """
+        Runs fn(*args) in a worker, or inline() in this process if there is no pool.
+
+        Args:
+            fn: The task, a module-level function so it can be pickled.
+            inline: The in-process equivalent, by default fn(*args).
+
+        Returns:
+            The return value of the task.
+        """
+        inline = inline or (lambda: fn(*args))
+        started = time.perf_counter()
+        executor = self._get_executor()
+        if executor is not None:
+            try:
+                result = executor.submit(fn, *args).result(timeout=OFFLOAD_TIMEOUT)
+                self.offloaded += 1
+                self.busy_time += time.perf_counter() - started
+                return result
+            except BrokenProcessPool as e:
+                self.errors += 1
+                if self._logger:
+                    self._logger.error(f"Offload pool broke, restarting it: {e}")
+                self._discard(executor)
+            except FutureTimeoutError:
+                self.errors += 1
+                if self._logger:
+                    self._logger.error(
+                        f"Offloaded task took over {OFFLOAD_TIMEOUT}s, restarting the pool and running it in-process."
+                    )
+                self._discard(executor)
+        self.inline += 1
+        return inline()
+
+    def transform_frame(self, data, flip_h, flip_v, rotate, scale=1.0):
+        """
+        Applies the webcam transforms to a frame and encodes it as PNG.
+
+        Returns:
+            bytes: The PNG encoded frame.
+        """
+        if self.workers <= 0:
+            return self._run(transform_frame, data, flip_h, flip_v, rotate, scale)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        try:
+            shm.buf[: len(data)] = data
+            return self._run(
+                transform_shared_frame,
+                shm.name,
+                len(data),
+                flip_h,
+                flip_v,
+                rotate,
+                scale,
+                inline=lambda: transform_frame(data, flip_h, flip_v, rotate, scale),
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def scan_first_layer(self, gcode_path):
+        """Finds where the first layer ends in a G-code file, see scan_first_layer"""
+        return self._run(scan_first_layer, gcode_path)
+
+    def close(self):
+        with self._lock:
+            executor = self._executor
+        if executor is not None:
+            self._discard(executor)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "offloaded": self.offloaded,
+            "inline": self.inline,
+            "errors": self.errors,
+            "mean_offload_ms": (
+                round(self.busy_time / self.offloaded * 1000, 1) if self.offloaded else None
+            ),
+        }
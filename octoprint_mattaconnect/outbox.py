@@ -0,0 +1,405 @@
+'''
+This module holds the durable upload outbox for job lifecycle calls
+(start-job, first-layer-upload, live-upload, end-job).
+
+Each call is written to disk under MATTA_TMP_DATA_DIR/outbox before it is
+sent, together with hard links (or copies) of the files it uploads, so it
+survives restarts and the job directory being removed. Background workers
+drain the outbox in order per job with exponential backoff, and every call
+carries an idempotency key so the server can drop duplicate deliveries.
+
+Entries are ordered by a sequence number that carries on from the highest one
+on disk, rather than by the clock, which can step back on boards without a
+real-time clock. An upload that is not ready yet can reserve its place in the
+order, which holds back the later entries of its job until it is queued.
+Requests the backend rejects outright are moved to the dead
+letter directory at once, so they do not hold up the rest of their job.
+'''
+import os
+import json
+import time
+import uuid
+import random
+import shutil
+import threading
+import requests
+
+from .client import http
+from .breaker import CircuitOpenError
+from .governor import resources, GOVERNOR_INTERVAL
+from .config import config
+from .metrics import metrics, record_upload
+from .utils import get_api_url, MATTA_TMP_DATA_DIR
+
+OUTBOX_DIR = os.path.join(MATTA_TMP_DATA_DIR, "outbox")
+OUTBOX_WORKERS = 2
+OUTBOX_MAX_ATTEMPTS = 50
+OUTBOX_BASE_BACKOFF = 2.0  # seconds
+OUTBOX_MAX_BACKOFF = 300.0  # seconds
+# responses after which resending the same request cannot succeed
+OUTBOX_FINAL_STATUS = (409,)  # already received (idempotency key seen before)
+# client errors worth retrying, every other 4xx rejects the request for good
+OUTBOX_RETRY_STATUS = (408, 429)
+# bandwidth traffic class by endpoint, anything else is a bulk file transfer
+OUTBOX_TRAFFIC = {"first-layer-upload": "telemetry", "live-upload": "telemetry"}
+# telemetry the resource governor may hold back under pressure
+OUTBOX_NON_CRITICAL = ("live-upload",)
+
+
+class Outbox:
+    """Disk-backed queue of backend uploads, drained by background workers"""
+
+    def __init__(self, settings, logger, outbox_dir=OUTBOX_DIR, workers=OUTBOX_WORKERS):
+        self._settings = settings
+        self._logger = logger
+        self._dir = outbox_dir
+        self._dead_dir = os.path.join(outbox_dir, "dead")
+        self._condition = threading.Condition()
+        self._entries = []  # pending entries, in enqueue order
+        self._in_flight = {}  # group -> the entry being sent
+        self.listeners = []
+        self._seq = 0  # the last sequence number handed out
+        self._reserved = {}  # group -> sequence numbers reserved but not queued yet
+        self.sent = 0
+        self.failures = 0
+        metrics.gauge(
+            "matta_outbox_depth", "Uploads waiting in the outbox", fn=lambda: len(self._entries)
+        )
+        os.makedirs(self._dead_dir, exist_ok=True)
+        self._load()
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"matta-outbox-{i}")
+            worker.daemon = True
+            worker.start()
+
+    def _load(self):
+        """Picks up entries left over from before a restart"""
+        for name in sorted(os.listdir(self._dir)):
+            path = os.path.join(self._dir, name)
+            if name == "dead" or not os.path.isdir(path):
+                continue
+            if name.startswith("tmp-"):
+                shutil.rmtree(path, ignore_errors=True)  # never finished enqueueing
+                continue
+            try:
+                with open(os.path.join(path, "entry.json"), "r") as file:
+                    entry = json.load(file)
+            except (OSError, ValueError) as e:
+                self._logger.error(f"Dropping unreadable outbox entry {name}: {e}")
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            entry["next_attempt"] = 0.0  # retry straight away after a restart
+            self._entries.append(entry)
+            self._seq = max(self._seq, entry["seq"])
+        self._entries.sort(key=lambda entry: entry["seq"])
+        if self._entries:
+            self._logger.info(f"Outbox resumed with {len(self._entries)} pending uploads.")
+
+    def add_listener(self, listener):
+        """
+        Registers listener(entry) to be called when an entry is moved to the dead
+        letters. It is called with the outbox lock held, so it has to be quick.
+        """
+        self.listeners.append(listener)
+
+    def withdraw(self, group, endpoint):
+        """
+        Drops a group's pending entries to an endpoint, for uploads the sender
+        will make another way. An entry being sent cannot be stopped, it is
+        dropped instead of retried if the attempt fails.
+
+        Args:
+            group (str): The group of the entries.
+            endpoint (str): The endpoint of the entries.
+
+        Returns:
+            list: The withdrawn entries, including one being sent, whose delivery
+                is then not known.
+        """
+        with self._condition:
+            withdrawn = [
+                entry
+                for entry in self._entries
+                if entry["group"] == group and entry["endpoint"] == endpoint
+            ]
+            for entry in withdrawn:
+                if self._in_flight.get(group) is entry:
+                    entry["withdrawn"] = True
+                else:
+                    self._entries.remove(entry)
+            self._condition.notify_all()
+        for entry in withdrawn:
+            if not entry.get("withdrawn"):
+                shutil.rmtree(os.path.join(self._dir, entry["name"]), ignore_errors=True)
+        return withdrawn
+
+    def reserve(self, group):
+        """
+        Reserves a place in the order for an upload that is queued later. The
+        group's later entries are not sent until it is queued or released.
+
+        Args:
+            group (str): The group of the upload.
+
+        Returns:
+            int: The sequence number to pass to enqueue.
+        """
+        with self._condition:
+            self._seq += 1
+            self._reserved.setdefault(group, set()).add(self._seq)
+            return self._seq
+
+    def release(self, group, seq):
+        """Gives up a reservation, letting the group's later entries go"""
+        with self._condition:
+            self._release(group, seq)
+            self._condition.notify_all()
+
+    def _release(self, group, seq):
+        """Must be called with the lock held"""
+        reserved = self._reserved.get(group)
+        if reserved is not None:
+            reserved.discard(seq)
+            if not reserved:
+                del self._reserved[group]
+
+    def enqueue(self, endpoint, data, group, files=None, seq=None):
+        """
+        Durably queues a POST to the backend.
+
+        Args:
+            endpoint (str): The API endpoint, relative to the API URL.
+            data (dict): Form fields to send.
+            group (str): Entries of the same group (the job) are sent in order.
+            files (dict): Form files as {field: (filename, source, content_type)},
+                where source is either a path to link or copy, or bytes.
+            seq (int): A sequence number from reserve, to take the reserved place.
+
+        Returns:
+            str: The idempotency key of the queued entry.
+        """
+        key = uuid.uuid4().hex
+        if seq is None:
+            with self._condition:
+                self._seq += 1
+                seq = self._seq
+        name = f"{seq:012d}-{key}"
+        tmp_path = os.path.join(self._dir, f"tmp-{name}")
+        os.makedirs(tmp_path)
+        stored_files = {}
+        for i, (field, (filename, source, content_type)) in enumerate((files or {}).items()):
+            blob = f"file_{i}"
+            blob_path = os.path.join(tmp_path, blob)
+            if isinstance(source, (bytes, bytearray)):
+                with open(blob_path, "wb") as file:
+                    file.write(source)
+            else:
+                try:
+                    os.link(source, blob_path)
+                except OSError:
+                    shutil.copyfile(source, blob_path)
+            stored_files[field] = [filename, blob, content_type]
+        entry = {
+            "name": name,
+            "seq": seq,
+            "group": group,
+            "endpoint": endpoint,
+            "data": data,
+            "files": stored_files,
+            "idempotency_key": key,
+            "attempts": 0,
+            "created": time.time(),
+            "next_attempt": 0.0,
+            "last_error": None,
+        }
+        self._write_entry(tmp_path, entry)
+        os.replace(tmp_path, os.path.join(self._dir, name))
+        with self._condition:
+            # usually the end, earlier only when taking a reserved place
+            index = len(self._entries)
+            while index and self._entries[index - 1]["seq"] > seq:
+                index -= 1
+            self._entries.insert(index, entry)
+            self._release(group, seq)
+            self._condition.notify_all()
+        return key
+
+    def _write_entry(self, path, entry):
+        tmp_file = os.path.join(path, "entry.json.tmp")
+        with open(tmp_file, "w") as file:
+            json.dump(entry, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, os.path.join(path, "entry.json"))
+
+    def _next_entry(self):
+        """
+        Returns the first due entry at the head of its group, and how long to wait
+        if none is due. Must be called with the lock held.
+        """
+        now = time.time()
+        wait = None
+        blocked = set(self._in_flight)
+        for entry in self._entries:
+            group = entry["group"]
+            if group in blocked:
+                continue
+            blocked.add(group)  # later entries of this group wait for this one
+            if entry["seq"] > min(self._reserved.get(group, (entry["seq"],))):
+                continue  # and all of them for an upload reserved before it
+            if entry["next_attempt"] <= now:
+                return entry, None
+            delay = entry["next_attempt"] - now
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                entry, wait = self._next_entry()
+                while entry is None:
+                    self._condition.wait(wait)
+                    entry, wait = self._next_entry()
+                self._in_flight[entry["group"]] = entry
+            deferred = None
+            try:
+                if self._held(entry):
+                    done, deferred = False, GOVERNOR_INTERVAL
+                else:
+                    done, error, retry = self._send(entry)
+            except CircuitOpenError as e:
+                done, deferred = False, e.retry_after
+            except Exception as e:
+                done, error, retry = False, str(e), True
+            with self._condition:
+                self._in_flight.pop(entry["group"], None)
+                if done:
+                    self._entries.remove(entry)
+                    self.sent += 1
+                elif entry.get("withdrawn"):
+                    self._entries.remove(entry)
+                elif deferred is not None:
+                    # shed while the endpoint's breaker is open or the resource governor
+                    # holds it back, without using up an attempt
+                    entry["next_attempt"] = time.time() + deferred
+                elif not retry:
+                    self.failures += 1
+                    self._logger.error(
+                        f"Backend rejected {entry['endpoint']} for {entry['group']}: {error}"
+                    )
+                    self._bury(entry, error)
+                else:
+                    self._retry_later(entry, error)
+                self._condition.notify_all()
+            if done or entry.get("withdrawn"):
+                shutil.rmtree(os.path.join(self._dir, entry["name"]), ignore_errors=True)
+
+    def _retry_later(self, entry, error):
+        """Schedules the next attempt with exponential backoff. Must be called with the lock held."""
+        self.failures += 1
+        entry["attempts"] += 1
+        entry["last_error"] = error
+        path = os.path.join(self._dir, entry["name"])
+        if entry["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            self._logger.error(
+                f"Giving up on {entry['endpoint']} for {entry['group']} after "
+                f"{entry['attempts']} attempts: {error}"
+            )
+            self._bury(entry, error)
+            return
+        backoff = min(OUTBOX_MAX_BACKOFF, OUTBOX_BASE_BACKOFF * 2 ** (entry["attempts"] - 1))
+        entry["next_attempt"] = time.time() + backoff * random.uniform(0.8, 1.2)
+        self._logger.info(
+            f"Upload to {entry['endpoint']} failed ({error}), retrying in {backoff:.0f}s."
+        )
+        try:
+            self._write_entry(path, entry)
+        except OSError as e:
+            self._logger.error(f"Failed to update outbox entry: {e}")
+
+    def _bury(self, entry, error):
+        """Moves an entry that will not be sent to the dead letter directory. Must be called with the lock held."""
+        entry["last_error"] = error
+        path = os.path.join(self._dir, entry["name"])
+        self._entries.remove(entry)
+        try:
+            self._write_entry(path, entry)
+            shutil.move(path, os.path.join(self._dead_dir, entry["name"]))
+        except OSError as e:
+            self._logger.error(f"Failed to move outbox entry to dead letters: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+        for listener in self.listeners:
+            try:
+                listener(entry)
+            except Exception as e:
+                self._logger.error(f"Outbox listener failed: {e}")
+
+    @staticmethod
+    def _held(entry):
+        """Checks if the resource governor is holding back entries like this one"""
+        name = entry["endpoint"].rsplit("/", 1)[-1]
+        if OUTBOX_TRAFFIC.get(name, "bulk") == "bulk":
+            return not resources.allows_bulk()
+        return name in OUTBOX_NON_CRITICAL and not resources.allows_telemetry()
+
+    def _send(self, entry):
+        """
+        Sends one entry.
+
+        Returns:
+            tuple: Whether the entry is done with, the error if it is not, and
+                whether sending it again could succeed.
+        """
+        path = os.path.join(self._dir, entry["name"])
+        name = entry["endpoint"].rsplit("/", 1)[-1]
+        headers = http.auth_headers(config.current.auth_token)
+        headers["Idempotency-Key"] = entry["idempotency_key"]
+        opened = []
+        started = time.perf_counter()
+        try:
+            files = {}
+            for field, (filename, blob, content_type) in entry["files"].items():
+                file = open(os.path.join(path, blob), "rb")
+                opened.append(file)
+                files[field] = (filename, file, content_type)
+            resp = http.post(
+                get_api_url() + entry["endpoint"],
+                data=entry["data"],
+                files=files or None,
+                headers=headers,
+                timeout=(10, 120),
+                breaker=name,
+                traffic=OUTBOX_TRAFFIC.get(name, "bulk"),
+            )
+        except CircuitOpenError:
+            raise
+        except requests.exceptions.RequestException as e:
+            record_upload(name, time.perf_counter() - started, False)
+            return False, str(e), True
+        finally:
+            for file in opened:
+                file.close()
+        done = resp.ok or resp.status_code in OUTBOX_FINAL_STATUS
+        record_upload(name, time.perf_counter() - started, done)
+        if done:
+            return True, None, False
+        retry = resp.status_code < 400 or resp.status_code >= 500 or resp.status_code in OUTBOX_RETRY_STATUS
+        return False, f"status code {resp.status_code}", retry
+
+    def stats(self):
+        """
+        Returns the outbox depth and age for reporting.
+
+        Returns:
+            dict: Pending entry count, age of the oldest entry in seconds, and counters.
+        """
+        with self._condition:
+            oldest = min((entry["created"] for entry in self._entries), default=None)
+            return {
+                "depth": len(self._entries),
+                "oldest_age": None if oldest is None else round(time.time() - oldest, 1),
+                "in_flight": len(self._in_flight),
+                "sent": self.sent,
+                "failures": self.failures,
+                "dead": len(os.listdir(self._dead_dir)),
+            }
@@ -0,0 +1,282 @@
+'''
+This module holds the adaptive sampling policy. It picks frame and telemetry
+periods from the phase of the print, shortens them for a while when the
+on-device detectors see something worth a closer look, and keeps the result
+within the configured bandwidth and CPU budget.
+'''
+import time
+
+from .utils import SAMPLING_TIMEOUT
+
+# (frame period, telemetry period) in seconds for each phase of a print
+PHASE_PERIODS = {
+    "heat_up": (5.0, 1.0),
+    "first_layer": (0.75, 0.5),
+    "body": (2.5, 1.25),
+    "idle": (10.0, 5.0),
+}
+# Periods used while a boost is active
+BOOST_PERIODS = (0.75, 0.5)
+# Periods are rounded to this step so small budget changes do not reschedule
+PERIOD_STEP = 0.05
+MAX_PERIOD = 30.0
+# A heater counts as heating up until it is within this many degrees of its target
+HEAT_UP_MARGIN = 5.0
+IDLE_STATES = ("Paused", "Pausing", "Resuming")
+
+
+class EwmaDeviationDetector:
+    """
+    Flags readings that leave the band the recent readings have settled in.
+
+    The detector follows the error between a heater's actual and target
+    temperature with an exponentially weighted mean and variance, and flags
+    a reading when it is further than `threshold` standard deviations (and at
+    least `min_delta` degrees) from the mean. A new target restarts it.
+    """
+
+    def __init__(self, alpha=0.1, threshold=4.0, min_delta=2.0, warmup=10):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_delta = min_delta
+        self.warmup = warmup
+        self.triggered = 0
+        self.reset()
+
+    def reset(self, target=None):
+        self.target = target
+        self.mean = 0.0
+        self.var = 0.0
+        self.samples = 0
+
+    def update(self, actual, target):
+        """
+        Adds one reading.
+
+        Args:
+            actual (float): The measured temperature.
+            target (float): The target temperature.
+
+        Returns:
+            bool: True if the reading is anomalous.
+        """
+        if actual is None or not target:
+            self.reset()
+            return False
+        if target != self.target:
+            self.reset(target)
+        error = actual - target
+        deviation = error - self.mean
+        anomalous = (
+            self.samples >= self.warmup
+            and abs(deviation) >= self.min_delta
+            and deviation * deviation > self.threshold * self.threshold * self.var
+        )
+        if anomalous:
+            self.triggered += 1
+        else:
+            # anomalies are kept out of the baseline so a drift keeps triggering
+            self.mean += self.alpha * deviation
+            self.var = (1 - self.alpha) * (self.var + self.alpha * deviation * deviation)
+            self.samples += 1
+        return anomalous
+
+    def to_dict(self):
+        return {
+            "mean_error": round(self.mean, 2),
+            "std_error": round(self.var**0.5, 2),
+            "samples": self.samples,
+            "triggered": self.triggered,
+        }
+
+
+class SamplingPolicy:
+    """
+    Decides the frame and telemetry periods for the data thread.
+
+    The periods come from the print phase, are shortened while a boost is
+    active, and are then lengthened as far as needed to keep the average frame
+    upload within `frame_kbps` and the CPU time the data thread spends sampling
+    within `cpu_percent` of the wall clock. Time spent waiting on the camera or
+    the network is not CPU time, slow links are left to the bandwidth budget.
+    Like every *_kbps setting of the plugin, `frame_kbps` is in KiB per second.
+    """
+
+    def __init__(self, enabled=True, frame_kbps=256, cpu_percent=15, boost_duration=30.0):
+        self.detectors = {
+            "hotend": EwmaDeviationDetector(),
+            "bed": EwmaDeviationDetector(),
+        }
+        self.configure(enabled, frame_kbps, cpu_percent, boost_duration)
+        self.reset()
+
+    def configure(self, enabled, frame_kbps, cpu_percent, boost_duration):
+        """Applies the sampling settings"""
+        self.enabled = bool(enabled)
+        self.frame_kbps = float(frame_kbps)
+        self.cpu_percent = float(cpu_percent)
+        self.boost_duration = float(boost_duration)
+
+    def reset(self):
+        """Clears the per-job state, called when a print starts"""
+        self.phase = "heat_up"
+        self.heated = False
+        self.boost_until = 0.0
+        self.boost_reason = None
+        self.boosts = 0
+        self.last_rates = None
+        self.frame_bytes = None
+        self.frame_cost = None
+        self.telemetry_cost = None
+        for detector in self.detectors.values():
+            detector.reset()
+
+    @staticmethod
+    def _ewma(current, value, alpha=0.2):
+        return value if current is None else current + alpha * (value - current)
+
+    def record_frame(self, size, cost):
+        """
+        Records the upload size and processing cost of one frame.
+
+        Args:
+            size (int): The bytes uploaded for the frame, 0 if none was sent.
+            cost (float): The CPU seconds the data thread spent on it, from time.thread_time.
+        """
+        if size:
+            self.frame_bytes = self._ewma(self.frame_bytes, size)
+        self.frame_cost = self._ewma(self.frame_cost, cost)
+
+    def record_telemetry(self, cost):
+        """Records the CPU seconds spent writing one telemetry row"""
+        self.telemetry_cost = self._ewma(self.telemetry_cost, cost)
+
+    def boost(self, reason, now=None):
+        """Samples at the boost rate for the next boost_duration seconds"""
+        now = time.perf_counter() if now is None else now
+        if now >= self.boost_until:
+            self.boosts += 1
+        self.boost_until = now + self.boost_duration
+        self.boost_reason = reason
+
+    def detect_phase(self, snapshot, first_layer_end_line):
+        """
+        Works out the phase of the print from a snapshot.
+
+        Args:
+            snapshot (TelemetrySnapshot): The snapshot of the current tick.
+            first_layer_end_line (int): The G-code line the first layer ends at, if known.
+
+        Returns:
+            str: One of the PHASE_PERIODS keys.
+        """
+        if snapshot.state in IDLE_STATES:
+            return "idle"
+        # once at temperature, a drop is left to the detectors rather than
+        # treated as another heat-up
+        if not self.heated:
+            for actual, target in (
+                (snapshot.hotend_actual, snapshot.hotend_target),
+                (snapshot.bed_actual, snapshot.bed_target),
+            ):
+                if actual is not None and target and actual < target - HEAT_UP_MARGIN:
+                    return "heat_up"
+        if snapshot.layer is not None and snapshot.layer > 1:
+            return "body"
+        if first_layer_end_line is not None and snapshot.gcode_line_num is not None:
+            if int(snapshot.gcode_line_num) > first_layer_end_line:
+                return "body"
+        return "first_layer"
+
+    def observe(self, snapshot, first_layer_end_line=None, now=None):
+        """
+        Updates the phase and the detectors from the snapshot of the current tick.
+
+        Args:
+            snapshot (TelemetrySnapshot): The snapshot of the current tick.
+            first_layer_end_line (int): The G-code line the first layer ends at, if known.
+            now (float): The current time, from time.perf_counter.
+        """
+        now = time.perf_counter() if now is None else now
+        self.phase = self.detect_phase(snapshot, first_layer_end_line)
+        # heaters are allowed to drift while paused
+        if self.phase not in ("heat_up", "idle"):
+            self.heated = True
+            if self.detectors["hotend"].update(snapshot.hotend_actual, snapshot.hotend_target):
+                self.boost("hotend_deviation", now)
+            if self.detectors["bed"].update(snapshot.bed_actual, snapshot.bed_target):
+                self.boost("bed_deviation", now)
+        rates = (snapshot.flow_rate, snapshot.feed_rate)
+        if self.last_rates is not None and rates != self.last_rates:
+            self.boost("rate_change", now)
+        self.last_rates = rates
+
+    def boosted(self, now=None):
+        now = time.perf_counter() if now is None else now
+        return now < self.boost_until
+
+    def min_frame_period(self):
+        """
+        Returns the shortest frame period the bandwidth and CPU budgets allow,
+        whatever the phase, in seconds. Layer captures are held to it too.
+        """
+        if not self.enabled:
+            return 0.0
+        period = 0.0
+        if self.frame_bytes and self.frame_kbps > 0:
+            period = self.frame_bytes / (self.frame_kbps * 1024)
+        if self.frame_cost and self.cpu_percent > 0:
+            period = max(period, self.frame_cost / (self.cpu_percent / 100.0))
+        return period
+
+    def periods(self, now=None):
+        """
+        Returns the frame and telemetry periods to sample at now.
+
+        Returns:
+            tuple: The frame period and the telemetry period, in seconds.
+        """
+        if not self.enabled:
+            return SAMPLING_TIMEOUT, SAMPLING_TIMEOUT
+        frame_period, telemetry_period = PHASE_PERIODS[self.phase]
+        if self.boosted(now):
+            frame_period = min(frame_period, BOOST_PERIODS[0])
+            telemetry_period = min(telemetry_period, BOOST_PERIODS[1])
+
+        if self.frame_bytes and self.frame_kbps > 0:
+            frame_period = max(frame_period, self.frame_bytes / (self.frame_kbps * 1024))
+        if self.cpu_percent > 0:
+            # share the CPU budget between frames and telemetry in proportion to their cost
+            budget = self.cpu_percent / 100.0
+            frame_cost = self.frame_cost or 0.0
+            telemetry_cost = self.telemetry_cost or 0.0
+            load = frame_cost / frame_period + telemetry_cost / telemetry_period
+            if load > budget:
+                scale = load / budget
+                frame_period *= scale
+                telemetry_period *= scale
+
+        return self._round(frame_period), self._round(telemetry_period)
+
+    @staticmethod
+    def _round(period):
+        period = round(round(period / PERIOD_STEP) * PERIOD_STEP, 2)
+        return min(MAX_PERIOD, max(PERIOD_STEP, period))
+
+    def stats(self, now=None):
+        frame_period, telemetry_period = self.periods(now)
+        return {
+            "enabled": self.enabled,
+            "phase": self.phase,
+            "frame_period": frame_period,
+            "telemetry_period": telemetry_period,
+            "boosted": self.boosted(now),
+            "boost_reason": self.boost_reason,
+            "boosts": self.boosts,
+            "frame_bytes": None if self.frame_bytes is None else int(self.frame_bytes),
+            "frame_cost_ms": None if self.frame_cost is None else round(self.frame_cost * 1000, 1),
+            "telemetry_cost_ms": (
+                None if self.telemetry_cost is None else round(self.telemetry_cost * 1000, 2)
+            ),
+            "detectors": {name: d.to_dict() for name, d in self.detectors.items()},
+        }
@@ -0,0 +1,226 @@
+'''
+This module holds the local print queue. Upcoming jobs are sent over the
+websocket and their G-code is prefetched into the G-code cache while the
+current print runs, so the next print can start as soon as the bed is cleared.
+'''
+import os
+import json
+import itertools
+import threading
+
+from .worker import PRIORITY_BACKGROUND, PRIORITY_PRINT_NOW
+from .utils import download_file_from_url, MATTA_TMP_DATA_DIR
+from .config import config
+
+
+class PrintQueue:
+    """Local queue of upcoming print jobs managed from the cloud"""
+
+    def __init__(self, matta_printer, settings, logger):
+        self._printer = matta_printer
+        self._settings = settings
+        self._logger = logger
+        self._lock = threading.RLock()
+        self._path = os.path.join(MATTA_TMP_DATA_DIR, "print_queue.json")
+        self.entries = []
+        self._load()
+        self._ids = itertools.count(
+            max([entry["id"] for entry in self.entries], default=0) + 1
+        )
+        self.prefetch()
+
+    def _setting(self, key, default):
+        value = config.current.get(key)
+        return default if value is None else value
+
+    def _load(self):
+        try:
+            with open(self._path, "r") as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = []
+        for entry in self.entries:
+            # in-flight prefetches and starts did not survive the restart
+            if entry["state"] in ("prefetching", "starting"):
+                entry["state"] = "pending"
+
+    def _save(self):
+        try:
+            os.makedirs(MATTA_TMP_DATA_DIR, exist_ok=True)
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(self.entries, file)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            self._logger.error(f"Failed to save print queue: {e}")
+
+    def handle_cmd(self, queue_msg):
+        """
+        Handles a print queue command received over the websocket.
+
+        Args:
+            queue_msg (dict): The command, one of "add", "remove", "clear",
+                "move" or "start_next" plus its arguments.
+        """
+        cmd = queue_msg["cmd"]
+        if cmd == "add":
+            self.add(
+                queue_msg["file"],
+                queue_msg["url"],
+                loc=queue_msg.get("loc", "local"),
+                file_hash=queue_msg.get("hash"),
+            )
+        elif cmd == "remove":
+            self.remove(int(queue_msg["id"]))
+        elif cmd == "clear":
+            self.clear()
+        elif cmd == "move":
+            self.move(int(queue_msg["id"]), int(queue_msg["position"]))
+        elif cmd == "start_next":
+            self.start_next()
+
+    def add(self, file, url, loc="local", file_hash=None):
+        """Appends a job to the queue and starts prefetching if it is near the front"""
+        with self._lock:
+            entry = {
+                "id": next(self._ids),
+                "file": file,
+                "url": url,
+                "loc": loc,
+                "hash": file_hash,
+                "state": "pending",
+            }
+            self.entries.append(entry)
+            self._save()
+        self.prefetch()
+        return entry
+
+    def remove(self, entry_id):
+        with self._lock:
+            self.entries = [entry for entry in self.entries if entry["id"] != entry_id]
+            self._save()
+        self.prefetch()
+
+    def clear(self):
+        with self._lock:
+            self.entries = []
+            self._save()
+
+    def move(self, entry_id, position):
+        """Moves a queued job to a new position in the queue"""
+        with self._lock:
+            for i, entry in enumerate(self.entries):
+                if entry["id"] == entry_id:
+                    self.entries.insert(position, self.entries.pop(i))
+                    break
+            self._save()
+        self.prefetch()
+
+    def start_next(self):
+        """
+        Starts printing the job at the front of the queue. If it was prefetched the
+        file is linked out of the G-code cache, otherwise it is downloaded now.
+
+        The entry stays in the queue, marked "starting", until the download job
+        has put the file in place and selected it for printing. If the job fails
+        or is cancelled the entry goes back to pending and stays queued.
+
+        Returns:
+            dict: The starting queue entry, or None if the queue is empty, a job
+                is already starting or the printer cannot take a job right now.
+        """
+        if not self._printer.is_operational() or self._printer.has_job():
+            self._logger.info("Printer is busy or not operational, not starting the next queued job.")
+            return None
+        with self._lock:
+            if not self.entries or self.entries[0]["state"] == "starting":
+                return None
+            entry = self.entries[0]
+            previous_state = entry["state"]
+            entry["state"] = "starting"
+            self._save()
+        json_file = {
+            "file": entry["file"],
+            "url": entry["url"],
+            "loc": entry["loc"],
+            "hash": entry["hash"],
+            "print": True,
+        }
+        try:
+            self._printer.submit_download(
+                json_file,
+                priority=PRIORITY_PRINT_NOW,
+                on_finish=lambda job: self._on_start_finished(entry, job),
+            )
+        except Exception:
+            with self._lock:
+                entry["state"] = previous_state
+                self._save()
+            raise
+        return entry
+
+    def _on_start_finished(self, entry, job):
+        """Drops a started entry once its print is under way, or puts it back"""
+        with self._lock:
+            if job.state == "done":
+                self.entries = [other for other in self.entries if other is not entry]
+            else:
+                self._logger.info(f"Queued job {entry['file']} did not start: {job.error or job.state}")
+                entry["state"] = "pending"
+            self._save()
+        self.prefetch()
+
+    def prefetched_bytes(self):
+        """Returns the size of the ready queue entries held in the G-code cache"""
+        with self._lock:
+            hashes = {entry["hash"] for entry in self.entries if entry["state"] == "ready"}
+        return self._printer.gcode_cache.size_of(hashes)
+
+    def prefetch(self):
+        """Queues background downloads for the next few jobs that are not cached yet"""
+        count = int(self._setting("queue_prefetch_count", 2))
+        with self._lock:
+            for entry in self.entries[:count]:
+                if entry["state"] in ("prefetching", "ready", "starting"):
+                    continue
+                if self._printer.gcode_cache.has(entry["hash"]):
+                    entry["state"] = "ready"
+                    continue
+                entry["state"] = "prefetching"
+                self._printer.file_jobs.submit(
+                    "prefetch",
+                    self._prefetch_entry,
+                    entry,
+                    key=f"prefetch:{entry['hash'] or entry['url']}",
+                    priority=PRIORITY_BACKGROUND,
+                    description=entry["file"],
+                )
+            self._save()
+
+    def _prefetch_entry(self, job, entry):
+        """File job downloading a queued file into the G-code cache"""
+        disk_budget = int(self._setting("queue_prefetch_disk_mb", 512)) * 1024**2
+        try:
+            if self.prefetched_bytes() >= disk_budget:
+                self._logger.info(f"Prefetch disk budget reached, not prefetching {entry['file']}")
+                entry["state"] = "pending"
+                return
+            rate = int(self._setting("queue_prefetch_kbps", 1024)) * 1024
+            content = download_file_from_url(
+                entry["url"], job=job, max_bytes_per_sec=rate or None
+            )
+            job.check_cancelled()
+            entry["hash"] = self._printer.gcode_cache.put_bytes(
+                content.encode("utf-8"), expected_hash=entry["hash"]
+            )
+            entry["state"] = "ready"
+        except Exception:
+            entry["state"] = "failed"
+            raise
+        finally:
+            with self._lock:
+                self._save()
+
+    def to_dict(self):
+        with self._lock:
+            return {"entries": [dict(entry) for entry in self.entries]}
@@ -1,11 +1,103 @@
 import re
 import inspect
 import os
-from concurrent.futures import ThreadPoolExecutor
-
-from .worker import download_file_and_print, upload_file_to_backend
-from .utils import get_file_from_url, make_timestamp, post_file_to_backend_for_download, download_file_from_url
+import threading
+
+from .worker import (
+    FileJobScheduler,
+    download_file_and_print,
+    upload_file_to_backend,
+    delete_path,
+    PRIORITY_PRINT_NOW,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_BACKGROUND,
+)
+from .utils import (
+    get_file_from_url,
+    make_timestamp,
+    post_file_to_backend_for_download,
+    download_file_from_url,
+    get_gcode_cache_dir,
+    GCODE_CACHE_SIZE_MB,
+)
+from .cache import GcodeCache
+from .print_queue import PrintQueue
+from .capture import LayerCaptureTrigger
+from .gcode_trace import GcodeTrace
+from .snapshot import TelemetrySnapshot
+from .history import TelemetryHistory
+from .camera import CameraMonitor
+from .config import config
 from octoprint.filemanager import FileDestinations
+from octoprint.printer import PrinterCallback
+
+
+class PrinterStateCache(PrinterCallback):
+    """
+    Keeps a lock-protected copy of OctoPrint's printer state, updated from the
+    printer callbacks at the firmware report rate, so readers never have to
+    call into OctoPrint's printer internals.
+    """
+
+    def __init__(self, printer, on_temperature=None):
+        self._printer = printer
+        self.on_temperature = on_temperature
+        self._lock = threading.Lock()
+        self.state = None
+        self.temperatures = None
+        self.temperature_time = None
+        self.current_data = None
+        self.temperature_updates = 0
+
+    def on_printer_add_temperature(self, data):
+        with self._lock:
+            # merge so fields only known to get_current_temperatures (offsets) are kept
+            temperatures = dict(self.temperatures or {})
+            for heater, values in data.items():
+                if heater == "time":
+                    continue
+                merged = dict(temperatures.get(heater, {}))
+                merged.update(values)
+                temperatures[heater] = merged
+            self.temperatures = temperatures
+            self.temperature_time = data.get("time")
+            self.temperature_updates += 1
+        if self.on_temperature is not None:
+            self.on_temperature(temperatures, data.get("time"))
+
+    def on_printer_send_current_data(self, data):
+        with self._lock:
+            self.current_data = data
+            self.state = data.get("state", {}).get("text", self.state)
+
+    def on_printer_send_initial_data(self, data):
+        self.on_printer_send_current_data(data)
+        if data.get("temps"):
+            self.on_printer_add_temperature(data["temps"][-1])
+
+    def get(self):
+        """
+        Returns the latest state, polling OctoPrint only for values no callback
+        has delivered yet.
+
+        Returns:
+            tuple: The state string, temperatures and current data.
+        """
+        with self._lock:
+            state, temperatures, current_data = (
+                self.state,
+                self.temperatures,
+                self.current_data,
+            )
+        if state is None or current_data is None:
+            state = self._printer.get_state_string()
+            current_data = self._printer.get_current_data()
+        if temperatures is None:
+            temperatures = self._printer.get_current_temperatures()
+            with self._lock:
+                if self.temperatures is None:
+                    self.temperatures = temperatures
+        return state, temperatures, current_data
 
 
 class MattaPrinter:
@@ -16,8 +108,6 @@ class MattaPrinter:
         self._logger = logger
         self._file_manager = file_manager
         self._settings = settings
-        self.printing = False  # True when print job is running
-        self.finished = True  # True for loop when print job has just finished
 
         self.flow_rate = 100  # in percent
         self.feed_rate = 100  # in percent
@@ -25,14 +115,99 @@ class MattaPrinter:
         self.hotend_temp_offset = 0.0  # in degrees C
         self.bed_temp_offset = 0.0  # in degrees C
 
-        self.gcode_line_num_no_comments = 0
-        self.gcode_cmd = ""
+        # (line number, command) of the last sent file line, swapped as one tuple
+        self.gcode_position = (0, "")
+        self.latest_snapshot = None
+        self.layer_trigger = LayerCaptureTrigger()
+        self.gcode_trace = GcodeTrace()
+        self.camera = CameraMonitor(self._logger)
 
-        self.new_print_job = False
         self.current_job = None
 
-        # Initialize the ThreadPoolExecutor
-        self.executor = ThreadPoolExecutor()
+        # Printer state pushed by OctoPrint rather than polled
+        self.history = TelemetryHistory()
+        self.state_cache = PrinterStateCache(printer, on_temperature=self.record_history)
+        self._printer.register_callback(self.state_cache)
+
+        # Scheduler for downloads, uploads and deletes
+        self.file_jobs = FileJobScheduler(self._logger)
+        self.gcode_cache = GcodeCache(
+            get_gcode_cache_dir(), self.gcode_cache_bytes(config.current), self._logger
+        )
+        config.add_listener(self.on_settings_refresh)
+        self.print_queue = PrintQueue(self, settings, self._logger)
+
+    @property
+    def gcode_line_num_no_comments(self):
+        return self.gcode_position[0]
+
+    @gcode_line_num_no_comments.setter
+    def gcode_line_num_no_comments(self, value):
+        self.gcode_position = (value, self.gcode_position[1])
+
+    @property
+    def gcode_cmd(self):
+        return self.gcode_position[1]
+
+    @gcode_cmd.setter
+    def gcode_cmd(self, value):
+        self.gcode_position = (self.gcode_position[0], value)
+
+    def capture_snapshot(self, count=None):
+        """
+        Captures a snapshot of the printer and settings, shared by everything
+        that reports on the current sampling tick.
+
+        Args:
+            count (int): The image count the snapshot belongs to.
+
+        Returns:
+            TelemetrySnapshot: The captured snapshot.
+        """
+        self.latest_snapshot = TelemetrySnapshot.capture(self, config.current, count)
+        return self.latest_snapshot
+
+    def current_snapshot(self, max_age):
+        """Returns the latest snapshot if it is recent enough, otherwise captures a new one"""
+        snapshot = self.latest_snapshot
+        if snapshot is None or snapshot.age() > max_age:
+            snapshot = self.capture_snapshot()
+        return snapshot
+
+    @staticmethod
+    def gcode_cache_bytes(snapshot):
+        """Returns the G-code cache size budget of a settings snapshot, in bytes"""
+        return int(snapshot.get("gcode_cache_size_mb") or GCODE_CACHE_SIZE_MB) * 1024**2
+
+    def on_settings_refresh(self, snapshot):
+        """Applies a new G-code cache size budget"""
+        self.gcode_cache.resize(self.gcode_cache_bytes(snapshot))
+
+    def record_history(self, temperatures, timestamp=None):
+        """
+        Adds a sample to the telemetry history. Called for every temperature
+        report, so the history also covers the time between prints.
+
+        Args:
+            temperatures (dict): The merged temperatures of all heaters.
+            timestamp (float): Unix time of the report.
+        """
+        tool0 = temperatures.get("tool0", {})
+        bed = temperatures.get("bed", {})
+        self.history.append(
+            timestamp,
+            hotend_actual=tool0.get("actual"),
+            hotend_target=tool0.get("target"),
+            bed_actual=bed.get("actual"),
+            bed_target=bed.get("target"),
+            flow_rate=self.flow_rate,
+            feed_rate=self.feed_rate,
+            z=self.layer_trigger.current_z,
+        )
+
+    def close(self):
+        """Stops receiving printer callbacks"""
+        self._printer.unregister_callback(self.state_cache)
 
     def reset(self):
         """Resets all parameters to default values"""
@@ -94,10 +269,11 @@ class MattaPrinter:
         Returns:
             dict: A dictionary containing the printer's state, temperature data, and printer data.
         """
+        state, temperatures, current_data = self.state_cache.get()
         data = {
-            "state": self._printer.get_state_string(),
-            "temperature_data": self._printer.get_current_temperatures(),
-            "printer_data": self._printer.get_current_data(),
+            "state": state,
+            "temperature_data": temperatures,
+            "printer_data": current_data,
         }
         return data
 
@@ -134,10 +310,11 @@ class MattaPrinter:
         """Retrieves information on the current print job"""
         return self._printer.get_current_job()
 
-    def make_job_name(self):
+    def make_job_name(self, name=None):
         """Generates a job name string in the format 'filename_timestamp'"""
-        job_details = self.get_current_job()
-        filename, _ = os.path.splitext(job_details["file"]["name"])
+        if name is None:
+            name = self.get_current_job()["file"]["name"]
+        filename, _ = os.path.splitext(name)
         dt = make_timestamp()
         return f"{filename}_{dt}"
 
@@ -145,25 +322,54 @@ class MattaPrinter:
         """Checks if the printer is operational"""
         return self._printer.is_ready() or self._printer.is_operational()
 
-    def just_finished(self):
-        """Checks if the state has turned from printing to finished"""
-        if self.printing == False and self.finished == False:
-            return True
-        return False
-
     def has_job(self):
         """Checks if the printer currently has a print job."""
-        if (
+        return (
             self._printer.is_printing()
             or self._printer.is_paused()
             or self._printer.is_pausing()
-        ):
-            self.printing = True
-            self.finished = False
-            return True
-        self.extruding = False
-        self.printing = False
-        return False
+        )
+
+    def submit_download(self, json_file, priority=None, on_finish=None):
+        """
+        Queues the download of a file from the cloud onto the file job scheduler,
+        so the main thread is not blocked.
+
+        Args:
+            json_file (dict): The file details ("file", "url", "loc", "print" and optionally "hash").
+            priority (int): The job priority, defaults to print-now for files printed straight away.
+            on_finish (callable): Called with the job once it has finished, see FileJobScheduler.submit.
+
+        Returns:
+            FileJob: The queued job.
+        """
+        destination = (
+            FileDestinations.SDCARD
+            if json_file["loc"] == "sd"
+            else FileDestinations.LOCAL
+        )
+        file_url = json_file["url"]
+
+        # Get the signature of the add_file method
+        sig = inspect.signature(self._file_manager.add_file)
+
+        if priority is None:
+            priority = PRIORITY_PRINT_NOW if json_file["print"] else PRIORITY_BACKGROUND
+        return self.file_jobs.submit(
+            "download",
+            download_file_and_print,
+            file_url,
+            destination,
+            sig,
+            json_file,
+            self._file_manager,
+            self._printer,
+            gcode_cache=self.gcode_cache,
+            key=f"download:{destination}:{json_file['file']}:{json_file.get('hash') or file_url}:{json_file['print']}",
+            priority=priority,
+            description=json_file["file"],
+            on_finish=on_finish,
+        )
 
     def handle_cmds(self, json_msg):
         """
@@ -218,53 +424,28 @@ class MattaPrinter:
                 )
             elif json_msg["files"]["cmd"] == "upload":
                 # Download the file from the URL and save it to the local file system
+                self.submit_download(json_msg["files"])
+            elif json_msg["files"]["cmd"] == "delete":
                 destination = (
                     FileDestinations.SDCARD
                     if json_msg["files"]["loc"] == "sd"
                     else FileDestinations.LOCAL
                 )
-                file_url = json_msg["files"]["url"]
-
-                # Get the signature of the add_file method
-                sig = inspect.signature(self._file_manager.add_file)
-
-                # Check if 'destination' or 'location' are in the parameters
-                has_destination = 'destination' in sig.parameters
-                has_location = 'location' in sig.parameters
-
-                json_file = json_msg["files"]
-                
-                # call the download_file_and_print function
-                # in new thread and do not block the main thread
-                
-                self.executor.submit(
-                    download_file_and_print,
-                    file_url,
-                    destination,
-                    sig,
-                    json_file,
-                    self._file_manager,
-                    self._printer,
+                is_folder = json_msg["files"]["type"] == "folder"
+                path = (
+                    json_msg["files"]["folder"] if is_folder else json_msg["files"]["file"]
                 )
-
-            elif json_msg["files"]["cmd"] == "delete":
-                destination = (
-                    FileDestinations.SDCARD
-                    if json_msg["files"]["loc"] == "sd"
-                    else FileDestinations.LOCAL
+                self.file_jobs.submit(
+                    "delete",
+                    delete_path,
+                    self._file_manager,
+                    path,
+                    destination,
+                    folder=is_folder,
+                    key=f"delete:{destination}:{path}",
+                    priority=PRIORITY_INTERACTIVE,
+                    description=path,
                 )
-                if json_msg["files"]["type"] == "folder":
-                    self.executor.submit(
-                        self._file_manager.remove_folder,
-                        path=json_msg["files"]["folder"],
-                        location=destination,
-                    )
-                else:
-                    self.executor.submit(
-                        self._file_manager.remove_file,
-                        path=json_msg["files"]["file"],
-                        location=destination,
-                    )
             elif json_msg["files"]["cmd"] == "new_folder":
                 destination = (
                     FileDestinations.SDCARD
@@ -286,11 +467,19 @@ class MattaPrinter:
                 full_path = self._file_manager.path_on_disk(
                     destination, json_msg["files"]["file"]
                 )
-                self.executor.submit(
+                self.file_jobs.submit(
+                    "upload",
                     upload_file_to_backend,
                     full_path,
-                    self._settings.get(["auth_token"]),
+                    config.current.auth_token,
+                    key=f"upload:{full_path}",
+                    priority=PRIORITY_INTERACTIVE,
+                    description=json_msg["files"]["file"],
                 )
+            elif json_msg["files"]["cmd"] == "cancel":
+                self.file_jobs.cancel(int(json_msg["files"]["job_id"]))
+        elif "queue" in json_msg:
+            self.print_queue.handle_cmd(json_msg["queue"])
         elif "gcode" in json_msg:
             if json_msg["gcode"]["cmd"] == "send":
                 self._printer.commands(commands=json_msg["gcode"]["lines"])
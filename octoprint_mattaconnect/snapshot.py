@@ -0,0 +1,100 @@
+'''
+This module holds the per-tick telemetry snapshot. It is captured once per
+sampling tick and shared by the CSV row, the frame metadata and the websocket
+packet, so all of them describe the same instant.
+'''
+import time
+
+from .utils import make_timestamp
+
+
+class TelemetrySnapshot:
+    """Immutable view of the printer and plugin settings at one instant"""
+
+    __slots__ = (
+        "monotonic",
+        "timestamp",
+        "count",
+        "state",
+        "temperatures",
+        "printer_data",
+        "flow_rate",
+        "feed_rate",
+        "z_offset",
+        "hotend_target",
+        "hotend_actual",
+        "bed_target",
+        "bed_actual",
+        "gcode_line_num",
+        "gcode_cmd",
+        "layer",
+        "nozzle_tip_coords_x",
+        "nozzle_tip_coords_y",
+        "flip_h",
+        "flip_v",
+        "rotate",
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    @classmethod
+    def capture(cls, matta_printer, settings, count=None):
+        """
+        Reads the printer state, the comm thread fields and the settings once.
+
+        Args:
+            matta_printer (MattaPrinter): The virtual printer.
+            settings (SettingsSnapshot): The current plugin settings.
+            count (int): The image count the snapshot belongs to.
+
+        Returns:
+            TelemetrySnapshot: The captured snapshot.
+        """
+        # the sent-line hook swaps this tuple in one go, so line and command match
+        gcode_line_num, gcode_cmd = matta_printer.gcode_position
+        state, temperatures, printer_data = matta_printer.state_cache.get()
+        tool0 = (temperatures or {}).get("tool0", {})
+        bed = (temperatures or {}).get("bed", {})
+        return cls(
+            monotonic=time.monotonic(),
+            timestamp=make_timestamp(),
+            count=count,
+            state=state,
+            temperatures=temperatures,
+            printer_data=printer_data,
+            flow_rate=matta_printer.flow_rate,
+            feed_rate=matta_printer.feed_rate,
+            z_offset=matta_printer.z_offset,
+            hotend_target=tool0.get("target"),
+            hotend_actual=tool0.get("actual"),
+            bed_target=bed.get("target"),
+            bed_actual=bed.get("actual"),
+            gcode_line_num=gcode_line_num,
+            gcode_cmd=gcode_cmd,
+            layer=matta_printer.layer_trigger.layer,
+            nozzle_tip_coords_x=settings.nozzle_tip_coords_x,
+            nozzle_tip_coords_y=settings.nozzle_tip_coords_y,
+            flip_h=settings.flip_h,
+            flip_v=settings.flip_v,
+            rotate=settings.rotate,
+        )
+
+    def age(self):
+        """Returns how many seconds ago the snapshot was captured"""
+        return time.monotonic() - self.monotonic
+
+    def get_data(self):
+        """Returns the printer data in the same shape as MattaPrinter.get_data"""
+        return {
+            "state": self.state,
+            "temperature_data": self.temperatures,
+            "printer_data": self.printer_data,
+        }
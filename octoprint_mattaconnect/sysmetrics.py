@@ -0,0 +1,180 @@
+'''
+This module holds the system metrics sampler. A background thread reads
+memory, CPU, load, disk space, SoC temperature, the Raspberry Pi throttling
+flags and the plugin process's own usage at a low rate, and publishes them as
+one snapshot. Readers (ws_data, the resource governor) take the latest
+snapshot instead of calling into psutil themselves.
+'''
+import os
+import time
+import shutil
+import threading
+import subprocess
+
+import psutil
+
+from .utils import (
+    get_current_memory_usage,
+    get_gcode_upload_dir,
+    MATTA_TMP_DATA_DIR,
+)
+
+SYSTEM_SAMPLE_INTERVAL = 5.0  # seconds between snapshots
+
+THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+THROTTLED_SYSFS = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+
+
+def read_temperature():
+    """Returns the SoC temperature in degrees C, or None if the board does not report it"""
+    try:
+        with open(THERMAL_ZONE) as file:
+            return int(file.read().strip()) / 1000.0
+    except (OSError, ValueError):
+        return None
+
+
+def read_throttled():
+    """
+    Reads the Raspberry Pi firmware's throttling flags, from sysfs where the
+    kernel exposes them and from vcgencmd otherwise.
+
+    Returns:
+        int: The get_throttled bits, or None on boards without them.
+    """
+    try:
+        with open(THROTTLED_SYSFS) as file:
+            return int(file.read().strip(), 16)
+    except (OSError, ValueError):
+        pass
+    if shutil.which("vcgencmd") is None:
+        return None
+    try:
+        output = subprocess.check_output(["vcgencmd", "get_throttled"], timeout=2)
+        return int(output.decode("utf-8").strip().split("=")[-1], 16)
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+
+def disk_usage(path):
+    """Returns the free and total bytes and the used percentage of the disk holding path"""
+    try:
+        usage = psutil.disk_usage(path)
+    except OSError:
+        return None
+    return {"free": usage.free, "total": usage.total, "percent": usage.percent}
+
+
+class SystemSampler:
+    """
+    Samples the system every SYSTEM_SAMPLE_INTERVAL seconds. The snapshot is
+    a new dict each time and is never changed after it is published, so a
+    reader always sees one consistent set of readings.
+    """
+
+    def __init__(self, interval=SYSTEM_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.snapshot = {}
+        self.listeners = []
+        self._logger = None
+        self._thread = None
+        self._process = psutil.Process()
+        self._disks = {}
+        self._has_thermal = os.path.exists(THERMAL_ZONE)
+        self._has_throttled = True  # until a read finds nothing
+
+    def add_listener(self, listener):
+        """Registers listener(snapshot) to be called after every sample"""
+        self.listeners.append(listener)
+
+    def start(self, logger, disks=None):
+        """
+        Takes a first snapshot and starts sampling in a background thread.
+
+        Args:
+            logger: The plugin logger.
+            disks (dict): Name to path of the directories whose disk space is reported,
+                by default the uploads and .matta directories.
+        """
+        self._logger = logger
+        self._disks = disks or {
+            "uploads": get_gcode_upload_dir(),
+            "matta": MATTA_TMP_DATA_DIR,
+        }
+        # the first CPU readings only set the baseline the later ones are measured from
+        psutil.cpu_percent(interval=None)
+        self._process.cpu_percent(interval=None)
+        self.snapshot = self.sample(cpu=False)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="matta-sysmetrics")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                snapshot = self.sample()
+            except Exception as e:
+                if self._logger:
+                    self._logger.error(f"Failed to sample system metrics: {e}")
+                continue
+            self.snapshot = snapshot
+            for listener in self.listeners:
+                try:
+                    listener(snapshot)
+                except Exception as e:
+                    if self._logger:
+                        self._logger.error(f"System metrics listener failed: {e}")
+
+    def sample(self, cpu=True):
+        """
+        Takes one snapshot.
+
+        Args:
+            cpu (bool): Read the CPU usage since the last sample, False for the first one.
+
+        Returns:
+            dict: The readings, None where the system does not report one.
+        """
+        memory = psutil.virtual_memory()
+        try:
+            load = [round(value, 2) for value in os.getloadavg()]
+        except (AttributeError, OSError):  # not available on Windows
+            load = None
+        with self._process.oneshot():
+            rss = self._process.memory_info().rss
+            process_cpu = self._process.cpu_percent(interval=None) if cpu else None
+        throttled = read_throttled() if self._has_throttled else None
+        self._has_throttled = throttled is not None
+        return {
+            "time": time.time(),
+            "memory": {
+                "used": memory.used,
+                "total": memory.total,
+                "available": memory.available,
+                "percent": memory.percent,
+            },
+            "memory_usage": get_current_memory_usage(memory),
+            "cpu_percent": psutil.cpu_percent(interval=None) if cpu else None,
+            "cpu_count": psutil.cpu_count(),
+            "load": load,
+            "disk": {name: disk_usage(path) for name, path in self._disks.items()},
+            "temperature": read_temperature() if self._has_thermal else None,
+            "throttled": throttled,
+            "process": {"rss": rss, "cpu_percent": process_cpu},
+        }
+
+    def memory_usage(self):
+        """
+        Returns the memory usage in the format get_current_memory_usage reports.
+
+        Returns:
+            tuple: Used memory (formatted string), total memory (formatted string)
+                and memory usage percentage, zeros before the first sample.
+        """
+        return self.snapshot.get("memory_usage", (0, 0, 0))
+
+
+# shared by the whole plugin, so the system is sampled once for every reader
+system_metrics = SystemSampler()
@@ -0,0 +1,195 @@
+'''
+This module holds the monotonic deadline scheduler used by the sampling and
+websocket loops, with a histogram of the actual intervals between ticks so
+their cadence can be checked under load, and the timer for the plugin's
+start-up steps.
+'''
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+# Upper edges, in ms, of the buckets of (actual interval - period)
+JITTER_BUCKETS_MS = (-500, -100, -20, -5, 5, 20, 50, 100, 250, 500, 1000, 5000, math.inf)
+
+
+class IntervalHistogram:
+    """Fixed-bucket histogram of how far actual tick intervals deviate from the period"""
+
+    def __init__(self, buckets=JITTER_BUCKETS_MS):
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+        self.total_abs_deviation = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, interval, period):
+        """
+        Records one interval.
+
+        Args:
+            interval (float): Seconds since the previous tick.
+            period (float): The period the tick was scheduled at.
+        """
+        deviation_ms = (interval - period) * 1000
+        for i, edge in enumerate(self.buckets):
+            if deviation_ms <= edge:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += interval
+        self.total_abs_deviation += abs(deviation_ms)
+        self.min = interval if self.min is None else min(self.min, interval)
+        self.max = interval if self.max is None else max(self.max, interval)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_interval": round(self.total / self.count, 4) if self.count else None,
+            "min_interval": None if self.min is None else round(self.min, 4),
+            "max_interval": None if self.max is None else round(self.max, 4),
+            "mean_abs_jitter_ms": (
+                round(self.total_abs_deviation / self.count, 2) if self.count else None
+            ),
+            "buckets_ms": [
+                [edge if edge != math.inf else "+Inf", count]
+                for edge, count in zip(self.buckets, self.counts)
+            ],
+        }
+
+
+class DeadlineScheduler:
+    """
+    Fires at fixed deadlines on the monotonic clock, so timing errors do not
+    accumulate the way sleeping a fixed amount per loop does.
+
+    When ticks fall behind (for example while an upload blocks the loop),
+    policy "skip" drops the missed deadlines and resumes on the period grid,
+    while "catch_up" fires the missed ticks back to back, up to max_catch_up.
+    """
+
+    def __init__(self, period, policy="skip", max_catch_up=3, wakeup=None, clock=time.perf_counter):
+        if policy not in ("skip", "catch_up"):
+            raise ValueError(f"Unknown deadline policy: {policy}")
+        self.period = period
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.wakeup = wakeup if wakeup is not None else threading.Event()
+        self.clock = clock
+        self.histogram = IntervalHistogram()
+        self.ticks = 0
+        self.missed = 0
+        self.last_tick = None
+        self.next_deadline = clock()
+
+    def set_period(self, period):
+        """Changes the period, the next deadline moves to one new period after the last tick"""
+        if period == self.period:
+            return
+        self.period = period
+        if self.last_tick is not None:
+            self.next_deadline = self.last_tick + period
+        self.wakeup.set()
+
+    def due(self, now=None):
+        now = self.clock() if now is None else now
+        return now >= self.next_deadline
+
+    def time_until(self, now=None):
+        """Returns the seconds left until the next deadline, 0 if it has passed"""
+        now = self.clock() if now is None else now
+        return max(0.0, self.next_deadline - now)
+
+    def _record(self, now):
+        if self.last_tick is not None:
+            self.histogram.record(now - self.last_tick, self.period)
+        self.last_tick = now
+        self.ticks += 1
+
+    def tick(self, now=None):
+        """Records a tick at the current deadline and schedules the next one"""
+        now = self.clock() if now is None else now
+        self._record(now)
+        self.next_deadline += self.period
+        behind = now - self.next_deadline
+        if behind < 0:
+            return
+        missed = int(behind // self.period) + 1
+        if self.policy == "catch_up" and missed <= self.max_catch_up:
+            return  # the missed ticks fire straight away
+        self.missed += missed
+        self.next_deadline += missed * self.period
+
+    def restart(self, now=None):
+        """Records an out-of-schedule tick and restarts the period from it"""
+        now = self.clock() if now is None else now
+        self._record(now)
+        self.next_deadline = now + self.period
+
+    def reset(self, now=None):
+        """Makes the next deadline due immediately, e.g. when sampling starts"""
+        self.next_deadline = self.clock() if now is None else now
+        self.last_tick = None
+
+    def wait(self, max_wait=None):
+        """
+        Sleeps until the next deadline, returning early if woken.
+
+        Args:
+            max_wait (float): Optional cap on the sleep, in seconds.
+        """
+        timeout = self.time_until()
+        if max_wait is not None:
+            timeout = min(timeout, max_wait)
+        if self.wakeup.wait(timeout):
+            self.wakeup.clear()
+
+    def stats(self):
+        return {
+            "period": self.period,
+            "policy": self.policy,
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "intervals": self.histogram.to_dict(),
+        }
+
+
+class StartupTimings:
+    """Records how long each import and subsystem start of the plugin took"""
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.steps = []  # (name, seconds) in the order they ran
+        self.failed = []
+
+    @contextmanager
+    def measure(self, name):
+        """Times the body of the with block as the step name, even if it raises"""
+        started = self.clock()
+        try:
+            yield
+        except Exception:
+            self.failed.append(name)
+            raise
+        finally:
+            self.steps.append((name, self.clock() - started))
+
+    def total(self):
+        return sum(seconds for _, seconds in self.steps)
+
+    def summary(self):
+        """Returns the steps as one line for the log, slowest first"""
+        steps = sorted(self.steps, key=lambda step: step[1], reverse=True)
+        return ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in steps)
+
+    def to_dict(self):
+        return {
+            "total_ms": round(self.total() * 1000, 1),
+            "steps_ms": {name: round(seconds * 1000, 1) for name, seconds in self.steps},
+            "failed": list(self.failed),
+        }
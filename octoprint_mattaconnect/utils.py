@@ -1,11 +1,13 @@
 import psutil
-import requests
 import sentry_sdk
 import time
 import os
 from datetime import datetime
 from sys import platform
 
+from .client import http
+from .bandwidth import bandwidth
+
 
 MATTA_OS_ENDPOINT = "https://os.matta.ai/"
 # MATTA_OS_ENDPOINT = "http://localhost"
@@ -14,6 +16,8 @@ MATTA_TMP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".matta")
 
 SAMPLING_TIMEOUT = 1.25  # sample every 1.25 seconds
 
+GCODE_CACHE_SIZE_MB = 1024  # default size budget of the local G-code cache
+
 
 def get_cloud_http_url():
     """
@@ -76,40 +80,25 @@ def convert_bytes_to_formatted_string(bytes):
     return bytes
 
 
-def get_current_memory_usage(os):
+def get_current_memory_usage(memory=None):
     """
-    Gets the current memory usage of the computer/SBC depending on the OS.
+    Gets the current memory usage of the computer/SBC. psutil reads it the same
+    way on Linux, Windows and macOS.
 
     Args:
-        os (str): The operating system identifier. Valid values are "linux", "windows", or "mac".
+        memory: A psutil.virtual_memory() reading to format, taken now if not given.
 
     Returns:
         tuple: A tuple containing three values: used memory (formatted string),
                total memory (formatted string), and memory usage percentage.
     """
-    if os == "linux":
-        used = psutil.virtual_memory().used
-        used = convert_bytes_to_formatted_string(used)
-        total = psutil.virtual_memory().total
-        total = convert_bytes_to_formatted_string(total)
-        percent = psutil.virtual_memory().percent
-        return used, total, percent
-    elif os == "windows":
-        used = psutil.virtual_memory().used
-        used = convert_bytes_to_formatted_string(used)
-        total = psutil.virtual_memory().total
-        total = convert_bytes_to_formatted_string(total)
-        percent = psutil.virtual_memory().percent
-        return used, total, percent
-    elif os == "mac":
-        used = psutil.virtual_memory().used
-        used = convert_bytes_to_formatted_string(used)
-        total = psutil.virtual_memory().total
-        total = convert_bytes_to_formatted_string(total)
-        percent = psutil.virtual_memory().percent
-        return used, total, percent
-    else:
-        return 0, 0, 0
+    if memory is None:
+        memory = psutil.virtual_memory()
+    return (
+        convert_bytes_to_formatted_string(memory.used),
+        convert_bytes_to_formatted_string(memory.total),
+        memory.percent,
+    )
 
 
 def get_gcode_upload_dir():
@@ -135,6 +124,17 @@ def get_gcode_upload_dir():
     return os.path.expanduser(path)
 
 
+def get_gcode_cache_dir():
+    """
+    Returns the path for the content-addressed G-code cache. It lives next to the
+    uploads directory so that cached files can be hard linked into place.
+
+    Returns:
+        str: The path for the G-code cache directory.
+    """
+    return os.path.join(os.path.dirname(get_gcode_upload_dir()), "matta_cache")
+
+
 def make_timestamp():
     """Generates a timestamp string in the format 'YYYY-MM-DDTHH:MM:SS.sssZ'"""
     dt = datetime.utcnow().isoformat(sep="T", timespec="milliseconds") + "Z"
@@ -175,14 +175,9 @@ def init_sentry(version):
 def get_file_from_backend(bucket_file, auth_token):
     """Gets a file from the backend"""
     full_url = get_api_url() + "print-jobs/printer/gcode/uploadfile"
-    headers = generate_auth_headers(auth_token)
     data = {"bucket_file": bucket_file}
     try:
-        resp = requests.post(
-            url=full_url,
-            data=data,
-            headers=headers,
-        )
+        resp = http.post(full_url, data=data, token=auth_token)
         # print data from resp
         resp.raise_for_status()
         return resp.text
@@ -202,7 +197,7 @@ def get_file_from_url(file_url):
 
     for i in range(retries):
         try:
-            resp = requests.get(file_url)
+            resp = http.get(file_url)
             resp.raise_for_status()
             return resp.text
         except Exception as e:
@@ -211,37 +206,50 @@ def get_file_from_url(file_url):
             else:
                 raise e
 
-def download_file_from_url(file_url):
+def download_file_from_url(file_url, job=None, max_bytes_per_sec=None):
     """
     Stream large file download to a string.
 
     Args:
         file_url (str): The URL to download the file from.
+        job (FileJob): Optional job to report download progress to, the
+            download is aborted if the job gets cancelled.
+        max_bytes_per_sec (int): Optional cap on the download rate.
     """
     retries = 3
     decay = 2  # decay factor for wait time between retries
 
     for i in range(retries):
         try:
-            with requests.get(file_url, stream=True) as r:
+            with http.get(file_url, stream=True) as r:
                 r.raise_for_status()
-                file_content = ''
-                for chunk in r.iter_content(chunk_size=8192, decode_unicode=True): 
-                    # if chuck is bytes, decode it to utf-8
-                    if not isinstance(chunk, str):
-                        chunk = chunk.decode('utf-8')
-                    file_content += chunk
-            return file_content
+                total = int(r.headers.get("Content-Length", 0)) or None
+                chunks = []
+                received = 0
+                started = time.perf_counter()
+                for chunk in r.iter_content(chunk_size=8192):
+                    bandwidth.throttle("down", "bulk", len(chunk))
+                    chunks.append(chunk)
+                    received += len(chunk)
+                    if job is not None:
+                        job.update_progress(received, total)
+                    if max_bytes_per_sec:
+                        ahead = received / max_bytes_per_sec - (time.perf_counter() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            # decode once so multi-byte characters split across chunks survive
+            return b"".join(chunks).decode("utf-8")
         except Exception as e:
+            if job is not None and job.cancelled:
+                raise
             if i < retries - 1:  # no need to wait after the last try
                 time.sleep(decay ** i)  # wait time increases with each retry
             else:
                 raise e
-            
+
 def post_file_to_backend_for_download(file_name, file_content, auth_token):
     """Posts a file to the backend"""
     full_url = get_api_url() + "printers/upload-from-edge/download-request"
-    headers = generate_auth_headers(auth_token)
     # get the content type given file name extension (gcode, stl, etc.)
     content_type = "text/plain"
     if (
@@ -254,10 +262,12 @@ def post_file_to_backend_for_download(file_name, file_content, auth_token):
         "file": (file_name, file_content, content_type),
     }
     try:
-        resp = requests.post(
-            url=full_url,
+        resp = http.post(
+            full_url,
             files=files,
-            headers=headers,
+            token=auth_token,
+            breaker="download-request",
+            traffic="bulk",
         )
         # print data from resp
         resp.raise_for_status()
@@ -3,70 +3,389 @@ This module is responsible for downloading and uploading files to the MattaOS
 as well as long websocket processes
 '''
 import os
-import queue
+import heapq
+import itertools
 import threading
+import time
+from collections import deque
 from inspect import Signature
 from .utils import download_file_from_url, post_file_to_backend_for_download
+from .metrics import metrics
 
-# class FileWorker:
-#     def __init__(self, file_manager, printer) -> None:
-#         self.file_manager = file_manager
-#         self.printer = printer
+# Job priorities, lower runs first
+PRIORITY_PRINT_NOW = 0
+PRIORITY_INTERACTIVE = 10
+PRIORITY_BACKGROUND = 20
 
-#         self.start_worker_threads()
+# Maximum number of jobs of each kind allowed to run at the same time.
+# "download" is cloud -> printer, "upload" is printer -> cloud.
+DEFAULT_FILE_JOB_CONCURRENCY = {
+    "download": 1,
+    "upload": 1,
+    "delete": 2,
+    "prefetch": 1,
+    "cache": 1,  # hashing a printed file into the G-code cache
+}
 
-#     def start_worker_threads(self):
-#         # Make queue for managing the download and print tasks
-#         if not hasattr(self, "queue"):
-#             self.queue = queue.Queue()
-#             self.queue_condition = threading.Condition()
 
-#         # Start the main worker thread
-#         self.main_thread = threading.Thread(target=self.thread_loop)
-#         self.main_thread.daemon = True
-#         self.thread_running = True
-#         self.main_thread.start()
-#         self._logger.info("Main worker thread running.")
+class JobCancelled(Exception):
+    """Raised inside a running job once it has been cancelled"""
+
+
+class FileJob:
+    """A single file operation queued on the FileJobScheduler"""
+
+    def __init__(self, job_id, kind, key, priority, description, fn, args, kwargs):
+        self.job_id = job_id
+        self.kind = kind
+        self.key = key
+        self.priority = priority
+        self.description = description
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.state = "queued"  # queued, running, done, failed, cancelled
+        self.error = None
+        self.bytes_done = 0
+        self.bytes_total = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.on_finish = []  # callables taking the job, called once it has finished
+        self._cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        """Flags the job as cancelled, running jobs stop at their next progress update"""
+        self._cancel_event.set()
+
+    def check_cancelled(self):
+        """Raises JobCancelled if the job has been cancelled"""
+        if self.cancelled:
+            raise JobCancelled(self.job_id)
+
+    def update_progress(self, bytes_done, bytes_total=None):
+        """
+        Records the progress of a running job and aborts it if it was cancelled.
+
+        Args:
+            bytes_done (int): Bytes transferred so far.
+            bytes_total (int): Total bytes to transfer, if known.
+        """
+        self.bytes_done = bytes_done
+        if bytes_total:
+            self.bytes_total = bytes_total
+        self.check_cancelled()
+
+    def progress(self):
+        """Returns the completion ratio of the job (0-1), or None if unknown"""
+        if self.state == "done":
+            return 1.0
+        if self.bytes_total:
+            return min(1.0, self.bytes_done / self.bytes_total)
+        return None
+
+    def to_dict(self):
+        return {
+            "id": self.job_id,
+            "kind": self.kind,
+            "description": self.description,
+            "priority": self.priority,
+            "state": self.state,
+            "progress": self.progress(),
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+class FileJobScheduler:
+    """
+    Runs file operations (downloads, uploads, deletes) on a small pool of
+    worker threads, with a concurrency limit per kind of job, priorities,
+    cancellation and de-duplication of identical requests.
+    """
+
+    def __init__(self, logger, concurrency=None, history_size=20):
+        self._logger = logger
+        self._concurrency = dict(DEFAULT_FILE_JOB_CONCURRENCY)
+        if concurrency:
+            self._concurrency.update(concurrency)
+        self._condition = threading.Condition()
+        self._heap = []  # entries of (priority, seq, job)
+        self._seq = itertools.count()
+        self._ids = itertools.count(1)
+        self._running = {kind: 0 for kind in self._concurrency}
+        self._active = {}  # job_id -> job, for queued and running jobs
+        self._active_keys = {}  # dedup key -> job
+        self._history = deque(maxlen=history_size)
+        self._paused_kinds = set()
+        metrics.gauge(
+            "matta_file_jobs_queued",
+            "File jobs waiting to run",
+            fn=lambda: sum(1 for job in list(self._active.values()) if job.state == "queued"),
+        )
+        self._workers = []
+        for i in range(sum(self._concurrency.values())):
+            worker = threading.Thread(
+                target=self._worker_loop, name=f"matta-file-job-{i}"
+            )
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(
+        self,
+        kind,
+        fn,
+        *args,
+        key=None,
+        priority=PRIORITY_BACKGROUND,
+        description=None,
+        on_finish=None,
+        **kwargs,
+    ):
+        """
+        Queues a file operation. The callable is invoked as fn(job, *args, **kwargs).
+
+        Args:
+            kind (str): The kind of job ("download", "upload", "delete").
+            fn (callable): The function doing the work.
+            key (str): Optional de-duplication key, identical requests share a job.
+            priority (int): Lower values run first.
+            description (str): Human readable description for reporting.
+            on_finish (callable): Called with the job once it is done, failed or cancelled.
+
+        Returns:
+            FileJob: The queued (or already existing) job.
+        """
+        with self._condition:
+            if key is not None and key in self._active_keys:
+                existing = self._active_keys[key]
+                if on_finish is not None:
+                    existing.on_finish.append(on_finish)
+                if existing.state == "queued" and priority < existing.priority:
+                    # re-queue with the more urgent priority, the stale heap entry is skipped
+                    existing.priority = priority
+                    heapq.heappush(self._heap, (priority, next(self._seq), existing))
+                    self._condition.notify_all()
+                self._logger.debug(f"File job {existing.job_id} already queued for {key}")
+                return existing
+            job = FileJob(
+                next(self._ids), kind, key, priority, description, fn, args, kwargs
+            )
+            if on_finish is not None:
+                job.on_finish.append(on_finish)
+            self._running.setdefault(kind, 0)
+            self._active[job.job_id] = job
+            if key is not None:
+                self._active_keys[key] = job
+            heapq.heappush(self._heap, (priority, next(self._seq), job))
+            self._condition.notify_all()
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued or running job.
+
+        Returns:
+            bool: True if a job was found and cancelled, False otherwise.
+        """
+        with self._condition:
+            job = self._active.get(job_id)
+            if job is None:
+                return False
+            job.cancel()
+            queued = job.state == "queued"
+            if queued:
+                self._finish(job, "cancelled")
+            self._condition.notify_all()
+        if queued:
+            self._notify(job)
+        return True
+
+    def pause_kind(self, kind, paused=True):
+        """
+        Stops (or resumes) dispatching queued jobs of the given kind. Print-now
+        jobs still run, since holding them would keep a print from starting.
+        """
+        with self._condition:
+            if paused:
+                self._paused_kinds.add(kind)
+            else:
+                self._paused_kinds.discard(kind)
+            self._condition.notify_all()
+
+    def snapshot(self):
+        """
+        Returns the queued, running and recently finished jobs for reporting.
+
+        Returns:
+            dict: Lists of job dictionaries keyed by "queued", "running" and "recent".
+        """
+        with self._condition:
+            active = sorted(
+                self._active.values(), key=lambda job: (job.priority, job.job_id)
+            )
+            return {
+                "queued": [job.to_dict() for job in active if job.state == "queued"],
+                "running": [job.to_dict() for job in active if job.state == "running"],
+                "recent": [job.to_dict() for job in self._history],
+            }
+
+    def _finish(self, job, state, error=None):
+        """Moves a job out of the active set. Must be called with the lock held."""
+        job.state = state
+        job.error = error
+        job.finished_at = time.time()
+        self._active.pop(job.job_id, None)
+        if job.key is not None and self._active_keys.get(job.key) is job:
+            del self._active_keys[job.key]
+        self._history.append(job)
+
+    def _next_job(self):
+        """Pops the most urgent runnable job. Must be called with the lock held."""
+        skipped = []
+        job = None
+        while self._heap:
+            priority, seq, candidate = heapq.heappop(self._heap)
+            if candidate.state != "queued" or priority != candidate.priority:
+                continue  # stale entry
+            limit = self._concurrency.get(candidate.kind, 1)
+            paused = (
+                candidate.kind in self._paused_kinds
+                and candidate.priority > PRIORITY_PRINT_NOW
+            )
+            if paused or self._running[candidate.kind] >= limit:
+                skipped.append((priority, seq, candidate))
+                continue
+            job = candidate
+            break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return job
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_job()
+                self._running[job.kind] += 1
+                job.state = "running"
+                job.started_at = time.time()
+            state, error = "done", None
+            try:
+                job.check_cancelled()
+                job.fn(job, *job.args, **job.kwargs)
+            except JobCancelled:
+                state = "cancelled"
+                self._logger.info(f"File job {job.job_id} cancelled.")
+            except Exception as e:
+                state, error = "failed", str(e)
+                self._logger.error(f"File job {job.job_id} ({job.description}) failed: {e}")
+            with self._condition:
+                self._running[job.kind] -= 1
+                self._finish(job, state, error)
+                self._condition.notify_all()
+            self._record(job)
+            self._notify(job)
+
+    def _notify(self, job):
+        """Calls the job's on_finish callbacks, outside the lock"""
+        for callback in job.on_finish:
+            try:
+                callback(job)
+            except Exception as e:
+                self._logger.error(f"File job {job.job_id} callback failed: {e}")
+
+    @staticmethod
+    def _record(job):
+        """Records a finished job's duration, outcome and bytes moved"""
+        labels = {"kind": job.kind}
+        metrics.histogram(
+            "matta_file_job_seconds", "Time taken by file jobs", labels
+        ).observe(job.finished_at - job.started_at)
+        metrics.counter(
+            "matta_file_jobs_total", "File jobs by outcome", dict(labels, state=job.state)
+        ).inc()
+        if job.bytes_done:
+            metrics.counter(
+                "matta_file_job_bytes_total", "Bytes moved by file jobs", labels
+            ).inc(job.bytes_done)
 
-#     def thread_loop(self):
 
 class FileObjectWithSaveMethod:
     response = None
     def __init__(self, response) -> None:
         self.response = response
     def save(self, destination_path):
+        # replace rather than truncate, the old file may be hard linked into the G-code cache
+        if os.path.exists(destination_path):
+            os.remove(destination_path)
         with open(destination_path, "w") as file:
             file.write(self.response)
 
-def download_file_and_print(file_url, destination, signature: Signature, json_file: dict, file_manager, printer):
-    
+class FileObjectFromCache:
+    """File object which links a cached G-code file into place on save"""
+    def __init__(self, gcode_cache, file_hash) -> None:
+        self.gcode_cache = gcode_cache
+        self.file_hash = file_hash
+    def save(self, destination_path):
+        if not self.gcode_cache.link_to(self.file_hash, destination_path):
+            raise FileNotFoundError(f"{self.file_hash} is not in the G-code cache")
+
+def download_file_and_print(job, file_url, destination, signature: Signature, json_file: dict, file_manager, printer, gcode_cache=None):
+
     # Check if 'destination' or 'location' are in the parameters
     has_destination = 'destination' in signature.parameters
     has_location = 'location' in signature.parameters
 
-    # download the file from the URL
-    response = download_file_from_url(file_url)
-    if response is None:
-        return
+    file_hash = json_file.get("hash")
+    if gcode_cache is not None and gcode_cache.has(file_hash, verify=True):
+        # already on disk, no need to download it again
+        file_object = FileObjectFromCache(gcode_cache, file_hash)
+    else:
+        # download the file from the URL
+        response = download_file_from_url(file_url, job=job)
+        if response is None:
+            return
+        job.check_cancelled()
+        file_object = FileObjectWithSaveMethod(response)
+        if gcode_cache is not None:
+            try:
+                file_hash = gcode_cache.put_bytes(
+                    response.encode("utf-8"), expected_hash=file_hash
+                )
+                file_object = FileObjectFromCache(gcode_cache, file_hash)
+            except OSError:
+                pass  # fall back to writing the downloaded content
 
     if has_destination:
         file_manager.add_file(
             path=json_file["file"],
-            file_object=FileObjectWithSaveMethod(response),
+            file_object=file_object,
             destination=destination,
             allow_overwrite=True,
         )
     elif has_location:
         file_manager.add_file(
             path=json_file["file"],
-            file_object=FileObjectWithSaveMethod(response),
+            file_object=file_object,
             location=destination,
             allow_overwrite=True,
         )
     else:
         file_manager.add_file(
             path=json_file["file"],
-            file_object=FileObjectWithSaveMethod(response),
+            file_object=file_object,
             allow_overwrite=True,
         )
 
@@ -76,11 +395,21 @@ def download_file_and_print(file_url, destination, signature: Signature, json_fi
             json_file["file"], sd=on_sd, printAfterSelect=True
         )
 
-def upload_file_to_backend(full_path, auth_token):
+def upload_file_to_backend(job, full_path, auth_token):
+    job.update_progress(0, os.path.getsize(full_path))
     with open(full_path, "r") as file:
         file_content = file.read()
         response = post_file_to_backend_for_download(
             os.path.basename(full_path),
             file_content,
             auth_token,
-        )
\ No newline at end of file
+        )
+    job.update_progress(job.bytes_total or 0)
+
+
+def delete_path(job, file_manager, path, location, folder=False):
+    """Removes a file or folder through OctoPrint's file manager"""
+    if folder:
+        file_manager.remove_folder(path=path, location=location)
+    else:
+        file_manager.remove_file(path=path, location=location)
@@ -1,9 +1,19 @@
 import json
+import time
 import logging
 import websocket
 
+from .bandwidth import bandwidth
+from .metrics import metrics, SEND_BUCKETS
+
 _logger = logging.getLogger("octoprint.plugins.mattaconnect")
 
+SEND_TIME = metrics.histogram(
+    "matta_ws_send_seconds", "Time taken to send a WebSocket message", buckets=SEND_BUCKETS
+)
+SENT_BYTES = metrics.counter("matta_ws_sent_bytes_total", "Bytes sent over the WebSocket")
+SEND_ERRORS = metrics.counter("matta_ws_send_errors_total", "Failed WebSocket sends")
+
 
 class Socket:
     def __init__(self, on_message, url, token):
@@ -21,8 +31,15 @@ class Socket:
             if isinstance(msg, dict):
                 msg = json.dumps(msg)
             if self.connected() and self.socket is not None:
+                # charge the bytes on the wire, not the characters
+                size = len(msg.encode("utf-8")) if isinstance(msg, str) else len(msg)
+                bandwidth.throttle("up", "control", size)
+                started = time.perf_counter()
                 self.socket.send(msg)
+                SEND_TIME.observe(time.perf_counter() - started)
+                SENT_BYTES.inc(size)
         except Exception as e:
+            SEND_ERRORS.inc()
             _logger.info("ERROR Socket send_msg: %s", e)
             self.disconnect()
 